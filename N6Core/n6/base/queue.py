@@ -7,8 +7,12 @@
 # some of the docstrings are taken from or contain fragments of the
 # docs of the `pika` library.
 
+import collections
 import functools
+import inspect
+import math
 import sys
+import time
 import types
 
 try:
@@ -18,7 +22,9 @@ except ImportError:
 import contextlib
 import copy
 import pprint
+import Queue
 import re
+import threading
 
 try:
     import pika
@@ -30,12 +36,46 @@ except ImportError:
 from n6lib.amqp_helpers import get_amqp_connection_params_dict
 from n6lib.argument_parser import N6ArgumentParser
 from n6lib.auth_api import AuthAPICommunicationError
+from n6lib.config import Config
 from n6lib.log_helpers import get_logger
 
 
 LOGGER = get_logger(__name__)
 
 
+# (the defaults are taken from the respective QueuedBase attributes)
+QUEUE_CONFIG_SPEC_PATTERN = '''
+    [{queue_config_section}]
+    prefetch_count = {prefetch_count} :: int
+    adaptive_prefetch = {adaptive_prefetch} :: bool
+    min_prefetch_count = {min_prefetch_count} :: int
+    max_prefetch_count = {max_prefetch_count} :: int
+    prefetch_target_buffer_time = {prefetch_target_buffer_time} :: float
+    prefetch_adjustment_interval = {prefetch_adjustment_interval} :: float
+    max_workers = {max_workers} :: int
+    batch_max_size = {batch_max_size} :: int
+    batch_max_wait = {batch_max_wait} :: float
+'''
+
+
+# (used to capture the output messages "published" in worker threads)
+_worker_thread_state = threading.local()
+
+
+def _call_catching_exc_info(func):
+    try:
+        return func(), None
+    except:
+        return None, sys.exc_info()
+
+
+def _reraise(exc_info):
+    try:
+        raise exc_info[0], exc_info[1], exc_info[2]
+    finally:
+        del exc_info
+
+
 class n6QueueProcessingException(Exception):
     pass
 
@@ -44,6 +84,262 @@ class n6AMQPCommunicationError(Exception):
     pass
 
 
+class BatchedMessage(object):
+
+    """
+    An input message passed (within a list) to batch_input_callback().
+
+    Public attributes: `delivery_tag`, `routing_key`, `body`,
+    `properties` (see: QueuedBase.on_message()) and `exc_info` (None
+    or a failure info set with mark_failed()).
+    """
+
+    __slots__ = ('delivery_tag', 'routing_key', 'body', 'properties', 'exc_info')
+
+    def __init__(self, delivery_tag, routing_key, body, properties):
+        self.delivery_tag = delivery_tag
+        self.routing_key = routing_key
+        self.body = body
+        self.properties = properties
+        self.exc_info = None
+
+    def __repr__(self):
+        return '<{0} #{1!r} routed with key {2!r}>'.format(
+            self.__class__.__name__,
+            self.delivery_tag,
+            self.routing_key)
+
+    def mark_failed(self):
+        """
+        Mark the message as failed (it will be nack-ed instead of acked).
+
+        To be called in an `except` block (the info about the exception
+        being handled is recorded, to be logged later).
+        """
+        self.exc_info = sys.exc_info()
+
+
+class _PublisherConfirmsTracker(object):
+
+    """
+    Bookkeeping for the "publisher confirms" mode of QueuedBase.
+
+    It keeps track of: (1) input deliveries that have not been
+    acknowledged yet, (2) output messages published on their behalf
+    that have not been confirmed by the broker yet.  An input delivery
+    is ready to be acknowledged when its processing has finished and
+    all its output messages have been confirmed; the longest ready
+    prefix of the (ordered by delivery tags) not-yet-acknowledged input
+    deliveries can be acknowledged with one `multiple=True` Basic.Ack.
+
+    Delivery tags that are not known (any more) -- i.e., the tags of
+    input deliveries that have already been dropped (nack-ed) or that
+    were started before the last reset() -- are ignored by
+    input_done() and output_published().
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # publish sequence number of the most recently published output
+        # message (RabbitMQ numbers them from 1, per channel)
+        self._last_publish_no = 0
+        # input delivery tag -> [<num of unconfirmed outputs>, <is done?>]
+        self._pending_inputs = collections.OrderedDict()
+        # publish sequence number -> tuple of input delivery tags
+        self._unconfirmed_outputs = collections.OrderedDict()
+
+    def input_started(self, delivery_tag):
+        self._pending_inputs[delivery_tag] = [0, False]
+
+    def input_done(self, delivery_tag):
+        input_state = self._pending_inputs.get(delivery_tag)
+        if input_state is not None:
+            input_state[1] = True
+
+    def input_dropped(self, delivery_tag):
+        self._pending_inputs.pop(delivery_tag, None)
+
+    def is_pending(self, delivery_tag):
+        return delivery_tag in self._pending_inputs
+
+    def output_published(self, delivery_tags):
+        self._last_publish_no += 1
+        delivery_tags = tuple(tag for tag in delivery_tags
+                              if tag in self._pending_inputs)
+        self._unconfirmed_outputs[self._last_publish_no] = delivery_tags
+        for tag in delivery_tags:
+            self._pending_inputs[tag][0] += 1
+
+    def outputs_confirmed(self, publish_no, multiple, ok):
+        """
+        Register a broker's Basic.Ack (`ok` being true) or Basic.Nack
+        (`ok` being false) concerning output message(s).
+
+        Returns:
+            A sorted list of the delivery tags of the input deliveries
+            whose outputs have been rejected by the broker (always empty
+            if `ok` is true).
+        """
+        if multiple:
+            publish_nos = []
+            for no in self._unconfirmed_outputs:
+                if no > publish_no:
+                    break
+                publish_nos.append(no)
+        else:
+            publish_nos = [publish_no]
+        failed_tags = set()
+        for no in publish_nos:
+            for tag in self._unconfirmed_outputs.pop(no, ()):
+                input_state = self._pending_inputs.get(tag)
+                if input_state is None:
+                    # already nack-ed
+                    continue
+                input_state[0] -= 1
+                if not ok:
+                    failed_tags.add(tag)
+        return sorted(failed_tags)
+
+    def pop_ackable_tag(self):
+        """
+        Forget the longest ready-to-be-acked prefix of the pending
+        input deliveries and return the delivery tag of the last of
+        them (or None if there are no such deliveries).
+        """
+        ackable_tag = None
+        while self._pending_inputs:
+            tag, (num_of_unconfirmed, done) = next(self._pending_inputs.iteritems())
+            if num_of_unconfirmed or not done:
+                break
+            del self._pending_inputs[tag]
+            ackable_tag = tag
+        return ackable_tag
+
+
+class _AdaptivePrefetchController(object):
+
+    """
+    Computes the prefetch count for the "adaptive prefetch" mode of
+    QueuedBase.
+
+    The desired prefetch window is the number of messages the consumer
+    needs to stay busy for `target_buffer_time` seconds (computed from
+    the moving average of per-message processing times) -- but it is
+    not enlarged beyond the current depth of the input queue (there is
+    no point in doing that), and it is always kept within the
+    [`min_prefetch_count`, `max_prefetch_count`] bounds.  Small changes
+    are ignored (to avoid superfluous Basic.Qos round-trips).
+    """
+
+    # weight of the most recent sample in the moving average
+    SMOOTHING_FACTOR = 0.2
+
+    # minimum relative change of the prefetch count to be applied
+    MIN_RELATIVE_CHANGE = 0.25
+
+    def __init__(self, prefetch_count, min_prefetch_count, max_prefetch_count,
+                 target_buffer_time):
+        if not 1 <= min_prefetch_count <= max_prefetch_count:
+            raise ValueError(
+                'the condition 1 <= min_prefetch_count ({0!r}) <= '
+                'max_prefetch_count ({1!r}) is not satisfied'.format(
+                    min_prefetch_count, max_prefetch_count))
+        self.min_prefetch_count = min_prefetch_count
+        self.max_prefetch_count = max_prefetch_count
+        self.target_buffer_time = target_buffer_time
+        self.prefetch_count = self._clamp(prefetch_count)
+        self.avg_processing_time = None
+
+    def _clamp(self, prefetch_count):
+        return max(self.min_prefetch_count,
+                   min(self.max_prefetch_count, prefetch_count))
+
+    def message_processed(self, processing_time):
+        if self.avg_processing_time is None:
+            self.avg_processing_time = processing_time
+        else:
+            self.avg_processing_time += self.SMOOTHING_FACTOR * (
+                processing_time - self.avg_processing_time)
+
+    def get_adjusted_prefetch_count(self, queue_depth=None):
+        """
+        Get the new prefetch count (or None if it should not be changed).
+
+        Args:
+            `queue_depth` (optional):
+                The number of messages ready to be delivered from the
+                input queue (None if unknown).
+        """
+        if self.avg_processing_time is None:
+            return None
+        desired = int(math.ceil(self.target_buffer_time /
+                                max(self.avg_processing_time, 1e-6)))
+        if queue_depth is not None:
+            desired = min(desired, max(self.prefetch_count, queue_depth))
+        desired = self._clamp(desired)
+        if abs(desired - self.prefetch_count) < max(
+                1, self.MIN_RELATIVE_CHANGE * self.prefetch_count):
+            return None
+        self.prefetch_count = desired
+        return desired
+
+
+class _WorkerPool(object):
+
+    """
+    A fixed-size pool of daemon threads (for the worker-pool mode of
+    QueuedBase).
+
+    Tasks are submitted, and their results are consumed, in the ioloop
+    thread: run_done_callbacks() calls, for each finished task, the
+    `on_done` callback (passed to submit()) with the task's result.
+    """
+
+    def __init__(self, max_workers):
+        if max_workers < 1:
+            raise ValueError('max_workers must be positive')
+        self._tasks = Queue.Queue()
+        self._results = Queue.Queue()
+        self.num_of_pending = 0
+        self._threads = []
+        for i in xrange(max_workers):
+            thread = threading.Thread(target=self._work, name='worker-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            func, on_done = self._tasks.get()
+            try:
+                result = func()
+            except:
+                LOGGER.critical('Unhandled exception in a worker thread!', exc_info=True)
+                result = None
+            self._results.put((on_done, result))
+
+    def submit(self, func, on_done):
+        """
+        Args:
+            `func`: An argumentless callable (to be called in a worker thread).
+            `on_done`: A one-argument callable (to be called in the
+                ioloop thread, with the result of `func()`).
+        """
+        self.num_of_pending += 1
+        self._tasks.put((func, on_done))
+
+    def run_done_callbacks(self):
+        while True:
+            try:
+                on_done, result = self._results.get_nowait()
+            except Queue.Empty:
+                break
+            self.num_of_pending -= 1
+            on_done(result)
+
+
 class QueuedBase(object):
 
     """
@@ -119,6 +415,71 @@ class QueuedBase(object):
     #  if the no-ack option is set.
     prefetch_count = 20
 
+    # if set to True (in a subclass or in the config) the prefetch count
+    # is adjusted at runtime (within the [min_prefetch_count,
+    # max_prefetch_count] bounds) -- based on measured processing times
+    # of input messages and on the input queue depth; the prefetch
+    # window is kept large enough to let the component stay busy for
+    # `prefetch_target_buffer_time` seconds without waiting for the
+    # broker; the adjustment is made every `prefetch_adjustment_interval`
+    # seconds (see: _AdaptivePrefetchController)
+    adaptive_prefetch = False
+    min_prefetch_count = 1
+    max_prefetch_count = 500
+    prefetch_target_buffer_time = 1.0
+    prefetch_adjustment_interval = 10.0
+
+    # the name of the config section the above settings (prefetch_count
+    # and the adaptive-prefetch-related ones) can be taken from; None
+    # means that the '<class name>_queue' name will be used; the section
+    # is optional (if it is absent the class attributes are used)
+    queue_config_section = None
+
+    # if set to a positive number (in a subclass or in the config) the
+    # worker-pool mode is turned on: input_callback() is called in one
+    # of `max_workers` threads (so the component can make use of I/O
+    # wait time) and its outputs are published -- and the input message
+    # is acked/nacked -- in the ioloop thread, `worker_results_check_interval`
+    # seconds later at the latest; the mode can be turned on only for
+    # components that declare their input_callback() as thread-safe
+    # (by setting `input_callback_thread_safe` to True); note that the
+    # order of outputs of different input messages is not preserved
+    max_workers = 0
+    input_callback_thread_safe = False
+    worker_results_check_interval = 0.01
+
+    # if set to a positive number (in a subclass or in the config) the
+    # micro-batch mode is turned on: deliveries are accumulated -- up to
+    # `batch_max_size` messages or for `batch_max_wait` seconds (whichever
+    # comes first) -- and then passed together to batch_input_callback()
+    # (note that `prefetch_count` should not be lower than
+    # `batch_max_size`); the mode cannot be combined with the
+    # worker-pool mode
+    batch_max_size = 0
+    batch_max_wait = 0.05
+
+    # if set to True (in a subclass) the "batched reliability" mode is
+    # turned on: RabbitMQ publisher confirms are enabled on the output
+    # channel and each input message is acknowledged (together with
+    # other ones, using `multiple=True`) only when all output messages
+    # published while processing it have been confirmed by the broker
+    # (if the broker rejects any of them the input message is nack-ed
+    # and requeued)
+    publisher_confirms = False
+
+    # if set to True (in a subclass) the output channel is put into the
+    # AMQP transactional mode: output messages published while
+    # processing an input message are committed (Tx.Commit) before
+    # that input message is acknowledged (it is acknowledged only when
+    # Tx.CommitOk arrives) or rolled back (Tx.Rollback) if the input
+    # message is nack-ed; while a Tx.Commit or Tx.Rollback is pending
+    # the next input messages are held (they are processed when
+    # Tx.CommitOk/Tx.RollbackOk arrives), so that each transaction
+    # covers exactly one input message; note: this mode cannot be
+    # combined with the `publisher_confirms`, worker-pool and
+    # micro-batch modes
+    transactional_publishing = False
+
     # basic kwargs for pika.BasicProperties (message-publishing-related)
     basic_prop_kwargs = {'delivery_mode': 2}
 
@@ -304,7 +665,18 @@ class QueuedBase(object):
         self.waiting_for_reconnect = False
         self._closing = False
         self._consumer_tag = None
+        self._confirms_tracker = _PublisherConfirmsTracker()
+        self._processed_delivery_tags = ()
+        self._tx_in_progress = False
+        self._tx_held_deliveries = collections.deque()
+        self._prefetch_controller = None
+        self._prefetch_adjustment_timeout_id = None
+        self._worker_pool = None
+        self._worker_results_check_scheduled = False
+        self._batch = []
+        self._batch_timeout_id = None
         self._conn_params_dict = self.get_connection_params_dict()
+        self.set_queue_configuration()
 
 
     #
@@ -329,10 +701,58 @@ class QueuedBase(object):
         )
         return conn_params_dict
 
+    @classmethod
+    def get_queue_config_section_name(cls):
+        if cls.queue_config_section is not None:
+            return cls.queue_config_section
+        return '{0}_queue'.format(cls.__name__)
+
 
     #
     # Regular instance methods
 
+    def set_queue_configuration(self):
+        """
+        Set the consumer-related attributes (such as `prefetch_count`)
+        from the optional config section (see: `queue_config_section`).
+        """
+        config_section_name = self.get_queue_config_section_name()
+        if Config.is_section_present(config_section_name):
+            config_spec = QUEUE_CONFIG_SPEC_PATTERN.format(
+                queue_config_section=config_section_name,
+                prefetch_count=self.prefetch_count,
+                adaptive_prefetch=self.adaptive_prefetch,
+                min_prefetch_count=self.min_prefetch_count,
+                max_prefetch_count=self.max_prefetch_count,
+                prefetch_target_buffer_time=self.prefetch_target_buffer_time,
+                prefetch_adjustment_interval=self.prefetch_adjustment_interval,
+                max_workers=self.max_workers,
+                batch_max_size=self.batch_max_size,
+                batch_max_wait=self.batch_max_wait)
+            queue_config = Config.section(config_spec)
+            for opt_name, value in queue_config.iteritems():
+                setattr(self, opt_name, value)
+        else:
+            LOGGER.debug('No %r config section, using the defaults', config_section_name)
+        if self.max_workers > 0 and not self.input_callback_thread_safe:
+            raise ValueError(
+                '{0}.input_callback() is not thread-safe so the '
+                'worker-pool mode cannot be used (max_workers={1!r})'
+                .format(self.__class__.__name__, self.max_workers))
+        if self.max_workers > 0 and self.batch_max_size > 0:
+            raise ValueError(
+                'the worker-pool mode (max_workers={0!r}) and the micro-batch '
+                'mode (batch_max_size={1!r}) cannot be combined'
+                .format(self.max_workers, self.batch_max_size))
+        if self.transactional_publishing and (self.publisher_confirms or
+                                              self.max_workers > 0 or
+                                              self.batch_max_size > 0):
+            raise ValueError(
+                'the transactional publishing mode cannot be combined with '
+                'publisher confirms, the worker-pool mode or the micro-batch mode '
+                '(publisher_confirms={0!r}, max_workers={1!r}, batch_max_size={2!r})'
+                .format(self.publisher_confirms, self.max_workers, self.batch_max_size))
+
     # Start/stop-related stuff:
 
     def run(self):
@@ -410,6 +830,9 @@ class QueuedBase(object):
         """
         LOGGER.info('Connection opened')
         self._connection.add_on_close_callback(self.on_connection_closed)
+        # (timeouts scheduled for the previous connection are gone)
+        self._worker_results_check_scheduled = False
+        self._prefetch_adjustment_timeout_id = None
         self.open_channels()
 
     # WARNING: probably due to some bug in some libraries, this callback
@@ -474,6 +897,10 @@ class QueuedBase(object):
         on_channel_open callback will be invoked by pika.
         """
         LOGGER.info('Creating new channels')
+        if self.publisher_confirms:
+            # (delivery tags and publish sequence numbers are
+            # channel-specific, so with new channels we start afresh)
+            self._confirms_tracker.reset()
         if self.input_queue is not None:
             self._connection.channel(on_open_callback=self.on_input_channel_open)
         if self.output_queue is not None:
@@ -515,6 +942,16 @@ class QueuedBase(object):
         self._channel_in = channel
         self._channel_in.add_on_close_callback(self.on_channel_closed)
         self._num_queues_bound = 0
+        if self._batch:
+            LOGGER.warning('Dropping %d not processed messages delivered with the '
+                           'previous channel (they will be redelivered)', len(self._batch))
+        self._batch = []
+        self._batch_timeout_id = None
+        if self._tx_held_deliveries:
+            LOGGER.warning('Dropping %d not processed messages delivered with the '
+                           'previous channel (they will be redelivered)',
+                           len(self._tx_held_deliveries))
+            self._tx_held_deliveries.clear()
         self.setup_input_exchange()
         self.setup_dead_exchange()
 
@@ -529,6 +966,14 @@ class QueuedBase(object):
         self._channel_out = channel
         self._channel_out.add_on_close_callback(self.on_channel_closed)
         self._declared_output_exchanges.clear()
+        if self.publisher_confirms:
+            LOGGER.debug('Enabling publisher confirms')
+            self._channel_out.confirm_delivery(self.on_delivery_confirmation)
+        if self.transactional_publishing:
+            LOGGER.debug('Enabling the transactional mode of the output channel')
+            self._channel_out.tx_select()
+            # (a transaction pending on the previous channel is gone)
+            self._tx_in_progress = False
         self.setup_output_exchanges()
 
     def on_channel_closed(self, channel, reply_code, reply_text):
@@ -699,7 +1144,66 @@ class QueuedBase(object):
             LOGGER.debug('All queues bound (including the dead-letter queue)')
             LOGGER.debug('Setting prefetch count')
             self._channel_in.basic_qos(prefetch_count=self.prefetch_count)
+            if self.max_workers > 0 and self._worker_pool is None:
+                LOGGER.info('Starting %d worker threads', self.max_workers)
+                self._worker_pool = _WorkerPool(self.max_workers)
             self.start_consuming()
+            if self.adaptive_prefetch:
+                if self._prefetch_controller is None:
+                    # (one for the whole lifetime of the component, so
+                    # that the measurements survive reconnections)
+                    self._prefetch_controller = _AdaptivePrefetchController(
+                        self.prefetch_count,
+                        self.min_prefetch_count,
+                        self.max_prefetch_count,
+                        self.prefetch_target_buffer_time)
+                self.schedule_prefetch_adjustment()
+
+    # Adaptive-prefetch-related stuff:
+
+    def schedule_prefetch_adjustment(self):
+        # (making sure that there is only one chain of adjustments)
+        if self._prefetch_adjustment_timeout_id is not None:
+            self._connection.remove_timeout(self._prefetch_adjustment_timeout_id)
+        self._prefetch_adjustment_timeout_id = self._connection.add_timeout(
+            self.prefetch_adjustment_interval,
+            self.check_input_queue_depth)
+
+    def check_input_queue_depth(self):
+        """
+        Get the input queue depth (by issuing a passive Queue.Declare
+        RPC command); when it is complete, the on_input_queue_depth_checked
+        method will be invoked by pika.
+        """
+        self._prefetch_adjustment_timeout_id = None
+        if self._channel_in is None or self._closing:
+            return
+        self._channel_in.queue_declare(
+            self.on_input_queue_depth_checked,
+            self.input_queue["queue_name"],
+            passive=True)
+
+    def on_input_queue_depth_checked(self, method_frame):
+        """
+        Adjust the prefetch count (if needed) and schedule the next check.
+
+        Args:
+            method_frame: The Queue.DeclareOk frame
+        """
+        if self._channel_in is None or self._closing:
+            return
+        queue_depth = method_frame.method.message_count
+        new_prefetch_count = self._prefetch_controller.get_adjusted_prefetch_count(queue_depth)
+        if new_prefetch_count is not None:
+            LOGGER.info('Changing prefetch count from %r to %r (average processing '
+                        'time: %.6fs, input queue depth: %r)',
+                        self.prefetch_count,
+                        new_prefetch_count,
+                        self._prefetch_controller.avg_processing_time,
+                        queue_depth)
+            self.prefetch_count = new_prefetch_count
+            self._channel_in.basic_qos(prefetch_count=new_prefetch_count)
+        self.schedule_prefetch_adjustment()
 
     def start_consuming(self):
         """
@@ -781,8 +1285,101 @@ class QueuedBase(object):
         Args:
             `delivery_tag`: The delivery tag from the Basic.Deliver frame.
         """
-        LOGGER.debug('Acknowledging message %r', delivery_tag)
-        self._channel_in.basic_ack(delivery_tag)
+        if self.publisher_confirms:
+            self._confirms_tracker.input_done(delivery_tag)
+            self.acknowledge_confirmed_messages()
+        elif self.transactional_publishing:
+            LOGGER.debug('Committing output messages related to message %r', delivery_tag)
+            self._tx_in_progress = True
+            self._channel_out.tx_commit(functools.partial(self.on_tx_commit_ok, delivery_tag))
+        else:
+            LOGGER.debug('Acknowledging message %r', delivery_tag)
+            self._channel_in.basic_ack(delivery_tag)
+
+    def on_tx_commit_ok(self, delivery_tag, method_frame):
+        """
+        Invoked by pika when RabbitMQ confirms (Tx.CommitOk) committing
+        the output messages related to the given input message (used in
+        the `transactional_publishing` mode).
+
+        Args:
+            `delivery_tag`: The delivery tag of the input message.
+            `method_frame`: The Tx.CommitOk frame.
+        """
+        if self._channel_in is None:
+            LOGGER.warning('Cannot acknowledge message %r (output messages have '
+                           'been committed) because the input channel is already '
+                           'None', delivery_tag)
+        else:
+            LOGGER.debug('Acknowledging message %r', delivery_tag)
+            self._channel_in.basic_ack(delivery_tag)
+        self.process_held_deliveries()
+
+    def on_tx_rollback_ok(self, method_frame):
+        """
+        Invoked by pika when RabbitMQ confirms (Tx.RollbackOk) rolling
+        back the output messages related to a nack-ed input message
+        (used in the `transactional_publishing` mode).
+
+        Args:
+            `method_frame`: The Tx.RollbackOk frame.
+        """
+        LOGGER.debug('Output messages rolled back')
+        self.process_held_deliveries()
+
+    def process_held_deliveries(self):
+        """
+        Process the input messages held while the previous transaction
+        was pending -- until a new transaction becomes pending (used in
+        the `transactional_publishing` mode).
+        """
+        self._tx_in_progress = False
+        while self._tx_held_deliveries and not self._tx_in_progress:
+            channel, basic_deliver, properties, body = self._tx_held_deliveries.popleft()
+            if channel is not self._channel_in:
+                LOGGER.warning('Dropping message #%r because the channel it was '
+                               'delivered with is no longer in use (the message '
+                               'will be redelivered)', basic_deliver.delivery_tag)
+                continue
+            self.on_message(channel, basic_deliver, properties, body)
+
+    def acknowledge_confirmed_messages(self):
+        """
+        Acknowledge (with one Basic.Ack, using `multiple=True`) all input
+        messages that are ready to be acknowledged, i.e., such ones whose
+        processing has been finished and all output messages have been
+        confirmed by the broker (used in the `publisher_confirms` mode).
+        """
+        delivery_tag = self._confirms_tracker.pop_ackable_tag()
+        if delivery_tag is not None:
+            LOGGER.debug('Acknowledging messages up to %r', delivery_tag)
+            self._channel_in.basic_ack(delivery_tag, multiple=True)
+
+    def on_delivery_confirmation(self, method_frame):
+        """
+        Invoked by pika when RabbitMQ confirms (Basic.Ack) or rejects
+        (Basic.Nack) output message(s) published by us (used in the
+        `publisher_confirms` mode).
+
+        Args:
+            `method_frame`: The Basic.Ack or Basic.Nack frame.
+        """
+        method = method_frame.method
+        ok = not isinstance(method, pika.spec.Basic.Nack)
+        failed_delivery_tags = self._confirms_tracker.outputs_confirmed(
+            method.delivery_tag,
+            multiple=method.multiple,
+            ok=ok)
+        if not ok:
+            LOGGER.warning('Output message(s) up to #%r (multiple=%r) rejected '
+                           'by the broker', method.delivery_tag, method.multiple)
+        if self._channel_in is None:
+            return
+        for delivery_tag in failed_delivery_tags:
+            self.nacknowledge_message(delivery_tag,
+                                      'output message(s) rejected by the broker',
+                                      requeue=True)
+        self.acknowledge_confirmed_messages()
 
     def nacknowledge_message(self, delivery_tag, reason, requeue=False):
         """
@@ -795,6 +1392,18 @@ class QueuedBase(object):
         ## FIXME?: maybe it should be INFO?
         LOGGER.debug('Not-Acknowledging message whose delivery tag is %r\n'
                      'Reason: %r\nRequeue: %r', delivery_tag, reason, requeue)
+        if self.publisher_confirms:
+            if not self._confirms_tracker.is_pending(delivery_tag):
+                # (e.g., the broker has rejected some outputs of the
+                # message while it was still being processed)
+                LOGGER.debug('Message %r has already been nack-ed (or it was '
+                             'delivered with a channel that is no longer in use)',
+                             delivery_tag)
+                return
+            self._confirms_tracker.input_dropped(delivery_tag)
+        elif self.transactional_publishing:
+            self._tx_in_progress = True
+            self._channel_out.tx_rollback(self.on_tx_rollback_ok)
         self._channel_in.basic_nack(delivery_tag, multiple=False, requeue=requeue)
 
     def on_message(self, channel, basic_deliver, properties, body):
@@ -814,16 +1423,64 @@ class QueuedBase(object):
             `properties`: A pika.Spec.BasicProperties object.
             `body`: The message body.
         """
-        exc_info = None
         delivery_tag = basic_deliver.delivery_tag
         routing_key = basic_deliver.routing_key
+        LOGGER.debug('Received message #%r routed with key %r)',
+                     delivery_tag, routing_key)
+        if self.transactional_publishing and self._tx_in_progress:
+            # (publishing now would make the new outputs part of the
+            # pending transaction -- e.g., they would be rolled back
+            # together with the outputs of the previous input message)
+            LOGGER.debug('Holding message #%r until the pending transaction '
+                         'is finished', delivery_tag)
+            self._tx_held_deliveries.append((channel, basic_deliver, properties, body))
+            return
+        if self.publisher_confirms:
+            # (note: it must be done here, in the order of deliveries)
+            self._confirms_tracker.input_started(delivery_tag)
+        if self.batch_max_size > 0:
+            self._batch.append(BatchedMessage(delivery_tag, routing_key, body, properties))
+            if len(self._batch) >= self.batch_max_size:
+                if self._batch_timeout_id is not None:
+                    self._connection.remove_timeout(self._batch_timeout_id)
+                self.flush_batch()
+            elif self._batch_timeout_id is None:
+                self._batch_timeout_id = self._connection.add_timeout(self.batch_max_wait,
+                                                                      self.flush_batch)
+        elif self._worker_pool is None:
+            self.handle_message(delivery_tag, routing_key, body, properties,
+                                functools.partial(self.call_input_callback,
+                                                  routing_key, body, properties))
+        else:
+            self._worker_pool.submit(
+                functools.partial(self._call_input_callback_in_worker,
+                                  routing_key, body, properties),
+                functools.partial(self._on_worker_done,
+                                  channel, delivery_tag, routing_key, body, properties))
+            self._schedule_worker_results_check()
+
+    def handle_message(self, delivery_tag, routing_key, body, properties, process):
+        """
+        Process the message (by calling `process()`) and then ack/nack it.
+
+        Args:
+            `delivery_tag`: The delivery tag from the Basic.Deliver frame.
+            `routing_key`: The routing key from the Basic.Deliver frame.
+            `body`: The message body.
+            `properties`: A pika.Spec.BasicProperties object.
+            `process`: An argumentless callable.
+        """
+        exc_info = None
         try:
-            LOGGER.debug('Received message #%r routed with key %r)',
-                         delivery_tag, routing_key)
+            if self.publisher_confirms:
+                self._processed_delivery_tags = (delivery_tag,)
             try:
-                self.input_callback(routing_key, body, properties)
+                process()
             except AuthAPICommunicationError as exc:
                 sys.exit(exc)
+            finally:
+                if self.publisher_confirms:
+                    self._processed_delivery_tags = ()
         except Exception as exc:
             # Note: catching Exception is OK here.  We *do* want to
             # catch any exception, except SystemExit, KeyboardInterrupt etc.
@@ -857,6 +1514,92 @@ class QueuedBase(object):
         finally:
             del exc_info
 
+    def call_input_callback(self, routing_key, body, properties):
+        """
+        Call input_callback() (measuring its execution time if needed).
+        """
+        start_time = time.time()
+        try:
+            self.input_callback(routing_key, body, properties)
+        finally:
+            if self._prefetch_controller is not None:
+                processing_time = time.time() - start_time
+                if self._worker_pool is not None:
+                    # (the messages are processed concurrently)
+                    processing_time /= self.max_workers
+                self._prefetch_controller.message_processed(processing_time)
+
+    def flush_batch(self):
+        """
+        Process the accumulated messages with batch_input_callback() and
+        then ack/nack each of them (used in the micro-batch mode).
+        """
+        self._batch_timeout_id = None
+        messages = self._batch
+        self._batch = []
+        if not messages:
+            return
+        if self._channel_in is None:
+            LOGGER.warning('Dropping %d not processed messages because the channel '
+                           'they were delivered with is no longer in use (they will '
+                           'be redelivered)', len(messages))
+            return
+        LOGGER.debug('Processing a batch of %d messages', len(messages))
+        start_time = time.time()
+        try:
+            if self.publisher_confirms:
+                # (outputs cannot be assigned to particular messages)
+                self._processed_delivery_tags = tuple(m.delivery_tag for m in messages)
+            try:
+                self.batch_input_callback(messages)
+            finally:
+                if self.publisher_confirms:
+                    self._processed_delivery_tags = ()
+                if self._prefetch_controller is not None:
+                    self._prefetch_controller.message_processed(
+                        (time.time() - start_time) / len(messages))
+        except:
+            # the whole batch failed
+            exc_info = sys.exc_info()
+            try:
+                for message in messages:
+                    if message.exc_info is None:
+                        message.exc_info = exc_info
+            finally:
+                del exc_info
+        for message in messages:
+            process = (lambda: None) if message.exc_info is None else (
+                functools.partial(_reraise, message.exc_info))
+            message.exc_info = None
+            self.handle_message(message.delivery_tag,
+                                message.routing_key,
+                                message.body,
+                                message.properties,
+                                process)
+
+    def batch_input_callback(self, messages):
+        """
+        Process a batch of input messages (used in the micro-batch mode).
+
+        Args:
+            `messages`:
+                A list of BatchedMessage instances.
+
+        After this method returns, each message is acked -- unless it
+        has been marked as failed (with its mark_failed() method); then
+        it is nack-ed.  If this method raises an exception, all the
+        messages are treated as failed.
+
+        The default implementation just calls input_callback() for each
+        message; it can be overridden in subclasses, e.g., to make use
+        of bulk operations.
+        """
+        for message in messages:
+            try:
+                self.input_callback(message.routing_key, message.body, message.properties)
+            except Exception:
+                message.mark_failed()
+
     def input_callback(self, routing_key, body, properties):
         """
         Placeholder for input_callback defined by child classes.
@@ -930,6 +1673,54 @@ class QueuedBase(object):
             msg_parts.append('event id: {0}'.format(event_id))
         return ', '.join(msg_parts)
 
+    # Worker-pool-related stuff:
+
+    def _call_input_callback_in_worker(self, routing_key, body, properties):
+        # (called in a worker thread)
+        captured_outputs = _worker_thread_state.captured_outputs = []
+        exc_info = None
+        try:
+            self.call_input_callback(routing_key, body, properties)
+        except:
+            exc_info = sys.exc_info()
+        finally:
+            _worker_thread_state.captured_outputs = None
+        return functools.partial(self._replay_worker_results, captured_outputs, exc_info)
+
+    def _replay_worker_results(self, captured_outputs, exc_info):
+        # (called in the ioloop thread, by handle_message())
+        for routing_key, body, prop_kwargs, exchange in captured_outputs:
+            self.publish_output(routing_key, body, prop_kwargs, exchange)
+        if exc_info is not None:
+            _reraise(exc_info)
+
+    def _on_worker_done(self, channel, delivery_tag, routing_key, body, properties,
+                        replay_worker_results):
+        # (called in the ioloop thread, by check_worker_results())
+        if channel is not self._channel_in:
+            LOGGER.warning('Dropping the results of processing message #%r because '
+                           'the channel it was delivered with is no longer in use '
+                           '(the message will be redelivered)', delivery_tag)
+            return
+        self.handle_message(delivery_tag, routing_key, body, properties,
+                            replay_worker_results)
+
+    def _schedule_worker_results_check(self):
+        if not self._worker_results_check_scheduled:
+            self._worker_results_check_scheduled = True
+            self._connection.add_timeout(self.worker_results_check_interval,
+                                         self.check_worker_results)
+
+    def check_worker_results(self):
+        """
+        Publish the outputs of the input messages processed in worker
+        threads and ack/nack those messages (invoked by the IOLoop timer).
+        """
+        self._worker_results_check_scheduled = False
+        self._worker_pool.run_done_callbacks()
+        if self._worker_pool.num_of_pending:
+            self._schedule_worker_results_check()
+
     # Output-exchanges-related stuff:
 
     def setup_output_exchanges(self):
@@ -992,7 +1783,16 @@ class QueuedBase(object):
                 The exchange name.  If omitted, the 'exchange' value of
                 the first item of the `output_queue` instance attribute
                 will be used.
+
+        In the worker-pool mode, when called in a worker thread, the
+        method only records the given arguments; the actual publishing
+        is done later, in the ioloop thread.
         """
+        captured_outputs = getattr(_worker_thread_state, 'captured_outputs', None)
+        if captured_outputs is not None:
+            captured_outputs.append((routing_key, body, prop_kwargs, exchange))
+            return
+
         if self._closing:
             # CRITICAL because for a long time (since 2013-04-26!) there was a silent return here!
             LOGGER.critical('Trying to publish when the `_closing` flag is true!')
@@ -1020,6 +1820,8 @@ class QueuedBase(object):
                            routing_key=routing_key,
                            body=body,
                            properties=properties)
+        if self.publisher_confirms:
+            self._confirms_tracker.output_published(self._processed_delivery_tags)
 
         # basic_publish() might trigger the on_connection_closed() callback
         if self._closing or not self.output_ready:
@@ -1048,3 +1850,160 @@ class QueuedBase(object):
                                         routing_key=routing_key,
                                         body=body,
                                         properties=properties)
+
+
+class AsyncQueuedBase(QueuedBase):
+
+    """
+    A QueuedBase variant whose input_callback() is a coroutine.
+
+    The input_callback() method of a subclass should be a generator
+    function.  Whenever the generator needs to perform a blocking
+    operation (e.g., a DNS query or an HTTP request) it should yield:
+
+    * an argumentless callable -- it will be called in a worker thread
+      and its result will be sent back into the generator (or the
+      exception it raised will be thrown into the generator);
+
+    * or a list of such callables -- they will be called concurrently
+      (in worker threads) and the list of their results will be sent
+      back into the generator (or the first raised exception will be
+      thrown into the generator).
+
+    The generator itself is always run in the ioloop thread, so it can
+    freely use publish_output() and any instance state.  The message is
+    acked when the generator finishes, or nack-ed if it raises an
+    exception.  Many messages (up to `prefetch_count`) can be processed
+    concurrently; their blocking operations are performed in a pool of
+    `max_workers` threads.  Note: the adaptive prefetch mode is not
+    supported (see: QueuedBase.adaptive_prefetch).
+
+    Example:
+
+        class MyComponent(AsyncQueuedBase):
+
+            input_queue = {...}
+            output_queue = {...}
+
+            def input_callback(self, routing_key, body, properties):
+                data = json.loads(body)
+                ips = yield functools.partial(self.resolve, data['fqdn'])
+                data['ips'] = ips
+                self.publish_output(routing_key, json.dumps(data))
+
+    The `input_queue`/`output_queue` attributes, as well as the setup
+    of exchanges, queues and the dead-letter exchange, are the same as
+    for QueuedBase.
+    """
+
+    max_workers = 10
+
+    # (input_callback() is *not* run in worker threads, only the
+    # callables it yields are -- so that attribute is irrelevant)
+    input_callback_thread_safe = True
+
+    def set_queue_configuration(self):
+        super(AsyncQueuedBase, self).set_queue_configuration()
+        if self.max_workers < 1:
+            raise ValueError('{0} requires max_workers to be positive (got: {1!r})'
+                             .format(self.__class__.__name__, self.max_workers))
+        if self.adaptive_prefetch:
+            # (the processing time of a message is mostly the time of
+            # waiting for its blocking calls, concurrently with other
+            # messages -- so it is not a meaningful measurement here)
+            raise ValueError('the adaptive prefetch mode cannot be used by {0}'
+                             .format(self.__class__.__name__))
+        if not inspect.isgeneratorfunction(self.input_callback):
+            raise TypeError('input_callback() of {0} is not a generator function'
+                            .format(self.__class__.__name__))
+
+    def on_message(self, channel, basic_deliver, properties, body):
+        """
+        Invoked by pika when a message is delivered from RabbitMQ.
+
+        Args:
+            `channel`: The channel object.
+            `basic_deliver`: A pika.Spec.Basic.Deliver object.
+            `properties`: A pika.Spec.BasicProperties object.
+            `body`: The message body.
+        """
+        delivery_tag = basic_deliver.delivery_tag
+        routing_key = basic_deliver.routing_key
+        LOGGER.debug('Received message #%r routed with key %r)',
+                     delivery_tag, routing_key)
+        if self.publisher_confirms:
+            self._confirms_tracker.input_started(delivery_tag)
+        coroutine = self.input_callback(routing_key, body, properties)
+        if not isinstance(coroutine, types.GeneratorType):
+            # (should not happen, see: set_queue_configuration() -- unless
+            # input_callback() has been replaced on the instance later)
+            def not_a_generator():
+                raise TypeError('input_callback() of {0!r} did not return '
+                                'a generator'.format(self))
+            self.handle_message(delivery_tag, routing_key, body, properties,
+                                not_a_generator)
+            return
+        self._resume_coroutine(channel, delivery_tag, routing_key, body, properties,
+                               coroutine, (None, None))
+
+    def _resume_coroutine(self, channel, delivery_tag, routing_key, body, properties,
+                          coroutine, outcome):
+        if channel is not self._channel_in:
+            LOGGER.warning('Abandoning the processing of message #%r because '
+                           'the channel it was delivered with is no longer in use '
+                           '(the message will be redelivered)', delivery_tag)
+            coroutine.close()
+            return
+        value, exc_info = outcome
+        try:
+            if self.publisher_confirms:
+                self._processed_delivery_tags = (delivery_tag,)
+            try:
+                if exc_info is None:
+                    blocking_call = coroutine.send(value)
+                else:
+                    blocking_call = coroutine.throw(*exc_info)
+            finally:
+                if self.publisher_confirms:
+                    self._processed_delivery_tags = ()
+        except StopIteration:
+            self.handle_message(delivery_tag, routing_key, body, properties,
+                                lambda: None)
+        except:
+            self.handle_message(delivery_tag, routing_key, body, properties,
+                                functools.partial(_reraise, sys.exc_info()))
+        else:
+            resume = functools.partial(self._resume_coroutine,
+                                       channel, delivery_tag, routing_key, body, properties,
+                                       coroutine)
+            self._submit_blocking_call(blocking_call, resume)
+        finally:
+            del exc_info
+
+    def _submit_blocking_call(self, blocking_call, resume):
+        if isinstance(blocking_call, list):
+            if not blocking_call:
+                resume(([], None))
+                return
+            outcomes = [None] * len(blocking_call)
+            num_of_pending = [len(blocking_call)]
+
+            def on_done(i, outcome):
+                outcomes[i] = outcome
+                num_of_pending[0] -= 1
+                if not num_of_pending[0]:
+                    exc_infos = [exc_info for _, exc_info in outcomes
+                                 if exc_info is not None]
+                    if exc_infos:
+                        resume((None, exc_infos[0]))
+                    else:
+                        resume(([value for value, _ in outcomes], None))
+
+            for i, func in enumerate(blocking_call):
+                self._worker_pool.submit(functools.partial(_call_catching_exc_info, func),
+                                         functools.partial(on_done, i))
+        else:
+            self._worker_pool.submit(functools.partial(_call_catching_exc_info, blocking_call),
+                                     resume)
+        self._schedule_worker_results_check()
+
@@ -34,6 +34,7 @@ class _BaseMixIn(object):
     ignored_row_prefixes = '#'
     field_sep = '\t'
     skip_blank_rows = True
+    bulk_row_splitting = True
 
     @staticmethod
     def _get_expires(time):
@@ -8,6 +8,7 @@ Parser base classes + auxiliary tools.
 
 import hashlib
 import itertools
+import multiprocessing
 import operator
 from cStringIO import StringIO
 from datetime import datetime
@@ -32,6 +33,72 @@ LOGGER = get_logger(__name__)
 MAX_IPS_IN_ADDRESS = 63
 
 
+#
+# Fast-path helpers for BaseParser.get_output_message_id() -- each
+# of them returns None if a value cannot be handled by the fast path
+# (then the slower, generic way is used; see the docs of the method)
+
+def _get_id_base_dict_repr(value):
+    item_reprs = {}
+    for k, v in value.iteritems():
+        k_type = type(k)
+        if k_type is unicode:
+            k = k.encode('utf-8')
+        elif k_type is not str:
+            return None
+        v_type = type(v)
+        if v_type is str or v_type is int:
+            v = repr(v)
+        elif v_type is unicode:
+            v = repr(v.encode('utf-8'))
+        elif v_type is long:
+            # non-canonical, int-like repr for long (without the 'L' suffix)
+            v = str(v)
+        else:
+            return None
+        item_reprs[repr(k)] = v
+    return '{' + ', '.join([k + ': ' + v for k, v in sorted(item_reprs.iteritems())]) + '}'
+
+_ID_BASE_ELEMENT_REPR_GETTERS = {
+    str: (lambda value: value),
+    unicode: (lambda value: value.encode('utf-8')),
+    int: str,
+    long: str,
+    dict: _get_id_base_dict_repr,
+}
+
+def _get_id_base_value_repr(value,
+                            _get_element_repr=_ID_BASE_ELEMENT_REPR_GETTERS.get):
+    value_type = type(value)
+    if value_type is list or value_type is tuple:
+        element_reprs = []
+        for el in value:
+            get_repr = _get_element_repr(type(el))
+            el_repr = get_repr(el) if get_repr is not None else None
+            if el_repr is None:
+                return None
+            element_reprs.append(el_repr)
+        element_reprs.sort()
+        return ','.join(element_reprs)
+    get_repr = _get_element_repr(value_type)
+    return get_repr(value) if get_repr is not None else None
+
+
+#
+# Helpers for parsing data chunks in worker processes
+# (see: BaseParser.parse_in_parallel())
+
+# (the parser instance copied into a worker process)
+_parse_worker_parser = None
+
+def _init_parse_worker(parser):
+    global _parse_worker_parser
+    _parse_worker_parser = parser
+
+def _parse_in_worker(chunk_data):
+    return list(_parse_worker_parser.parse(chunk_data))
+
+
 # TODO: finish tests
 class BaseParser(ConfigMixin, QueuedBase):
 
@@ -95,10 +162,45 @@ class BaseParser(ConfigMixin, QueuedBase):
     # (see: get_output_bodies())
     allow_empty_results = False
 
+    # if set to True (in a subclass) the streaming mode is turned on:
+    # each event is published as soon as it has been parsed and
+    # postprocessed -- instead of parsing the whole input data first
+    # (so the memory usage does not depend on the input data size);
+    # output messages are published within an AMQP transaction (see:
+    # QueuedBase.transactional_publishing) so that if processing fails
+    # in the midst none of them is delivered; note: the streaming mode
+    # cannot be used for blacklist parsers (as their postprocessing
+    # needs the total number of events)
+    stream_publishing = False
+
+    # if set to a positive number (in a subclass) the parallel parsing
+    # mode is turned on: each raw data body larger than
+    # `parallel_parse_chunk_size` (in bytes) is split into row-aligned
+    # chunks (see: split_raw_data()) which are parsed in a pool of
+    # `parallel_parse_processes` worker processes (the results are
+    # merged in the original order so that all further processing,
+    # including the computation of event ids and `_bl-series-*` items,
+    # is not affected); note: this mode is suitable only for parsers
+    # whose parse() processes each row/entry independently of others
+    # (it cannot be used for XML data parsers -- see: XmlDataParser)
+    parallel_parse_processes = 0
+    parallel_parse_chunk_size = 4 * 1024 * 1024
+
+    # (the pool of worker processes -- created in run(), i.e., before
+    # connecting to RabbitMQ and starting any threads, so that nothing
+    # but the parser itself is copied into the forked processes; then
+    # shut down in stop())
+    _parse_pool = None
+
 
     @attr_required('default_binding_key')
     def __init__(self, **kwargs):
         assert self.event_type in ('event', 'bl', 'hifreq')
+        if self.stream_publishing:
+            if self.event_type == 'bl':
+                raise ValueError('the streaming mode cannot be used '
+                                 'for blacklist parsers')
+            self.transactional_publishing = True
         super(BaseParser, self).__init__(**kwargs)
         self.set_configuration()
         # the attribute is overridden in order to supply each parser
@@ -182,6 +284,44 @@ class BaseParser(ConfigMixin, QueuedBase):
         except KeyboardInterrupt:
             self.stop()
 
+    def run(self):
+        if self.parallel_parse_processes:
+            self.start_parse_pool()
+        super(BaseParser, self).run()
+
+    def stop(self):
+        try:
+            super(BaseParser, self).stop()
+        finally:
+            self.shut_down_parse_pool()
+
+    def start_parse_pool(self):
+        """
+        Create the pool of worker processes used in the parallel parsing
+        mode (see: `parallel_parse_processes`).
+
+        This method is called in run() -- before connecting to RabbitMQ
+        (the worker processes are forked immediately, so they must not
+        inherit any connection or thread state).
+        """
+        assert self._parse_pool is None
+        LOGGER.info('Starting %d parse worker processes', self.parallel_parse_processes)
+        self._parse_pool = multiprocessing.Pool(self.parallel_parse_processes,
+                                                initializer=_init_parse_worker,
+                                                initargs=(self,))
+
+    def shut_down_parse_pool(self):
+        """
+        Terminate the pool of worker processes (if any) and wait for them
+        to exit (called in stop()).
+        """
+        parse_pool = self._parse_pool
+        if parse_pool is not None:
+            self._parse_pool = None
+            LOGGER.info('Shutting down parse worker processes')
+            parse_pool.terminate()
+            parse_pool.join()
+
     ### XXX: shouldn't the above method be rather:
     # def run_handling(self):
     #     """
@@ -216,8 +356,10 @@ class BaseParser(ConfigMixin, QueuedBase):
 
         * prepare_data(),
         * get_output_rk(),
-        * get_output_bodies(),
-        * and for each item of the sequence returned by get_output_bodies():
+        * get_output_bodies() (or iter_output_bodies() -- if the
+          streaming mode is on; see: `stream_publishing`),
+        * and for each item of the sequence returned by get_output_bodies()
+          (or of the iterator returned by iter_output_bodies()):
           * publish_output() (this one is defined in a superclass --
             typically it is QueuedBase.publish_output()).
 
@@ -229,10 +371,71 @@ class BaseParser(ConfigMixin, QueuedBase):
         rid = data.get('properties.message_id')
         with self.setting_error_event_info(rid):
             output_rk = self.get_output_rk(data)
+            if self.stream_publishing:
+                for output_body in self.iter_output_bodies(data):
+                    self.publish_output(routing_key=output_rk, body=output_body)
+                return
             with FilePagedSequence(page_size=1000) as working_seq:
                 for output_body in self.get_output_bodies(data, working_seq):
                     self.publish_output(routing_key=output_rk, body=output_body)
 
+    def parse_in_parallel(self, data):
+        """
+        Parse the given data in the pool of worker processes (used in
+        the parallel parsing mode; see: `parallel_parse_processes`).
+
+        Args:
+            `data` (dict):
+                As returned by prepare_data() (especially, its 'raw' item
+                contains the raw data body).
+
+        Returns:
+            An iterator over record dicts -- the same (and in the same
+            order) as those yielded by parse() when called for the whole
+            data.
+
+        The raw data body is split using split_raw_data(); then each
+        chunk (as the 'raw' item of a copy of `data`) is parsed with
+        parse() in a worker process.  If split_raw_data() returns None
+        or the pool of worker processes has not been started (see:
+        start_parse_pool()) the whole data are just parsed with parse()
+        in this process.
+
+        Typically, this method is used indirectly -- being called in
+        get_output_bodies() or iter_output_bodies().
+        """
+        if self._parse_pool is None:
+            return self.parse(data)
+        raw_chunks = self.split_raw_data(data)
+        if raw_chunks is None:
+            return self.parse(data)
+        chunk_results = self._parse_pool.imap(
+            _parse_in_worker,
+            (dict(data, raw=raw_chunk) for raw_chunk in raw_chunks))
+        return itertools.chain.from_iterable(chunk_results)
+
+    def split_raw_data(self, data):
+        """
+        Split the raw data body into chunks that can be parsed separately
+        (used in the parallel parsing mode; see: `parallel_parse_processes`).
+
+        Args:
+            `data` (dict):
+                As returned by prepare_data() (especially, its 'raw' item
+                contains the raw data body).
+
+        Returns:
+            A list of raw data chunks (str), each of them consisting of
+            whole rows/entries -- or None if the data cannot be split.
+
+        The default implementation returns None; it is overridden in
+        TabDataParser.
+
+        Typically, this method is used indirectly -- being called in
+        parse_in_parallel().
+        """
+        return None
+
     @staticmethod
     def _fix_body(body):
         # pika < 0.9.14 seems to pass in `body` as unicode when data are
@@ -326,7 +529,9 @@ class BaseParser(ConfigMixin, QueuedBase):
 
         This method calls the following parser-specific methods:
 
-        * parse() (must be implemented in concrete subclasses!),
+        * parse() (must be implemented in concrete subclasses!) -- or
+          parse_in_parallel() (if the parallel parsing mode is on; see:
+          `parallel_parse_processes`),
         * get_output_message_id(),
         * postprocess_parsed().
 
@@ -339,13 +544,7 @@ class BaseParser(ConfigMixin, QueuedBase):
         Typically, this method is used indirectly -- being called in
         input_callback().
         """
-        for parsed in self.parse(data):
-            assert isinstance(parsed, RecordDict)
-            if not parsed.used_as_context_manager:
-                raise AssertionError('record dict yielded in a parser must be '
-                                     'treated with a "with ..." statement!')
-            parsed["id"] = self.get_output_message_id(parsed)
-            self.delete_too_long_address(parsed)
+        for parsed in self._iter_parsed(data):
             working_seq.append(parsed)
         total = len(working_seq)
         for i, parsed in enumerate(working_seq):
@@ -353,16 +552,68 @@ class BaseParser(ConfigMixin, QueuedBase):
                 parsed = self.postprocess_parsed(data, parsed, total,
                                                  item_no=(i + 1))
                 working_seq[i] = parsed.get_ready_json()
-        if not working_seq and not self.allow_empty_results:
-            raise ValueError('no output data to publish; either all data '
-                             'items caused AdjusterError (you can look '
-                             'for apropriate warnings in logs) or input '
-                             'data contained no actual data items')
+        self._verify_output_not_empty(total)
         # we have parsed and postprocessed all data so now
         # we can start publishing without fear of breaking
         # publishing in the midst by a data error
         return working_seq
 
+    def iter_output_bodies(self, data):
+        """
+        Process given data, generating serialized events one by one
+        (used in the streaming mode; see: `stream_publishing`).
+
+        Args:
+            `data` (dict):
+                As returned by prepare_data() (especially, its 'raw' item
+                contains the raw data body).
+
+        Yields:
+            Strings, each being JSON-serialized event data dict.
+
+        This method does the same as get_output_bodies() but each event
+        is yielded immediately after it has been parsed and postprocessed
+        -- so the postprocess_parsed() method gets None as `total` (as
+        the total number of events is not known yet).
+
+        Note that a data error may occur after some events have already
+        been yielded (and published) -- that is why, in the streaming
+        mode, output messages are published within an AMQP transaction
+        which is rolled back when the input message is nack-ed.
+        """
+        item_no = 0
+        for parsed in self._iter_parsed(data):
+            item_no += 1
+            with self.setting_error_event_info(parsed):
+                parsed = self.postprocess_parsed(data, parsed, None,
+                                                 item_no=item_no)
+                output_body = parsed.get_ready_json()
+            yield output_body
+        self._verify_output_not_empty(item_no)
+
+    def _iter_parsed(self, data):
+        # (the part common to get_output_bodies() and iter_output_bodies())
+        if (self.parallel_parse_processes and
+              len(data['raw']) > self.parallel_parse_chunk_size):
+            parsed_items = self.parse_in_parallel(data)
+        else:
+            parsed_items = self.parse(data)
+        for parsed in parsed_items:
+            assert isinstance(parsed, RecordDict)
+            if not parsed.used_as_context_manager:
+                raise AssertionError('record dict yielded in a parser must be '
+                                     'treated with a "with ..." statement!')
+            parsed["id"] = self.get_output_message_id(parsed)
+            self.delete_too_long_address(parsed)
+            yield parsed
+
+    def _verify_output_not_empty(self, total):
+        if not total and not self.allow_empty_results:
+            raise ValueError('no output data to publish; either all data '
+                             'items caused AdjusterError (you can look '
+                             'for apropriate warnings in logs) or input '
+                             'data contained no actual data items')
+
     def delete_too_long_address(self, parsed):
         _address = parsed.get('address')
         if _address and len(_address) > MAX_IPS_IN_ADDRESS:
@@ -574,16 +825,29 @@ class BaseParser(ConfigMixin, QueuedBase):
         # method does call: after any code changes it should generate
         # the same ids for already stored data!  (That's why this code
         # may already seem to be weird a bit...)
+        # Note: values of the most common types (exactly: str, unicode,
+        # int, long, flat dicts of them, as well as lists/tuples of all
+        # of them) are serialized with the fast-path helpers (see:
+        # _get_id_base_value_repr()); other values are serialized with
+        # _get_id_base_value_repr_slowly() -- the results are the same.
         assert isinstance(parsed, RecordDict)
         serialized = []
         for k, v in sorted(self.iter_output_id_base_items(parsed)):
-            if isinstance(v, (list, tuple)):
-                v = ('{}'.format(self._prepare_for_deterministic_serialization(el))
-                     for el in v)
-                v = ','.join(sorted(v))
-            v = self._prepare_for_deterministic_serialization(v)
-            serialized.append("{},{}".format(k, v))
-        return hashlib.md5("\n".join(serialized)).hexdigest()
+            if type(k) is not str:
+                k = '{}'.format(k)
+            v_repr = _get_id_base_value_repr(v)
+            if v_repr is None:
+                v_repr = self._get_id_base_value_repr_slowly(v)
+            serialized.append(k + ',' + v_repr)
+        return hashlib.md5('\n'.join(serialized)).hexdigest()
+
+    def _get_id_base_value_repr_slowly(self, v):
+        if isinstance(v, (list, tuple)):
+            v = ('{}'.format(self._prepare_for_deterministic_serialization(el))
+                 for el in v)
+            v = ','.join(sorted(v))
+        v = self._prepare_for_deterministic_serialization(v)
+        return '{}'.format(v)
 
     def _prepare_for_deterministic_serialization(self, value):
         VALUE_TYPES = str, int, long
@@ -652,8 +916,10 @@ class BaseParser(ConfigMixin, QueuedBase):
                 As returned by prepare_data().
             `parsed` (RecordDict instance):
                 The parsed event data (a RecordDict instance).
-            `total` (int):
-                Total number of parsed events (within latest parse() call).
+            `total` (int or None):
+                Total number of parsed events (within latest parse() call)
+                or None if the streaming mode is on (see:
+                `stream_publishing`).
             `item_no` (int):
                 The number of this parsed event (within latest parse() call).
 
@@ -767,24 +1033,52 @@ class BlackListParser(BaseParser):
     # have to be set, if the datetime is in the ISO format.
     bl_current_time_format = None
 
+    # (the `_bl-series-*`-like items of the input message being
+    # processed -- a dict, filled when the first event is postprocessed;
+    # it is set only while get_output_bodies() is being executed, see:
+    # _get_bl_series_items())
+    _current_bl_series_items = None
+
     @staticmethod
     @picklable
     def handle_parse_error(context_manager_error):
         # any error breaks whole parse() call without publishing anything
         return False
 
+    def get_output_bodies(self, data, working_seq):
+        self._current_bl_series_items = {}
+        try:
+            return super(BlackListParser, self).get_output_bodies(data, working_seq)
+        finally:
+            self._current_bl_series_items = None
+
     def postprocess_parsed(self, data, parsed, total, item_no):
         parsed = super(BlackListParser,
                        self).postprocess_parsed(data, parsed, total, item_no)
+        parsed.update(self._get_bl_series_items(data, parsed))
         parsed.update({
-            "_bl-series-id": data["properties.message_id"],
             "_bl-series-total": total,
             "_bl-series-no": item_no,
-            "_bl-time": data['properties.timestamp'],
-            "_bl-current-time": self._get_bl_current_time(data, parsed)
         })
         return parsed
 
+    def _get_bl_series_items(self, data, parsed):
+        # the items that are the same for all events from the given
+        # input message are computed only once per message (note that
+        # getting `_bl-current-time` may require searching the whole
+        # raw data body)
+        bl_series_items = self._current_bl_series_items
+        if bl_series_items is None:
+            # (called not within get_output_bodies())
+            bl_series_items = {}
+        if not bl_series_items:
+            bl_series_items.update({
+                "_bl-series-id": data["properties.message_id"],
+                "_bl-time": data['properties.timestamp'],
+                "_bl-current-time": self._get_bl_current_time(data, parsed),
+            })
+        return bl_series_items
+
     def _get_bl_current_time(self, data, parsed):
         bl_current_time = self.get_bl_current_time_from_data(data, parsed)
         if bl_current_time:
@@ -839,6 +1133,14 @@ class TabDataParser(BaseParser):
     skip_first_row = False
     skip_blank_rows = False
 
+    # if set to True (in a subclass) all rows are extracted from the raw
+    # data body and split into fields in bulk by iter_rows_fields() --
+    # instead of being processed one by one by iter_rows() and
+    # get_row_fields() (which are then *not* used, so this option must
+    # not be set if any of them is overridden); the results are the same
+    # but for large data bodies the bulk way is significantly faster
+    bulk_row_splitting = False
+
 
     # auxiliary exception (to be used in process_row_fields() implementations)
     class SkipThisRow(Exception):
@@ -854,9 +1156,15 @@ class TabDataParser(BaseParser):
     # -- implement process_row_fields() instead (see below...)
     def parse(self, data):
         SkipThisRow = self.SkipThisRow
-        for row in self.iter_rows(data):
+        if self.bulk_row_splitting:
+            rows = self.iter_rows_fields(data)
+            get_row_fields = (lambda fields: fields)  # (rows are already split)
+        else:
+            rows = self.iter_rows(data)
+            get_row_fields = self.get_row_fields
+        for row in rows:
             with self.new_record_dict(data) as parsed:
-                fields = self.get_row_fields(row)
+                fields = get_row_fields(row)
                 try:
                     r = self.process_row_fields(data, parsed, *fields)
                 except SkipThisRow:
@@ -930,6 +1238,78 @@ class TabDataParser(BaseParser):
                   raw_rows)
         return raw_rows
 
+    def iter_rows_fields(self, data):
+        """
+        Get an iterator over lists of fields of rows extracted from the
+        raw data body (used if `bulk_row_splitting` is true).
+
+        Args:
+            `data` (dict):
+                As returned by prepare_data() (especially, its 'raw' item
+                contains the raw data body).
+
+        Returns:
+            An iterator over lists of row fields (each being an str).
+
+        The results are the same as the results of get_row_fields()
+        applied to each row yielded by iter_rows() -- but all rows are
+        processed in bulk (with list comprehensions instead of chains
+        of iterators and per-row method calls).
+
+        Typically, this method is used indirectly -- being called in parse().
+        """
+        rows = data['raw'].split('\n')
+        if not rows[-1]:
+            # (the last newline character does not start a new row)
+            del rows[-1]
+        if self.skip_first_row:
+            del rows[:1]
+        if not self.disable_row_rstrip:
+            rows = [row.rstrip() for row in rows]
+            if self.skip_blank_rows:
+                rows = [row for row in rows if row]
+        else:
+            rows = [row.rstrip('\r\n') for row in rows]
+            if self.skip_blank_rows:
+                rows = [row for row in rows if row.rstrip()]
+        required_row_prefixes = self.required_row_prefixes
+        if required_row_prefixes is not None:
+            rows = [row for row in rows if row.startswith(required_row_prefixes)]
+        ignored_row_prefixes = self.ignored_row_prefixes
+        if ignored_row_prefixes is not None:
+            rows = [row for row in rows if not row.startswith(ignored_row_prefixes)]
+        field_sep = self.field_sep
+        if self.disable_field_strip:
+            rows_fields = [row.split(field_sep) for row in rows]
+        else:
+            strip = str.strip
+            rows_fields = [map(strip, row.split(field_sep)) for row in rows]
+        return iter(rows_fields)
+
+    def split_raw_data(self, data):
+        """
+        Split the raw data body into row-aligned chunks (of about
+        `parallel_parse_chunk_size` bytes).
+
+        See: BaseParser.split_raw_data().
+
+        If `skip_first_row` is true an empty row is prepended to each
+        chunk except the first one (so that no actual row is skipped).
+        """
+        raw = data['raw']
+        chunk_size = self.parallel_parse_chunk_size
+        raw_chunks = []
+        start = 0
+        while start < len(raw):
+            end = raw.find('\n', start + chunk_size - 1) + 1
+            if not end:
+                end = len(raw)
+            raw_chunks.append(raw[start:end])
+            start = end
+        if self.skip_first_row:
+            raw_chunks[1:] = ['\n' + raw_chunk for raw_chunk in raw_chunks[1:]]
+        return raw_chunks
+
     ## NOTE: typically, this method must be implemented in concrete subclasses
     def process_row_fields(self, data, parsed, *fields):
         """
@@ -981,8 +1361,18 @@ class XmlDataParser(BaseParser):
 
     """
     The main base class for somewhat-typically-xml-data-parsers.
+
+    Note: the parallel parsing mode is not supported (splitting an XML
+    document into entries requires parsing the whole document in the
+    main process -- which costs as much as the actual parsing).
     """
 
+    def __init__(self, **kwargs):
+        if self.parallel_parse_processes:
+            raise ValueError('the parallel parsing mode cannot be used '
+                             'for XML data parsers')
+        super(XmlDataParser, self).__init__(**kwargs)
+
     # auxiliary exception (to be used in process_row_fields() implementations)
     class SkipThisRow(Exception):
         """Raise this in process_row_fields() to skip the processed row."""
@@ -0,0 +1,846 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2018 NASK. All rights reserved.
+
+import collections
+import functools
+import time
+import unittest
+
+import pika
+from mock import (
+    MagicMock,
+    call,
+    patch,
+    sentinel as sen,
+)
+
+from n6.base.queue import (
+    AsyncQueuedBase,
+    QueuedBase,
+    _AdaptivePrefetchController,
+    _PublisherConfirmsTracker,
+    _WorkerPool,
+)
+from n6lib.config import Config
+from n6lib.unit_test_helpers import TestCaseMixin
+
+
+class Test_PublisherConfirmsTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.tracker = _PublisherConfirmsTracker()
+
+    def test_inputs_without_outputs(self):
+        self.tracker.input_started(1)
+        self.tracker.input_started(2)
+        self.assertIsNone(self.tracker.pop_ackable_tag())
+        self.tracker.input_done(2)
+        self.assertIsNone(self.tracker.pop_ackable_tag())
+        self.tracker.input_done(1)
+        self.assertEqual(self.tracker.pop_ackable_tag(), 2)
+        self.assertIsNone(self.tracker.pop_ackable_tag())
+
+    def test_inputs_waiting_for_confirms(self):
+        self.tracker.input_started(1)
+        self.tracker.output_published([1])
+        self.tracker.output_published([1])
+        self.tracker.input_done(1)
+        self.tracker.input_started(2)
+        self.tracker.output_published([2])
+        self.tracker.input_done(2)
+        self.tracker.input_started(3)
+        self.tracker.input_done(3)
+        self.assertIsNone(self.tracker.pop_ackable_tag())
+        self.assertEqual(self.tracker.outputs_confirmed(1, multiple=False, ok=True), [])
+        self.assertIsNone(self.tracker.pop_ackable_tag())
+        self.assertEqual(self.tracker.outputs_confirmed(3, multiple=True, ok=True), [])
+        self.assertEqual(self.tracker.pop_ackable_tag(), 3)
+        self.assertIsNone(self.tracker.pop_ackable_tag())
+
+    def test_later_input_is_not_acked_before_earlier_one(self):
+        self.tracker.input_started(1)
+        self.tracker.output_published([1])
+        self.tracker.input_done(1)
+        self.tracker.input_started(2)
+        self.tracker.output_published([2])
+        self.tracker.input_done(2)
+        self.tracker.outputs_confirmed(2, multiple=False, ok=True)
+        self.assertIsNone(self.tracker.pop_ackable_tag())
+        self.tracker.outputs_confirmed(1, multiple=False, ok=True)
+        self.assertEqual(self.tracker.pop_ackable_tag(), 2)
+
+    def test_rejected_outputs(self):
+        self.tracker.input_started(1)
+        self.tracker.output_published([1])
+        self.tracker.input_done(1)
+        self.tracker.input_started(2)
+        self.tracker.output_published([2])
+        self.tracker.output_published([2])
+        self.tracker.input_done(2)
+        self.tracker.input_started(3)
+        self.tracker.output_published([3])
+        self.tracker.input_done(3)
+        self.assertEqual(self.tracker.outputs_confirmed(3, multiple=True, ok=False), [1, 2])
+        self.tracker.input_dropped(1)
+        self.tracker.input_dropped(2)
+        self.assertIsNone(self.tracker.pop_ackable_tag())
+        self.assertEqual(self.tracker.outputs_confirmed(4, multiple=False, ok=True), [])
+        self.assertEqual(self.tracker.pop_ackable_tag(), 3)
+
+    def test_outputs_of_dropped_input_are_ignored(self):
+        self.tracker.input_started(1)
+        self.tracker.output_published([1])
+        self.tracker.input_dropped(1)
+        self.tracker.input_started(2)
+        self.tracker.input_done(2)
+        self.assertEqual(self.tracker.outputs_confirmed(1, multiple=False, ok=False), [])
+        self.assertEqual(self.tracker.pop_ackable_tag(), 2)
+
+    def test_outputs_without_input(self):
+        self.tracker.output_published([])
+        self.assertEqual(self.tracker.outputs_confirmed(1, multiple=False, ok=False), [])
+        self.assertIsNone(self.tracker.pop_ackable_tag())
+
+    def test_output_of_many_inputs(self):
+        self.tracker.input_started(1)
+        self.tracker.input_started(2)
+        self.tracker.output_published([1, 2])
+        self.tracker.input_done(1)
+        self.tracker.input_done(2)
+        self.assertIsNone(self.tracker.pop_ackable_tag())
+        self.assertEqual(self.tracker.outputs_confirmed(1, multiple=False, ok=False), [1, 2])
+
+    def test_unknown_tags_ignored(self):
+        self.tracker.input_started(1)
+        self.tracker.output_published([1])
+        self.tracker.input_dropped(1)
+        self.assertFalse(self.tracker.is_pending(1))
+        self.tracker.output_published([1])
+        self.tracker.input_done(1)
+        self.tracker.input_done(42)
+        self.assertIsNone(self.tracker.pop_ackable_tag())
+        self.tracker.input_started(2)
+        self.assertTrue(self.tracker.is_pending(2))
+        self.tracker.output_published([1, 2])
+        self.tracker.input_done(2)
+        self.assertEqual(self.tracker.outputs_confirmed(3, multiple=True, ok=True), [])
+        self.assertEqual(self.tracker.pop_ackable_tag(), 2)
+
+    def test_reset(self):
+        self.tracker.input_started(1)
+        self.tracker.output_published([1])
+        self.tracker.reset()
+        self.tracker.input_started(1)
+        self.tracker.output_published([1])
+        self.tracker.input_done(1)
+        self.assertEqual(self.tracker.outputs_confirmed(1, multiple=False, ok=True), [])
+        self.assertEqual(self.tracker.pop_ackable_tag(), 1)
+
+
+class TestQueuedBase__publisher_confirms(TestCaseMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.qb = QueuedBase.__new__(QueuedBase)
+        self.qb.publisher_confirms = True
+        self.qb.output_ready = True
+        self.qb._closing = False
+        self.qb._declared_output_exchanges = {'out'}
+        self.qb.output_queue = [{'exchange': 'out', 'exchange_type': 'topic'}]
+        self.qb._confirms_tracker = _PublisherConfirmsTracker()
+        self.qb._processed_delivery_tags = ()
+        self.qb._prefetch_controller = None
+        self.qb._worker_pool = None
+        self.qb._channel_in = MagicMock()
+        self.qb._channel_out = MagicMock()
+        self.qb.input_callback = MagicMock(side_effect=self._input_callback)
+        self.num_of_outputs = {}
+
+    def _input_callback(self, routing_key, body, properties):
+        for _ in xrange(self.num_of_outputs.get(body, 0)):
+            self.qb.publish_output('rk', body)
+
+    def _deliver(self, delivery_tag, num_of_outputs):
+        body = 'body{0}'.format(delivery_tag)
+        self.num_of_outputs[body] = num_of_outputs
+        self.qb.on_message(sen.channel,
+                           MagicMock(delivery_tag=delivery_tag, routing_key='rk'),
+                           sen.properties,
+                           body)
+
+    def _confirm(self, publish_no, multiple=False, method_class=pika.spec.Basic.Ack):
+        self.qb.on_delivery_confirmation(MagicMock(
+            method=method_class(delivery_tag=publish_no, multiple=multiple)))
+
+    def test_inputs_acked_in_batch_after_confirms(self):
+        self._deliver(1, num_of_outputs=2)
+        self._deliver(2, num_of_outputs=0)
+        self._deliver(3, num_of_outputs=1)
+        self.assertEqual(self.qb._channel_in.mock_calls, [])
+        self.assertEqual(len(self.qb._channel_out.basic_publish.mock_calls), 3)
+        self._confirm(1)
+        self.assertEqual(self.qb._channel_in.mock_calls, [])
+        self._confirm(3, multiple=True)
+        self.assertEqual(self.qb._channel_in.mock_calls, [
+            call.basic_ack(3, multiple=True),
+        ])
+
+    def test_input_without_outputs_acked_immediately(self):
+        self._deliver(1, num_of_outputs=0)
+        self.assertEqual(self.qb._channel_in.mock_calls, [
+            call.basic_ack(1, multiple=True),
+        ])
+
+    def test_rejected_output_causes_input_requeue(self):
+        self._deliver(1, num_of_outputs=1)
+        self._deliver(2, num_of_outputs=1)
+        self._confirm(1, method_class=pika.spec.Basic.Nack)
+        self._confirm(2)
+        self.assertEqual(self.qb._channel_in.mock_calls, [
+            call.basic_nack(1, multiple=False, requeue=True),
+            call.basic_ack(2, multiple=True),
+        ])
+
+    def test_failed_input_is_nacked_and_does_not_block_others(self):
+        self.qb.input_callback.side_effect = [ValueError, None]
+        self._deliver(1, num_of_outputs=0)
+        self._deliver(2, num_of_outputs=0)
+        self.assertEqual(self.qb._channel_in.mock_calls, [
+            call.basic_nack(1, multiple=False, requeue=False),
+            call.basic_ack(2, multiple=True),
+        ])
+
+    def test_mode_disabled(self):
+        self.qb.publisher_confirms = False
+        self._deliver(1, num_of_outputs=1)
+        self.assertEqual(self.qb._channel_in.mock_calls, [
+            call.basic_ack(1),
+        ])
+
+
+class TestAsyncQueuedBase__publisher_confirms(unittest.TestCase):
+
+    def setUp(self):
+        self.qb = AsyncQueuedBase.__new__(AsyncQueuedBase)
+        self.qb.publisher_confirms = True
+        self.qb.output_ready = True
+        self.qb._closing = False
+        self.qb._declared_output_exchanges = {'out'}
+        self.qb.output_queue = [{'exchange': 'out', 'exchange_type': 'topic'}]
+        self.qb._confirms_tracker = _PublisherConfirmsTracker()
+        self.qb._processed_delivery_tags = ()
+        self.qb._worker_pool = MagicMock()
+        self.qb._worker_results_check_scheduled = True
+        self.qb._channel_in = MagicMock()
+        self.qb._channel_out = MagicMock()
+        self.qb.input_callback = self._input_callback
+
+    def _input_callback(self, routing_key, body, properties):
+        self.qb.publish_output(routing_key, body + '1')
+        result = yield sen.blocking_call
+        if result == 'bad':
+            raise ValueError
+        self.qb.publish_output(routing_key, body + '2')
+
+    def _deliver(self, delivery_tag):
+        self.qb.on_message(self.qb._channel_in,
+                           MagicMock(delivery_tag=delivery_tag, routing_key='rk'),
+                           sen.properties,
+                           'body{0}'.format(delivery_tag))
+
+    def _finish_blocking_call(self, result):
+        (_, (_, resume), _), = self.qb._worker_pool.submit.mock_calls
+        resume((result, None))
+
+    def _confirm(self, publish_no, method_class=pika.spec.Basic.Ack):
+        self.qb.on_delivery_confirmation(MagicMock(
+            method=method_class(delivery_tag=publish_no, multiple=False)))
+
+    def test_output_rejected_while_input_still_processed(self):
+        self._deliver(1)
+        self._confirm(1, method_class=pika.spec.Basic.Nack)
+        self.assertEqual(self.qb._channel_in.mock_calls, [
+            call.basic_nack(1, multiple=False, requeue=True),
+        ])
+        self._finish_blocking_call('ok')
+        self._confirm(2)
+        self.assertEqual(len(self.qb._channel_out.basic_publish.mock_calls), 2)
+        # (neither acked nor nack-ed again)
+        self.assertEqual(self.qb._channel_in.mock_calls, [
+            call.basic_nack(1, multiple=False, requeue=True),
+        ])
+
+    def test_output_rejected_while_input_still_processed__input_fails(self):
+        self._deliver(1)
+        self._confirm(1, method_class=pika.spec.Basic.Nack)
+        self._finish_blocking_call('bad')
+        self.assertEqual(self.qb._channel_in.mock_calls, [
+            call.basic_nack(1, multiple=False, requeue=True),
+        ])
+
+    def test_output_rejected_after_input_processed(self):
+        self._deliver(1)
+        self._finish_blocking_call('ok')
+        self.assertEqual(self.qb._channel_in.mock_calls, [])
+        self._confirm(1)
+        self._confirm(2, method_class=pika.spec.Basic.Nack)
+        self.assertEqual(self.qb._channel_in.mock_calls, [
+            call.basic_nack(1, multiple=False, requeue=True),
+        ])
+
+
+class TestQueuedBase__transactional_publishing(unittest.TestCase):
+
+    def setUp(self):
+        self.qb = QueuedBase.__new__(QueuedBase)
+        self.qb.transactional_publishing = True
+        self.qb.output_ready = True
+        self.qb._closing = False
+        self.qb._declared_output_exchanges = {'out'}
+        self.qb.output_queue = [{'exchange': 'out', 'exchange_type': 'topic'}]
+        self.qb._processed_delivery_tags = ()
+        self.qb._tx_in_progress = False
+        self.qb._tx_held_deliveries = collections.deque()
+        self.qb._prefetch_controller = None
+        self.qb._worker_pool = None
+        self.qb._channel_in = MagicMock()
+        self.qb._channel_out = MagicMock()
+        self.qb.input_callback = MagicMock(side_effect=self._input_callback)
+
+    def _input_callback(self, routing_key, body, properties):
+        self.qb.publish_output('rk', body)
+
+    def _deliver(self, delivery_tag, channel=None):
+        self.qb.on_message(channel or self.qb._channel_in,
+                           MagicMock(delivery_tag=delivery_tag, routing_key='rk'),
+                           sen.properties,
+                           'body{0}'.format(delivery_tag))
+
+    def _published_bodies(self):
+        return [c[2]['body'] for c in self.qb._channel_out.basic_publish.mock_calls]
+
+    def test_tx_select_on_output_channel_open(self):
+        channel = MagicMock()
+        with patch.object(QueuedBase, 'setup_output_exchanges') as setup_mock:
+            self.qb.on_output_channel_open(channel)
+        self.assertEqual(channel.tx_select.mock_calls, [call()])
+        self.assertEqual(setup_mock.mock_calls, [call()])
+
+    def test_input_acked_after_commit(self):
+        self._deliver(1)
+        self.assertEqual(self.qb._channel_in.mock_calls, [])
+        self.assertEqual(len(self.qb._channel_out.basic_publish.mock_calls), 1)
+        (_, (commit_ok_callback,), _), = self.qb._channel_out.tx_commit.mock_calls
+        self.assertFalse(self.qb._channel_out.tx_rollback.called)
+        commit_ok_callback(sen.method_frame)
+        self.assertEqual(self.qb._channel_in.mock_calls, [
+            call.basic_ack(1),
+        ])
+
+    def test_commit_ok_after_input_channel_closed(self):
+        self._deliver(1)
+        (_, (commit_ok_callback,), _), = self.qb._channel_out.tx_commit.mock_calls
+        channel_in = self.qb._channel_in
+        self.qb._channel_in = None
+        commit_ok_callback(sen.method_frame)
+        self.assertEqual(channel_in.mock_calls, [])
+
+    def test_failed_input_causes_rollback(self):
+        self.qb.input_callback.side_effect = ValueError
+        self._deliver(1)
+        self.assertEqual(self.qb._channel_out.tx_rollback.mock_calls, [
+            call(self.qb.on_tx_rollback_ok),
+        ])
+        self.assertFalse(self.qb._channel_out.tx_commit.called)
+        self.assertEqual(self.qb._channel_in.mock_calls, [
+            call.basic_nack(1, multiple=False, requeue=False),
+        ])
+
+    def test_nack_while_commit_pending(self):
+        self.qb.input_callback.side_effect = [None, ValueError]
+        self._deliver(1)
+        self._deliver(2)
+        # message #2 is held until the transaction of message #1 is committed
+        self.assertEqual(self.qb.input_callback.call_count, 1)
+        self.assertFalse(self.qb._channel_out.tx_rollback.called)
+        self.assertEqual(self.qb._channel_in.mock_calls, [])
+        (_, (commit_ok_callback,), _), = self.qb._channel_out.tx_commit.mock_calls
+        commit_ok_callback(sen.method_frame)
+        self.assertEqual(self.qb.input_callback.call_count, 2)
+        self.assertEqual(self.qb._channel_out.tx_rollback.mock_calls, [
+            call(self.qb.on_tx_rollback_ok),
+        ])
+        self.assertEqual(self.qb._channel_in.mock_calls, [
+            call.basic_ack(1),
+            call.basic_nack(2, multiple=False, requeue=False),
+        ])
+
+    def test_outputs_not_published_while_rollback_pending(self):
+        def input_callback(routing_key, body, properties):
+            if body == 'body1':
+                raise ValueError
+            self._input_callback(routing_key, body, properties)
+        self.qb.input_callback.side_effect = input_callback
+        self._deliver(1)
+        self._deliver(2)
+        self._deliver(3)
+        # the outputs of messages #2 and #3 must not be rolled back
+        # together with (nonexistent) outputs of message #1
+        self.assertEqual(self._published_bodies(), [])
+        self.qb.on_tx_rollback_ok(sen.method_frame)
+        self.assertEqual(self._published_bodies(), ['body2'])
+        (_, (commit_ok_callback,), _), = self.qb._channel_out.tx_commit.mock_calls
+        commit_ok_callback(sen.method_frame)
+        self.assertEqual(self._published_bodies(), ['body2', 'body3'])
+        self.assertEqual(len(self.qb._channel_out.tx_commit.mock_calls), 2)
+        self.assertEqual(self.qb._channel_in.mock_calls, [
+            call.basic_nack(1, multiple=False, requeue=False),
+            call.basic_ack(2),
+        ])
+        self.assertTrue(self.qb._tx_in_progress)
+        self.assertFalse(self.qb._tx_held_deliveries)
+
+    def test_held_message_from_old_channel_dropped(self):
+        self._deliver(1)
+        self._deliver(2, channel=sen.old_channel)
+        (_, (commit_ok_callback,), _), = self.qb._channel_out.tx_commit.mock_calls
+        commit_ok_callback(sen.method_frame)
+        self.assertEqual(self._published_bodies(), ['body1'])
+        self.assertEqual(self.qb._channel_in.mock_calls, [call.basic_ack(1)])
+        self.assertFalse(self.qb._tx_in_progress)
+        self.assertFalse(self.qb._tx_held_deliveries)
+
+
+class Test_AdaptivePrefetchController(unittest.TestCase):
+
+    def _make_controller(self, prefetch_count=20):
+        return _AdaptivePrefetchController(prefetch_count,
+                                           min_prefetch_count=2,
+                                           max_prefetch_count=100,
+                                           target_buffer_time=1.0)
+
+    def test_init_clamps_prefetch_count(self):
+        self.assertEqual(self._make_controller(1).prefetch_count, 2)
+        self.assertEqual(self._make_controller(1000).prefetch_count, 100)
+
+    def test_init_wrong_bounds(self):
+        with self.assertRaises(ValueError):
+            _AdaptivePrefetchController(20, 0, 100, 1.0)
+        with self.assertRaises(ValueError):
+            _AdaptivePrefetchController(20, 10, 5, 1.0)
+
+    def test_no_measurements(self):
+        controller = self._make_controller()
+        self.assertIsNone(controller.get_adjusted_prefetch_count(1000))
+
+    def test_moving_average(self):
+        controller = self._make_controller()
+        controller.message_processed(1.0)
+        self.assertEqual(controller.avg_processing_time, 1.0)
+        controller.message_processed(2.0)
+        self.assertAlmostEqual(controller.avg_processing_time, 1.2)
+
+    def test_slow_processing_shrinks_window(self):
+        controller = self._make_controller()
+        controller.message_processed(0.25)
+        self.assertEqual(controller.get_adjusted_prefetch_count(1000), 4)
+        self.assertEqual(controller.prefetch_count, 4)
+        self.assertIsNone(controller.get_adjusted_prefetch_count(1000))
+
+    def test_fast_processing_grows_window_within_bounds(self):
+        controller = self._make_controller()
+        controller.message_processed(0.001)
+        self.assertEqual(controller.get_adjusted_prefetch_count(1000), 100)
+
+    def test_window_not_grown_beyond_queue_depth(self):
+        controller = self._make_controller()
+        controller.message_processed(0.001)
+        self.assertIsNone(controller.get_adjusted_prefetch_count(0))
+        self.assertIsNone(controller.get_adjusted_prefetch_count(22))
+        self.assertEqual(controller.get_adjusted_prefetch_count(50), 50)
+        self.assertEqual(controller.get_adjusted_prefetch_count(None), 100)
+
+    def test_small_changes_ignored(self):
+        controller = self._make_controller()
+        controller.message_processed(1.0 / 24)
+        self.assertIsNone(controller.get_adjusted_prefetch_count(1000))
+        controller = self._make_controller()
+        controller.message_processed(1.0 / 25)
+        self.assertEqual(controller.get_adjusted_prefetch_count(1000), 25)
+
+
+class TestQueuedBase__adaptive_prefetch(unittest.TestCase):
+
+    def setUp(self):
+        self.qb = QueuedBase.__new__(QueuedBase)
+        self.qb.input_queue = {'queue_name': 'inp', 'binding_keys': ['rk']}
+        self.qb._closing = False
+        self.qb._num_queues_bound = 1
+        self.qb._connection = MagicMock()
+        self.qb._connection.add_timeout.return_value = sen.timeout_id
+        self.qb._channel_in = MagicMock()
+        self.qb._prefetch_controller = None
+        self.qb._prefetch_adjustment_timeout_id = None
+        self.qb._worker_pool = None
+        self.qb.adaptive_prefetch = True
+        self.qb.prefetch_count = 20
+        self.qb.prefetch_adjustment_interval = 7.0
+
+    def test_adjustment_cycle(self):
+        self.qb.on_bindok(sen.frame)
+        self.assertEqual(self.qb._connection.mock_calls, [
+            call.add_timeout(7.0, self.qb.check_input_queue_depth),
+        ])
+        self.qb._prefetch_controller.message_processed(0.5)
+        self.qb.check_input_queue_depth()
+        self.qb.on_input_queue_depth_checked(MagicMock(method=MagicMock(message_count=1000)))
+        self.assertEqual(self.qb.prefetch_count, 2)
+        self.assertEqual(self.qb._channel_in.mock_calls[-2:], [
+            call.queue_declare(self.qb.on_input_queue_depth_checked, 'inp', passive=True),
+            call.basic_qos(prefetch_count=2),
+        ])
+        self.assertEqual(len(self.qb._connection.add_timeout.mock_calls), 2)
+
+    def test_single_controller_and_timer_after_channel_reopened(self):
+        self.qb.on_bindok(sen.frame)
+        controller = self.qb._prefetch_controller
+        controller.message_processed(0.5)
+        # (the input channel reopened within the same connection)
+        self.qb._num_queues_bound = 1
+        self.qb.on_bindok(sen.frame)
+        self.assertIs(self.qb._prefetch_controller, controller)
+        self.assertEqual(controller.avg_processing_time, 0.5)
+        self.assertEqual(self.qb._connection.mock_calls, [
+            call.add_timeout(7.0, self.qb.check_input_queue_depth),
+            call.remove_timeout(sen.timeout_id),
+            call.add_timeout(7.0, self.qb.check_input_queue_depth),
+        ])
+        self.qb.check_input_queue_depth()
+        self.assertIsNone(self.qb._prefetch_adjustment_timeout_id)
+
+    def test_no_adjustment_when_closing(self):
+        self.qb.on_bindok(sen.frame)
+        self.qb._closing = True
+        self.qb._channel_in.reset_mock()
+        self.qb.check_input_queue_depth()
+        self.assertEqual(self.qb._channel_in.mock_calls, [])
+
+
+class TestQueuedBase__worker_pool(unittest.TestCase):
+
+    def setUp(self):
+        self.qb = QueuedBase.__new__(QueuedBase)
+        self.qb.max_workers = 3
+        self.qb.output_ready = True
+        self.qb._closing = False
+        self.qb._declared_output_exchanges = {'out'}
+        self.qb.output_queue = [{'exchange': 'out', 'exchange_type': 'topic'}]
+        self.qb._prefetch_controller = None
+        self.qb._worker_pool = _WorkerPool(3)
+        self.qb._worker_results_check_scheduled = False
+        self.qb._connection = MagicMock()
+        self.qb._channel_in = MagicMock()
+        self.qb._channel_out = MagicMock()
+        self.qb.input_callback = self._input_callback
+
+    def _input_callback(self, routing_key, body, properties):
+        if body == 'bad':
+            raise ValueError
+        self.qb.publish_output('rk', body + '1')
+        self.qb.publish_output('rk', body + '2')
+
+    def _deliver(self, delivery_tag, body, channel=None):
+        self.qb.on_message(channel or self.qb._channel_in,
+                           MagicMock(delivery_tag=delivery_tag, routing_key='rk'),
+                           sen.properties,
+                           body)
+
+    def _wait_for_workers(self, num_of_results):
+        deadline = time.time() + 5
+        while self.qb._worker_pool._results.qsize() < num_of_results:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.001)
+
+    def test_outputs_published_and_inputs_acked_in_ioloop_thread(self):
+        self._deliver(1, 'a')
+        self._deliver(2, 'bad')
+        self._deliver(3, 'b')
+        self.assertEqual(self.qb._connection.mock_calls, [
+            call.add_timeout(0.01, self.qb.check_worker_results),
+        ])
+        self._wait_for_workers(3)
+        self.assertEqual(self.qb._channel_in.mock_calls, [])
+        self.assertEqual(self.qb._channel_out.mock_calls, [])
+        self.qb.check_worker_results()
+        self.assertEqual(
+            sorted(c[2]['body'] for c in self.qb._channel_out.basic_publish.mock_calls),
+            ['a1', 'a2', 'b1', 'b2'])
+        self.assertItemsEqual(self.qb._channel_in.mock_calls, [
+            call.basic_ack(1),
+            call.basic_nack(2, multiple=False, requeue=False),
+            call.basic_ack(3),
+        ])
+        self.assertEqual(self.qb._worker_pool.num_of_pending, 0)
+        self.assertEqual(len(self.qb._connection.add_timeout.mock_calls), 1)
+
+    def test_results_from_old_channel_dropped(self):
+        self._deliver(1, 'a', channel=sen.old_channel)
+        self._wait_for_workers(1)
+        self.qb.check_worker_results()
+        self.assertEqual(self.qb._channel_in.mock_calls, [])
+        self.assertEqual(self.qb._channel_out.mock_calls, [])
+
+    def test_check_rescheduled_while_tasks_pending(self):
+        self.qb._worker_pool.num_of_pending = 1
+        self.qb.check_worker_results()
+        self.assertEqual(self.qb._connection.mock_calls, [
+            call.add_timeout(0.01, self.qb.check_worker_results),
+        ])
+
+
+class TestQueuedBase__micro_batch(unittest.TestCase):
+
+    def setUp(self):
+        self.qb = QueuedBase.__new__(QueuedBase)
+        self.qb.batch_max_size = 3
+        self.qb.batch_max_wait = 0.2
+        self.qb._batch = []
+        self.qb._batch_timeout_id = None
+        self.qb._prefetch_controller = None
+        self.qb._connection = MagicMock()
+        self.qb._connection.add_timeout.return_value = sen.timeout_id
+        self.qb._channel_in = MagicMock()
+        self.qb.input_callback = MagicMock()
+
+    def _deliver(self, delivery_tag, body='b'):
+        self.qb.on_message(self.qb._channel_in,
+                           MagicMock(delivery_tag=delivery_tag, routing_key='rk'),
+                           sen.properties,
+                           body)
+
+    def test_batch_flushed_when_full(self):
+        self.qb.batch_input_callback = MagicMock()
+        self._deliver(1)
+        self._deliver(2)
+        self.assertEqual(self.qb._connection.mock_calls, [
+            call.add_timeout(0.2, self.qb.flush_batch),
+        ])
+        self.assertEqual(self.qb.batch_input_callback.mock_calls, [])
+        self._deliver(3)
+        self.assertEqual(self.qb._connection.mock_calls[1:], [
+            call.remove_timeout(sen.timeout_id),
+        ])
+        [(_, (messages,), _)] = self.qb.batch_input_callback.mock_calls
+        self.assertEqual([m.delivery_tag for m in messages], [1, 2, 3])
+        self.assertEqual(self.qb._channel_in.mock_calls, [
+            call.basic_ack(1),
+            call.basic_ack(2),
+            call.basic_ack(3),
+        ])
+        self.assertEqual(self.qb._batch, [])
+        self.assertIsNone(self.qb._batch_timeout_id)
+
+    def test_batch_flushed_by_timer(self):
+        self._deliver(1, 'a')
+        self.qb.flush_batch()
+        self.assertEqual(self.qb.input_callback.mock_calls, [
+            call('rk', 'a', sen.properties),
+        ])
+        self.assertEqual(self.qb._channel_in.mock_calls, [call.basic_ack(1)])
+        self.qb.flush_batch()
+        self.assertEqual(self.qb._channel_in.mock_calls, [call.basic_ack(1)])
+
+    def test_per_message_failures(self):
+        self.qb.input_callback.side_effect = [None, ValueError, None]
+        self._deliver(1)
+        self._deliver(2)
+        self._deliver(3)
+        self.assertEqual(self.qb._channel_in.mock_calls, [
+            call.basic_ack(1),
+            call.basic_nack(2, multiple=False, requeue=False),
+            call.basic_ack(3),
+        ])
+
+    def test_batch_flushed_after_reconnection_dropped(self):
+        self.qb.publisher_confirms = True
+        self.qb._confirms_tracker = _PublisherConfirmsTracker()
+        self._deliver(1)
+        self._deliver(2)
+        channel_in = self.qb._channel_in
+        # (connection lost; then, new channels are being opened)
+        self.qb._channel_in = None
+        self.qb._confirms_tracker.reset()
+        self.qb.flush_batch()
+        self.assertEqual(self.qb.input_callback.mock_calls, [])
+        self.assertEqual(channel_in.mock_calls, [])
+        self.assertEqual(self.qb._batch, [])
+
+    def test_whole_batch_failure(self):
+        self.qb.batch_input_callback = MagicMock(side_effect=ValueError)
+        self._deliver(1)
+        self._deliver(2)
+        self._deliver(3)
+        self.assertEqual(self.qb._channel_in.mock_calls, [
+            call.basic_nack(1, multiple=False, requeue=False),
+            call.basic_nack(2, multiple=False, requeue=False),
+            call.basic_nack(3, multiple=False, requeue=False),
+        ])
+
+
+class TestAsyncQueuedBase(unittest.TestCase):
+
+    def setUp(self):
+        self.qb = AsyncQueuedBase.__new__(AsyncQueuedBase)
+        self.qb.output_ready = True
+        self.qb._closing = False
+        self.qb._declared_output_exchanges = {'out'}
+        self.qb.output_queue = [{'exchange': 'out', 'exchange_type': 'topic'}]
+        self.qb._worker_pool = _WorkerPool(3)
+        self.qb._worker_results_check_scheduled = False
+        self.qb._connection = MagicMock()
+        self.qb._channel_in = MagicMock()
+        self.qb._channel_out = MagicMock()
+        self.qb.input_callback = self._input_callback
+
+    @staticmethod
+    def _lookup(name):
+        if name == 'bad':
+            raise KeyError(name)
+        return name.upper()
+
+    def _input_callback(self, routing_key, body, properties):
+        names = body.split(',')
+        if len(names) == 1:
+            result = yield functools.partial(self._lookup, body)
+            self.qb.publish_output(routing_key, result)
+        else:
+            try:
+                results = yield [functools.partial(self._lookup, name) for name in names]
+            except KeyError:
+                self.qb.publish_output(routing_key, 'error')
+                raise
+            self.qb.publish_output(routing_key, ','.join(results))
+
+    def _deliver(self, delivery_tag, body, channel=None):
+        self.qb.on_message(channel or self.qb._channel_in,
+                           MagicMock(delivery_tag=delivery_tag, routing_key='rk'),
+                           sen.properties,
+                           body)
+
+    def _run_ioloop(self):
+        deadline = time.time() + 5
+        while self.qb._worker_pool.num_of_pending:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.001)
+            self.qb.check_worker_results()
+
+    def _published_bodies(self):
+        return sorted(c[2]['body'] for c in self.qb._channel_out.basic_publish.mock_calls)
+
+    def test_coroutines(self):
+        self._deliver(1, 'a')
+        self._deliver(2, 'b,c,d')
+        self._deliver(3, 'e,bad')
+        self._deliver(4, 'bad')
+        self.assertEqual(self.qb._channel_in.mock_calls, [])
+        self._run_ioloop()
+        self.assertEqual(self._published_bodies(), ['A', 'B,C,D', 'error'])
+        self.assertItemsEqual(self.qb._channel_in.mock_calls, [
+            call.basic_ack(1),
+            call.basic_ack(2),
+            call.basic_nack(3, multiple=False, requeue=False),
+            call.basic_nack(4, multiple=False, requeue=False),
+        ])
+
+    def test_coroutine_abandoned_when_channel_replaced(self):
+        self._deliver(1, 'a', channel=sen.old_channel)
+        self._run_ioloop()
+        self.assertEqual(self.qb._channel_in.mock_calls, [])
+        self.assertEqual(self.qb._channel_out.mock_calls, [])
+
+    def test_adaptive_prefetch_rejected(self):
+        with patch.object(Config, '_load_n6_config_files', return_value={}):
+            self.qb.set_queue_configuration()
+            with patch.object(AsyncQueuedBase, 'adaptive_prefetch', True), \
+                 self.assertRaises(ValueError):
+                self.qb.set_queue_configuration()
+
+    def test_not_a_generator_function_rejected(self):
+        with patch.object(Config, '_load_n6_config_files', return_value={}):
+            self.qb.set_queue_configuration()
+            self.qb.input_callback = lambda routing_key, body, properties: None
+            with self.assertRaises(TypeError):
+                self.qb.set_queue_configuration()
+
+    def test_not_a_generator_nacked(self):
+        self.qb.input_callback = MagicMock()
+        self._deliver(1, 'a')
+        self.assertEqual(self.qb._channel_in.mock_calls, [
+            call.basic_nack(1, multiple=False, requeue=False),
+        ])
+        self.assertEqual(self.qb._channel_out.mock_calls, [])
+
+    def test_not_a_generator_nacked__publisher_confirms(self):
+        self.qb.publisher_confirms = True
+        self.qb._confirms_tracker = _PublisherConfirmsTracker()
+        self.qb.input_callback = MagicMock()
+        self._deliver(1, 'a')
+        self.assertEqual(self.qb._channel_in.mock_calls, [
+            call.basic_nack(1, multiple=False, requeue=False),
+        ])
+        self.assertFalse(self.qb._confirms_tracker.is_pending(1))
+
+
+class TestQueuedBase__set_queue_configuration(unittest.TestCase):
+
+    def _set_queue_configuration(self, conf_from_files):
+        qb = QueuedBase.__new__(QueuedBase)
+        with patch.object(Config, '_load_n6_config_files', return_value=conf_from_files):
+            qb.set_queue_configuration()
+        return qb
+
+    def test_no_section(self):
+        qb = self._set_queue_configuration({'other': {'prefetch_count': '1'}})
+        self.assertNotIn('prefetch_count', vars(qb))
+        self.assertEqual(qb.prefetch_count, 20)
+        self.assertFalse(qb.adaptive_prefetch)
+
+    def test_section(self):
+        qb = self._set_queue_configuration({
+            'QueuedBase_queue': {
+                'prefetch_count': '42',
+                'adaptive_prefetch': 'yes',
+                'max_prefetch_count': '300',
+            },
+        })
+        self.assertEqual(qb.prefetch_count, 42)
+        self.assertTrue(qb.adaptive_prefetch)
+        self.assertEqual(qb.min_prefetch_count, 1)
+        self.assertEqual(qb.max_prefetch_count, 300)
+        self.assertEqual(qb.prefetch_target_buffer_time, 1.0)
+        self.assertEqual(qb.prefetch_adjustment_interval, 10.0)
+        self.assertEqual(qb.max_workers, 0)
+
+    def test_worker_pool_requires_thread_safety(self):
+        conf = {'QueuedBase_queue': {'max_workers': '4'}}
+        with self.assertRaises(ValueError):
+            self._set_queue_configuration(conf)
+        with patch.object(QueuedBase, 'input_callback_thread_safe', True):
+            qb = self._set_queue_configuration(conf)
+        self.assertEqual(qb.max_workers, 4)
+
+    def test_worker_pool_and_micro_batch_cannot_be_combined(self):
+        conf = {'QueuedBase_queue': {'max_workers': '4', 'batch_max_size': '10'}}
+        with patch.object(QueuedBase, 'input_callback_thread_safe', True), \
+             self.assertRaises(ValueError):
+            self._set_queue_configuration(conf)
+
+    def test_transactional_publishing_cannot_be_combined_with_other_modes(self):
+        with patch.object(QueuedBase, 'transactional_publishing', True):
+            qb = self._set_queue_configuration({})
+            self.assertTrue(qb.transactional_publishing)
+            with patch.object(QueuedBase, 'publisher_confirms', True), \
+                 self.assertRaises(ValueError):
+                self._set_queue_configuration({})
+            with self.assertRaises(ValueError):
+                self._set_queue_configuration({'QueuedBase_queue': {'batch_max_size': '10'}})
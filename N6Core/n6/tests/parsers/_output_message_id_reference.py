@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2018 NASK. All rights reserved.
+
+"""
+The reference implementation of event id computation.
+
+This is (a function-based version of) the original, slow implementation
+of BaseParser.get_output_message_id().  It is kept -- *only* for tests
+-- to ensure that the current implementation of that method produces
+exactly the same ids (as ids of already stored data must not change).
+"""
+
+import hashlib
+
+
+def reference_output_message_id(parsed):
+    serialized = []
+    id_base_items = ((k, v) for k, v in parsed.iteritems()
+                     if not k.startswith('_'))  # no internal flag keys
+    for k, v in sorted(id_base_items):
+        if isinstance(v, (list, tuple)):
+            v = ('{}'.format(_prepare_for_deterministic_serialization(el))
+                 for el in v)
+            v = ','.join(sorted(v))
+        v = _prepare_for_deterministic_serialization(v)
+        serialized.append("{},{}".format(k, v))
+    return hashlib.md5("\n".join(serialized)).hexdigest()
+
+
+def _prepare_for_deterministic_serialization(value):
+    VALUE_TYPES = str, int, long
+    if isinstance(value, dict):
+        item_reprs = {}
+        for k, v in value.iteritems():
+            if isinstance(k, unicode):
+                k = k.encode('utf-8')
+            if isinstance(v, unicode):
+                v = v.encode('utf-8')
+            if not isinstance(k, str):
+                raise TypeError('dict {!r} contains a non-string key ({!r})'
+                                .format(value, k))
+            if not isinstance(v, VALUE_TYPES):
+                raise TypeError('dict {!r} contains a value ({!r}) '
+                                'whose type ({!r}) is illegal'
+                                .format(value, v, type(v)))
+            item_reprs[repr(k)] = (repr(v) if not isinstance(v, long)
+                                   else str(v))
+        value = '{%s}' % ', '.join('{}: {}'.format(k, v)
+                                   for k, v in sorted(item_reprs.iteritems()))
+        assert isinstance(value, str)
+    elif isinstance(value, unicode):
+        value = value.encode('utf-8')
+    if not isinstance(value, VALUE_TYPES):
+        raise TypeError('encountered a value ({!r}) '
+                        'whose type ({!r}) is illegal)'
+                        .format(value, type(value)))
+    return value
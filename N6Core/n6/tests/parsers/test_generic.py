@@ -3,7 +3,10 @@
 # Copyright (c) 2013-2018 NASK. All rights reserved.
 
 import hashlib
+import itertools
 import json
+import random
+import re
 import unittest
 
 from mock import ANY, Mock, MagicMock, call, patch, sentinel
@@ -28,13 +31,16 @@ from n6lib.unit_test_helpers import (
     patch_always,
 )
 from n6.base.queue import QueuedBase
+from n6.tests.parsers._output_message_id_reference import reference_output_message_id
 from n6.parsers.generic import (
     MAX_IPS_IN_ADDRESS,
     BaseParser,
     AggregatedEventParser,
     BlackListParser,
-    #TabDataParser,
-    #BlackListTabDataParser,
+    TabDataParser,
+    BlackListTabDataParser,
+    XmlDataParser,
+    _init_parse_worker,
 )
 
 
@@ -42,8 +48,12 @@ from n6.parsers.generic import (
 class TestBaseParser(unittest.TestCase):
 
     def setUp(self):
-        self.mock = Mock(__class__=BaseParser, allow_empty_results=False)
-        self.meth = MethodProxy(BaseParser, self.mock)
+        self.mock = Mock(__class__=BaseParser,
+                         allow_empty_results=False,
+                         stream_publishing=False,
+                         parallel_parse_processes=0)
+        self.meth = MethodProxy(BaseParser, self.mock,
+                                class_attrs='_iter_parsed _verify_output_not_empty')
 
     def _asserts_of_proper__new__instance_adjustment(self, instance):
         # BaseQueued.__new__() ensures that
@@ -204,6 +214,25 @@ class TestBaseParser(unittest.TestCase):
                 expected_config,
                 expected_config_full)
 
+    def test_initialization_with_stream_publishing(self):
+        class SomeParser(BaseParser):
+            default_binding_key = 'foo.bar'
+            stream_publishing = True
+
+        class SomeBlParser(BlackListParser):
+            default_binding_key = 'foo.bar'
+            stream_publishing = True
+
+        super_cls_mock = SimpleNamespace(__init__=Mock())
+        with patch_always('n6.parsers.generic.super',
+                          return_value=super_cls_mock), \
+             patch('n6.parsers.generic.Config._load_n6_config_files',
+                   return_value={}):
+            instance = SomeParser()
+            self.assertTrue(instance.transactional_publishing)
+            with self.assertRaises(ValueError):
+                SomeBlParser()
+
     def test__make_binding_keys(self):
         self.mock.default_binding_key = 'fooo.barr'
         binding_keys = self.meth.make_binding_keys()
@@ -272,6 +301,39 @@ class TestBaseParser(unittest.TestCase):
             call().__exit__(None, None, None),
         ])
 
+    def test__input_callback__stream_publishing(self):
+        data = MagicMock(**{'get.return_value': sentinel.rid})
+        self.mock.configure_mock(**{
+            'stream_publishing': True,
+            '_fix_body.return_value': sentinel.body,
+            'prepare_data.return_value': data,
+            'setting_error_event_info': MagicMock(),
+            'get_output_rk.return_value': sentinel.output_rk,
+            'iter_output_bodies.return_value': iter([sentinel.output_body1,
+                                                     sentinel.output_body2]),
+        })
+        with patch('n6.parsers.generic.FilePagedSequence') as FilePagedSequence_mock:
+            self.meth.input_callback(sentinel.routing_key,
+                                     sentinel.body,
+                                     sentinel.properties)
+        self.assertEqual(self.mock.mock_calls, [
+            call._fix_body(sentinel.body),
+            call.prepare_data(sentinel.routing_key,
+                              sentinel.body,
+                              sentinel.properties),
+            call.prepare_data().get('properties.message_id'),
+            call.setting_error_event_info(sentinel.rid),
+            call.setting_error_event_info().__enter__(),
+            call.get_output_rk(data),
+            call.iter_output_bodies(data),
+            call.publish_output(routing_key=sentinel.output_rk,
+                                body=sentinel.output_body1),
+            call.publish_output(routing_key=sentinel.output_rk,
+                                body=sentinel.output_body2),
+            call.setting_error_event_info().__exit__(None, None, None),
+        ])
+        self.assertEqual(FilePagedSequence_mock.mock_calls, [])
+
     def test__prepare_data(self):
         data = self.meth.prepare_data(
             routing_key='ham.spam',
@@ -405,6 +467,70 @@ class TestBaseParser(unittest.TestCase):
             call.parse(sentinel.data),
         ])
 
+    def test__iter_output_bodies(self):
+        parsed = [MagicMock(**{'__class__': RecordDict,
+                               'used_as_context_manager': True,
+                               'get_ready_json.return_value':
+                                   getattr(sentinel,
+                                           'output_body{}'.format(i))})
+                  for i in (1, 2)]
+        self.mock.configure_mock(**{
+            'parse.return_value': iter(parsed),
+            'get_output_message_id.side_effect': [
+                sentinel.msg_A,
+                sentinel.msg_B,
+            ],
+            'setting_error_event_info': MagicMock(),
+            'postprocess_parsed.side_effect': (
+                lambda data, parsed, total, item_no: parsed
+            ),
+        })
+        output_bodies = self.meth.iter_output_bodies(sentinel.data)
+        self.assertEqual(self.mock.mock_calls, [])  # (it's a generator)
+        self.assertIs(next(output_bodies), sentinel.output_body1)
+        # the second event has not been parsed yet
+        self.assertEqual(self.mock.mock_calls, [
+            call.parse(sentinel.data),
+            call.get_output_message_id(parsed[0]),
+            call.delete_too_long_address(parsed[0]),
+            call.setting_error_event_info(parsed[0]),
+            call.setting_error_event_info().__enter__(),
+            call.postprocess_parsed(sentinel.data,
+                                    parsed[0],
+                                    None,
+                                    item_no=1),
+            call.setting_error_event_info().__exit__(None, None, None),
+        ])
+        self.assertEqual(list(output_bodies), [sentinel.output_body2])
+        self.assertEqual(parsed[1].mock_calls, [
+            call.__setitem__('id', sentinel.msg_B),
+            call.get_ready_json(),
+        ])
+        self.assertEqual(self.mock.mock_calls[7:], [
+            call.get_output_message_id(parsed[1]),
+            call.delete_too_long_address(parsed[1]),
+            call.setting_error_event_info(parsed[1]),
+            call.setting_error_event_info().__enter__(),
+            call.postprocess_parsed(sentinel.data,
+                                    parsed[1],
+                                    None,
+                                    item_no=2),
+            call.setting_error_event_info().__exit__(None, None, None),
+        ])
+
+    def test__iter_output_bodies__parse_yielded_no_items(self):
+        self.mock.configure_mock(**{'parse.return_value': iter([])})
+        with self.assertRaises(ValueError):
+            list(self.meth.iter_output_bodies(sentinel.data))
+        self.assertEqual(self.mock.method_calls, [
+            call.parse(sentinel.data),
+        ])
+
+    def test__iter_output_bodies__parse_yielded_no_items__allow_empty_results(self):
+        self.mock.configure_mock(**{'parse.return_value': iter([]),
+                                    'allow_empty_results': True})
+        self.assertEqual(list(self.meth.iter_output_bodies(sentinel.data)), [])
+
     def test__delete_too_long_address__address_is_ok(self):
         parsed = RecordDict()
         parsed['address'] = [{'ip': i+1} for i in xrange(MAX_IPS_IN_ADDRESS)]
@@ -566,6 +692,43 @@ class TestBaseParser(unittest.TestCase):
             with self.assertRaises(exc_class):
                 parser.get_output_message_id(record_dict)
 
+    def test__get_output_message_id__same_as_reference_implementation(self):
+        class _str(str): pass
+        class _int(int): pass
+        scalars = [
+            'foo.bar', 'zażółć', '', u'foo', u'gęślą', u'',
+            0, 1, -42, 2L, 9000111222333444555666777888999000L,
+            True, False, _str('foo'), _int(7),
+        ]
+        subdicts = [
+            {}, {'ip': '127.0.0.1'}, {u'ką': u'vą'}, {'k': 2L, u'a': 3, 'b': 'x'},
+            {'ą': 1, u'ą': 2}, {'k': True}, {_str('k'): 'v'}, {'k': _int(1)},
+        ]
+        values = (
+            scalars + subdicts +
+            [list(scalars[:6]), tuple(scalars[6:]), list(subdicts), [], (),
+             ['value3', u'value1', 'value2', 20L, 10], [scalars[0], subdicts[1]]])
+        invalid_values = [2.3, None, [2.3], [[2]], {'k': 2.3}, {32: 2}, {'k': {'k': 2}}]
+        class _RecordDict(RecordDict):
+            adjust_key1 = adjust_key2 = adjust_key3 = None
+            optional_keys = RecordDict.optional_keys | {'key1', 'key2', 'key3'}
+        parser = BaseParser.__new__(BaseParser)
+        random_gen = random.Random(42)
+        for i in xrange(2000):
+            input_dict = {
+                key: random_gen.choice(values)
+                for key in random_gen.sample(['key1', u'key2', 'key3'],
+                                             random_gen.randint(1, 3))}
+            record_dict = _RecordDict(input_dict)
+            self.assertEqual(parser.get_output_message_id(record_dict),
+                             reference_output_message_id(record_dict))
+        for value in invalid_values:
+            record_dict = _RecordDict({'key1': value, 'key2': 'foo'})
+            with self.assertRaises(TypeError):
+                reference_output_message_id(record_dict)
+            with self.assertRaises(TypeError):
+                parser.get_output_message_id(record_dict)
+
     def test__postprocess_parsed__without__do_not_resolve_fqdn_to_ip(self):
         data = {}
         parsed = RecordDict()
@@ -824,6 +987,63 @@ class Test__get_output_bodies__results_for_concrete_parsers(unittest.TestCase):
                 'expires': '2014-02-28 10:00:00',
             })
 
+    def test_BlackListParser_subclass__bl_current_time_searched_once_per_message(self):
+        class MyParser(self.MyParserMixIn, BlackListParser):
+            constant_items = dict(self.MyParserMixIn.constant_items,
+                                  expires='2014-02-28 10:00:00')
+            bl_current_time_regex = re.compile(
+                r'^# updated: (?P<datetime>\S+ \S+)$', re.MULTILINE)
+            def parse(self, data):
+                # (skipping the "# updated: ..." line)
+                data = dict(data, raw=data['raw'].split('\n', 1)[1])
+                return super(MyParser, self).parse(data)
+        parser = MyParser.__new__(MyParser)
+        ports = [str(i) for i in xrange(1, 1001)]
+        for raw_head in ('# updated: 2014-01-11 10:00:00\n',
+                         '# updated: 2014-01-12 10:00:00\n'):
+            data = dict(self.base_data, raw=(raw_head + ' '.join(ports)))
+            with patch.object(MyParser, 'bl_current_time_regex',
+                              wraps=MyParser.bl_current_time_regex) as regex_mock:
+                seq_mock = FilePagedSequence._instance_mock()
+                parser.get_output_bodies(data, seq_mock)
+            self.assertEqual(regex_mock.search.call_count, 1)
+            # (no references to the message's data are kept)
+            self.assertIsNone(parser._current_bl_series_items)
+            output_data = [json.loads(body) for body in seq_mock._list]
+            self.assertEqual(len(output_data), 1000)
+            self.assertEqual({d['_bl-current-time'] for d in output_data},
+                             {raw_head[len('# updated: '):-1]})
+            self.assertEqual([d['_bl-series-no'] for d in output_data],
+                             range(1, 1001))
+            self.assertTrue(all(d['_bl-series-total'] == 1000 for d in output_data))
+
+    def test_BlackListParser_subclass__100k_rows__raw_body_searched_once(self):
+        # the time is at the end of the raw data body, so each search of
+        # it would scan all 100k rows -- once per event without the
+        # per-message computation of the `_bl-series-*`-like items
+        class MyParser(self.MyParserMixIn, BlackListParser):
+            constant_items = dict(self.MyParserMixIn.constant_items,
+                                  expires='2014-02-28 10:00:00')
+            bl_current_time_regex = re.compile(
+                r'^# updated: (?P<datetime>\S+ \S+)$', re.MULTILINE)
+            def parse(self, data):
+                # (one event per 100 rows, so that the test is fast)
+                rows = data['raw'].split('\n')[:-1]
+                data = dict(data, raw=' '.join(rows[99::100]))
+                return super(MyParser, self).parse(data)
+        parser = MyParser.__new__(MyParser)
+        raw = ''.join('{0}\n'.format(i % 65535 + 1) for i in xrange(100000))
+        raw += '# updated: 2014-01-11 10:00:00'
+        data = dict(self.base_data, raw=raw)
+        with patch.object(MyParser, 'bl_current_time_regex',
+                          wraps=MyParser.bl_current_time_regex) as regex_mock:
+            seq_mock = FilePagedSequence._instance_mock()
+            parser.get_output_bodies(data, seq_mock)
+        self.assertEqual(regex_mock.search.call_count, 1)
+        self.assertEqual(len(seq_mock._list), 1000)
+        self.assertEqual({json.loads(body)['_bl-current-time'] for body in seq_mock._list},
+                         {'2014-01-11 10:00:00'})
+
     def test_BlackListParser_subclass__not_silenced_error(self, *args):
         # data error in an event (AdjusterError exception within
         # `with self.new_record_dict(data) as parsed: ...` block)
@@ -892,6 +1112,153 @@ class Test__get_output_bodies__results_for_concrete_parsers(unittest.TestCase):
                 parser.get_output_bodies(data, FilePagedSequence._instance_mock())
 
 
+class TestTabDataParser(unittest.TestCase):
+
+    raw_bodies = [
+        '',
+        '\n',
+        'a,b,c',
+        'a,b,c\n',
+        '# comment\n a , b,c \n\n  \nx,  y,z\t\r\n;ignored,row\n\n',
+        'first,row\r\n  ,\n#\n\t\r\nlast , row\r',
+        'no separator\n\n\n',
+    ]
+
+    def test__iter_rows_fields_gives_same_results_as_iter_rows_and_get_row_fields(self):
+        for option_values in itertools.product(
+                [',', None],                    # field_sep
+                [None, ('a', ' a', 'x'), 'f'],  # required_row_prefixes
+                [None, ('#', ';')],             # ignored_row_prefixes
+                [False, True],                  # disable_row_rstrip
+                [False, True],                  # disable_field_strip
+                [False, True],                  # skip_first_row
+                [False, True]):                 # skip_blank_rows
+            class MyParser(TabDataParser):
+                pass
+            (MyParser.field_sep,
+             MyParser.required_row_prefixes,
+             MyParser.ignored_row_prefixes,
+             MyParser.disable_row_rstrip,
+             MyParser.disable_field_strip,
+             MyParser.skip_first_row,
+             MyParser.skip_blank_rows) = option_values
+            parser = MyParser.__new__(MyParser)
+            for raw in self.raw_bodies:
+                data = {'raw': raw}
+                try:
+                    expected = [parser.get_row_fields(row)
+                                for row in parser.iter_rows(data)]
+                except StopIteration:
+                    # (`skip_first_row` + empty data => no rows in parse())
+                    expected = []
+                self.assertEqual(list(parser.iter_rows_fields(data)), expected,
+                                 msg=repr((option_values, raw)))
+
+    def test__split_raw_data(self):
+        class MyParser(TabDataParser):
+            field_sep = ','
+            parallel_parse_chunk_size = 10
+        parser = MyParser.__new__(MyParser)
+        raw = 'a,b\nccccccccccccccc\n\nd,e,f,g,h,i\nj'
+        self.assertEqual(parser.split_raw_data({'raw': raw}), [
+            'a,b\nccccccccccccccc\n',
+            '\nd,e,f,g,h,i\n',
+            'j',
+        ])
+        MyParser.skip_first_row = True
+        self.assertEqual(parser.split_raw_data({'raw': raw}), [
+            'a,b\nccccccccccccccc\n',
+            '\n\nd,e,f,g,h,i\n',
+            '\nj',
+        ])
+
+    def test__get_output_bodies__parallel_parsing(self):
+        class MyParser(BlackListTabDataParser):
+            field_sep = ','
+            skip_first_row = True
+            ignored_row_prefixes = '#'
+            constant_items = {
+                'restriction': 'public',
+                'confidence': 'low',
+                'category': 'malurl',
+            }
+            def process_row_fields(self, data, parsed, dport, expires):
+                parsed['dport'] = dport
+                parsed['time'] = '2014-01-10 10:14:00'
+                parsed['expires'] = expires
+        data = {
+            'properties.message_id': '0123456789abcdef0123456789abcdef',
+            'source': 'foo.bar',
+            'properties.timestamp': '2014-01-10 10:14:00',
+            'raw': 'dport,expires\n' + '\n'.join(
+                '{0},2014-02-{1:02} 10:00:00{2}'.format(i, i % 28 + 1,
+                                                       '\n#' if i % 10 else '')
+                for i in xrange(1, 301)),
+        }
+        parser = MyParser.__new__(MyParser)
+        expected = list(parser.get_output_bodies(data, []))
+        MyParser.parallel_parse_processes = 3
+        MyParser.parallel_parse_chunk_size = 100
+        self.assertGreater(len(parser.split_raw_data(data)), 30)
+        # (no pool started => parsing in this process)
+        self.assertEqual(list(parser.get_output_bodies(data, [])), expected)
+        parser.start_parse_pool()
+        try:
+            with patch.object(MyParser, 'parse', side_effect=AssertionError):
+                result = list(parser.get_output_bodies(data, []))
+        finally:
+            worker_processes = list(parser._parse_pool._pool)
+            parser.shut_down_parse_pool()
+        self.assertIsNone(parser._parse_pool)
+        self.assertEqual(len(worker_processes), 3)
+        self.assertFalse(any(proc.is_alive() for proc in worker_processes))
+        self.assertEqual(len(expected), 300)
+        self.assertEqual(result, expected)
+
+    @patch('n6.parsers.generic.multiprocessing.Pool')
+    @patch('n6.base.queue.QueuedBase.stop')
+    @patch('n6.base.queue.QueuedBase.run')
+    def test__parse_pool_started_before_connecting_and_shut_down_on_stop(
+            self, QueuedBase_run_mock, QueuedBase_stop_mock, Pool_mock):
+        class MyParser(TabDataParser):
+            parallel_parse_processes = 3
+        parser = MyParser.__new__(MyParser)
+        QueuedBase_run_mock.side_effect = (
+            lambda: self.assertIs(parser._parse_pool, Pool_mock.return_value))
+        parser.run()
+        self.assertEqual(Pool_mock.mock_calls, [
+            call(3, initializer=_init_parse_worker, initargs=(parser,)),
+        ])
+        QueuedBase_run_mock.assert_called_once_with()
+        parser.stop()
+        QueuedBase_stop_mock.assert_called_once_with()
+        self.assertEqual(Pool_mock.mock_calls[1:], [
+            call().terminate(),
+            call().join(),
+        ])
+        self.assertIsNone(parser._parse_pool)
+
+    @patch('n6.parsers.generic.multiprocessing.Pool')
+    @patch('n6.base.queue.QueuedBase.run')
+    def test__parse_pool_not_started_if_not_parallel(self, QueuedBase_run_mock, Pool_mock):
+        parser = TabDataParser.__new__(TabDataParser)
+        parser.run()
+        QueuedBase_run_mock.assert_called_once_with()
+        self.assertFalse(Pool_mock.called)
+        self.assertIsNone(parser._parse_pool)
+
+
+class TestXmlDataParser(unittest.TestCase):
+
+    def test__parallel_parsing_mode_rejected(self):
+        class MyParser(XmlDataParser):
+            default_binding_key = 'foo.bar'
+            parallel_parse_processes = 3
+        parser = MyParser.__new__(MyParser)
+        with self.assertRaises(ValueError):
+            parser.__init__()
+
+
 ## TODO:
 # * more BaseParser tests
 # * TabDataParser and BlackListTabDataParser tests
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2018 NASK. All rights reserved.
+
+"""
+A local stub DNS server -- to test DNS resolution offline.
+"""
+
+import socket
+import threading
+import time
+
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+
+
+class DnsStubServer(object):
+
+    """
+    A minimal UDP DNS server answering `A`/`AAAA` queries on 127.0.0.1.
+
+    Constructor args:
+        `records` (dict):
+            Maps FQDNs to lists of IPv4 and/or IPv6 addresses (strings);
+            for any FQDN not included in it the server responds with
+            NXDOMAIN (a query for the record type an FQDN has no
+            addresses of gets an empty answer).
+
+    Constructor kwargs:
+        `latency` (float; default: 0):
+            The delay (in seconds) of each response (note that requests
+            are handled concurrently).
+        `ttl` (int; default: 300):
+            The TTL of records included in responses.
+        `unresponsive_fqdns` (iterable of strings; default: empty):
+            FQDNs whose queries are never responded to (to test timeouts).
+
+    The `queried_fqdns` attribute is a list of FQDNs received so far.
+
+    The instance is a context manager -- the server runs (in a daemon
+    thread) within the `with` block; its port number is available as
+    the `port` attribute.
+    """
+
+    def __init__(self, records, latency=0, ttl=300, unresponsive_fqdns=()):
+        self.records = records
+        self.latency = latency
+        self.ttl = ttl
+        self.unresponsive_fqdns = frozenset(unresponsive_fqdns)
+        self.queried_fqdns = []
+        self.host = '127.0.0.1'
+        self.port = None
+        self._sock = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind((self.host, 0))
+        self.port = self._sock.getsockname()[1]
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._sock.close()
+
+    def _serve(self):
+        while True:
+            try:
+                wire, client_address = self._sock.recvfrom(512)
+            except socket.error:
+                # the socket has been closed
+                break
+            thread = threading.Thread(target=self._respond, args=(wire, client_address))
+            thread.daemon = True
+            thread.start()
+
+    def _respond(self, wire, client_address):
+        query = dns.message.from_wire(wire)
+        fqdn = query.question[0].name.to_text(omit_final_dot=True)
+        with self._lock:
+            self.queried_fqdns.append(fqdn)
+        if fqdn in self.unresponsive_fqdns:
+            return
+        if self.latency:
+            time.sleep(self.latency)
+        response = dns.message.make_response(query)
+        response.flags |= dns.flags.RA
+        ips = self.records.get(fqdn)
+        rdtype = query.question[0].rdtype
+        if ips is None:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+        else:
+            ips = [ip for ip in ips if (':' in ip) == (rdtype == dns.rdatatype.AAAA)]
+            if ips:
+                response.answer.append(dns.rrset.from_text_list(
+                    query.question[0].name, self.ttl,
+                    dns.rdataclass.IN, rdtype, ips))
+        try:
+            self._sock.sendto(response.to_wire(), client_address)
+        except socket.error:
+            pass
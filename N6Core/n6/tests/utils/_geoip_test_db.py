@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2018 NASK. All rights reserved.
+
+"""
+Tiny synthetic GeoIP (legacy format) IPv4/IPv6 databases -- to test
+GeoIP related stuff offline.
+"""
+
+import socket
+import struct
+
+import pygeoip.const
+
+
+def write_country_db(path, networks, ipv6=False):
+    """
+    Write a GeoIP country database.
+
+    Args:
+        `path`: the database file path.
+        `networks`: a list of non-overlapping (<CIDR>, <CC>) pairs.
+
+    Kwargs:
+        `ipv6` (default: False): whether it is an IPv6 database.
+    """
+    segments = pygeoip.const.COUNTRY_BEGIN
+    country_ids = {cc: i for i, cc in enumerate(pygeoip.const.COUNTRY_CODES)}
+    leaves = [(net, segments + country_ids[cc]) for net, cc in networks]
+    nodes = _make_nodes(leaves, segments, ipv6)
+    assert len(nodes) < segments
+    with open(path, 'wb') as f:
+        f.write(_serialize_nodes(nodes))
+        if ipv6:
+            f.write('\xff\xff\xff')
+            f.write(chr(pygeoip.const.COUNTRY_EDITION_V6))
+
+
+def write_asn_db(path, networks, ipv6=False):
+    """
+    Write a GeoIP ASN database.
+
+    Args:
+        `path`: the database file path.
+        `networks`: a list of non-overlapping (<CIDR>, <organization
+            string, e.g., 'AS12345 Some Org'>) pairs.
+
+    Kwargs:
+        `ipv6` (default: False): whether it is an IPv6 database.
+    """
+    # first, count the nodes (their number determines leaf values)
+    segments = len(_make_nodes([(net, 0) for net, _ in networks], 0, ipv6))
+    org_data = ['\0']  # (so that no organization is at offset 0)
+    org_data_len = 1
+    leaves = []
+    for net, org in networks:
+        leaves.append((net, segments + org_data_len))
+        org_data.append(org + '\0')
+        org_data_len += len(org) + 1
+    nodes = _make_nodes(leaves, segments, ipv6)
+    assert len(nodes) == segments
+    with open(path, 'wb') as f:
+        f.write(_serialize_nodes(nodes))
+        f.write(''.join(org_data))
+        f.write('\xff\xff\xff')
+        f.write(chr(pygeoip.const.ASNUM_EDITION_V6 if ipv6
+                    else pygeoip.const.ASNUM_EDITION))
+        f.write(_serialize_record(segments))
+
+
+def _make_nodes(leaves, no_data_leaf, ipv6):
+    address_bits = 128 if ipv6 else 32
+    ranges = []
+    for net, leaf in leaves:
+        ip, prefix_len = net.split('/')
+        start = ip_to_int(ip)
+        end = start + 2 ** (address_bits - int(prefix_len))
+        ranges.append((start, end, leaf))
+    nodes = []
+
+    def make_node(prefix, depth):
+        node_number = len(nodes)
+        node = [None, None]
+        nodes.append(node)
+        for branch in (0, 1):
+            start = prefix | (branch << (address_bits - 1 - depth))
+            end = start + 2 ** (address_bits - 1 - depth)
+            covering = [leaf for (r_start, r_end, leaf) in ranges
+                        if r_start <= start and end <= r_end]
+            overlapping = [leaf for (r_start, r_end, leaf) in ranges
+                           if r_start < end and start < r_end]
+            if covering:
+                node[branch] = covering[0]
+            elif not overlapping:
+                node[branch] = no_data_leaf
+            else:
+                node[branch] = make_node(start, depth + 1)
+        return node_number
+
+    make_node(0, 0)
+    return nodes
+
+
+def ip_to_int(ip):
+    if ':' in ip:
+        high, low = struct.unpack('!QQ', socket.inet_pton(socket.AF_INET6, ip))
+        return (high << 64) | low
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def int_to_ip(ip_int, ipv6=False):
+    if ipv6:
+        packed = struct.pack('!QQ', ip_int >> 64, ip_int & (2 ** 64 - 1))
+        return socket.inet_ntop(socket.AF_INET6, packed)
+    return socket.inet_ntoa(struct.pack('!I', ip_int))
+
+
+def _serialize_nodes(nodes):
+    return ''.join(_serialize_record(record)
+                   for node in nodes
+                   for record in node)
+
+
+def _serialize_record(value):
+    return ''.join(chr((value >> (j * 8)) & 0xff)
+                   for j in xrange(pygeoip.const.STANDARD_RECORD_LENGTH))
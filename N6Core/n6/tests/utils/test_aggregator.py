@@ -2,12 +2,24 @@
 
 # Copyright (c) 2013-2018 NASK. All rights reserved.
 
+import cPickle
 import datetime
 import json
+import os
+import random
+import shutil
+import tempfile
 import unittest
-from collections import namedtuple
+from collections import (
+    OrderedDict,
+    namedtuple,
+)
 
-from mock import patch
+from mock import (
+    MagicMock,
+    call,
+    patch,
+)
 from unittest_expander import (
     expand,
     foreach,
@@ -23,7 +35,9 @@ from n6.utils.aggregator import (
     HiFreqEventData,
     SourceData,
     DEFAULT_TIME_TOLERANCE,
+    SHARDS_EXCHANGE_TYPE,
 )
+from n6lib.datetime_helpers import parse_iso_datetime_to_utc
 
 
 
@@ -799,6 +813,69 @@ class TestAggregator(unittest.TestCase):
 
 
 
+class TestAggregator__sharding(unittest.TestCase):
+
+    def setUp(self):
+        self.aggregator = Aggregator.__new__(Aggregator)
+
+    def test_not_sharded(self):
+        original_input_queue = dict(self.aggregator.input_queue)
+        self.aggregator.configure_sharding(1, None)
+        self.assertIsNone(self.aggregator.shard_index)
+        self.assertEqual(self.aggregator.input_queue, original_input_queue)
+        self.assertEqual(self.aggregator.get_shard_dbpath('/x/aggr.pickle'), '/x/aggr.pickle')
+
+    def test_sharded(self):
+        self.aggregator.configure_sharding(3, 1)
+        self.assertEqual(self.aggregator.shard_count, 3)
+        self.assertEqual(self.aggregator.shard_index, 1)
+        self.assertEqual(self.aggregator.input_queue, {
+            "exchange": 'aggregator_shards',
+            "exchange_type": SHARDS_EXCHANGE_TYPE,
+            "queue_name": 'aggregator_shard1',
+            "binding_keys": ['1'],
+        })
+        self.assertEqual(self.aggregator.get_shard_dbpath('/x/aggr.pickle'),
+                         '/x/aggr.pickle.shard1')
+
+    def test_wrong_shard_settings(self):
+        for shard_count, shard_index in [(0, None), (1, 1), (3, None), (3, 3), (3, -1)]:
+            with self.assertRaises(ValueError):
+                Aggregator.__new__(Aggregator).configure_sharding(shard_count, shard_index)
+
+    def test_sharded_amqp_setup(self):
+        self.aggregator.configure_sharding(3, 1)
+        self.aggregator._channel_in = channel = MagicMock()
+        self.aggregator.setup_input_exchange()
+        self.aggregator.on_upstream_exchange_declared(MagicMock())
+        frame = MagicMock()
+        with patch('n6.base.queue.QueuedBase.on_input_exchange_declared') as super_method:
+            self.aggregator.on_input_exchange_declared(frame)
+        super_method.assert_called_once_with(frame)
+        self.assertEqual(channel.exchange_declare.mock_calls, [
+            call(self.aggregator.on_upstream_exchange_declared,
+                 'event', 'topic', durable=True),
+            call(self.aggregator.on_input_exchange_declared,
+                 'aggregator_shards', SHARDS_EXCHANGE_TYPE, durable=True),
+        ])
+        channel.exchange_bind.assert_called_once_with(
+            self.aggregator.on_shard_binding_ok,
+            destination='aggregator_shards',
+            source='event',
+            routing_key='hifreq.parsed.*.*')
+        self.assertEqual([c[1][1] for c in channel.queue_declare.mock_calls],
+                         ['aggregator_shard0', 'aggregator_shard2'])
+        for queue_name in ['aggregator_shard0', 'aggregator_shard2']:
+            self.aggregator.on_other_shard_queue_declared(queue_name, MagicMock())
+        self.assertEqual(channel.queue_bind.mock_calls, [
+            call(self.aggregator.on_shard_binding_ok,
+                 'aggregator_shard0', 'aggregator_shards', '1'),
+            call(self.aggregator.on_shard_binding_ok,
+                 'aggregator_shard2', 'aggregator_shards', '1'),
+        ])
+
+
+
 @expand
 class TestAggregatorDataWrapper(unittest.TestCase):
 
@@ -1447,6 +1524,132 @@ class TestAggregatorDataWrapper(unittest.TestCase):
 
 
 
+class TestAggregatorDataWrapper__persistence(unittest.TestCase):
+
+    sample_time_tolerance = 600
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.dbpath = os.path.join(self.tmp_dir, 'aggregator_db.pickle')
+
+    def _make_wrapper(self, **kwargs):
+        return AggregatorDataWrapper(self.dbpath, self.sample_time_tolerance, **kwargs)
+
+    @staticmethod
+    def _iter_messages(num_of_messages, seed=42):
+        rand = random.Random(seed)
+        sources = ['testsource.testchannel', 'othersource.otherchannel']
+        time = datetime.datetime(2017, 6, 1, 10)
+        for i in xrange(num_of_messages):
+            # (sometimes moving back -- within or beyond time tolerance,
+            # sometimes jumping forward by many hours)
+            time += datetime.timedelta(seconds=rand.choice([
+                -700, -300, 0, 60, 600, 3600, 13 * 3600]))
+            yield {
+                "id": '%032x' % i,
+                "source": rand.choice(sources),
+                "_group": 'group{}'.format(rand.randint(1, 8)),
+                "time": str(time),
+            }
+
+    @staticmethod
+    def _process(wrapper, messages):
+        for msg in messages:
+            try:
+                wrapper.process_new_message(msg)
+            except n6QueueProcessingException:
+                continue
+            list(wrapper.generate_suppresed_events_for_source(msg))
+            wrapper.save_changes()
+
+    @staticmethod
+    def _dump(aggr_data):
+        return {
+            source: (sd.time,
+                     sd.last_event,
+                     sd.time_tolerance,
+                     [(k, vars(v)) for k, v in sd.groups.iteritems()],
+                     [(k, vars(v)) for k, v in sd.buffer.iteritems()])
+            for source, sd in aggr_data.sources.iteritems()}
+
+    def test_state_restored_from_journal_after_crash(self):
+        wrapper = self._make_wrapper()
+        self._process(wrapper, self._iter_messages(300))
+        # (the aggregator is killed -- so store_state() is not called)
+        self.assertFalse(os.path.exists(self.dbpath))
+        restored = self._make_wrapper()
+        self.assertEqual(self._dump(restored.aggr_data), self._dump(wrapper.aggr_data))
+        self.assertTrue(restored.aggr_data.sources)
+
+    def test_state_restored_after_inactivity_cleanup(self):
+        wrapper = self._make_wrapper()
+        self._process(wrapper, self._iter_messages(100))
+        with patch('n6.utils.aggregator.datetime') as datetime_mock:
+            datetime_mock.datetime.utcnow.return_value = (datetime.datetime.utcnow() +
+                                                          datetime.timedelta(days=2))
+            datetime_mock.timedelta.side_effect = datetime.timedelta
+            self.assertTrue(list(wrapper.generate_suppresed_events_after_timeout()))
+        wrapper.save_changes()
+        self._process(wrapper, self._iter_messages(20, seed=1))
+        restored = self._make_wrapper()
+        self.assertEqual(self._dump(restored.aggr_data), self._dump(wrapper.aggr_data))
+
+    def test_journal_compaction(self):
+        wrapper = self._make_wrapper(journal_compaction_threshold=20)
+        self._process(wrapper, self._iter_messages(120))
+        generation = wrapper.aggr_data.journal_generation
+        self.assertGreaterEqual(generation, 2)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['aggregator_db.pickle',
+                          'aggregator_db.pickle.journal.{}'.format(generation)])
+        restored = self._make_wrapper()
+        self.assertEqual(self._dump(restored.aggr_data), self._dump(wrapper.aggr_data))
+        # (replaying only the journal tail -- not all records so far)
+        self.assertLess(restored._journal_record_count, 20)
+
+    def test_store_state(self):
+        wrapper = self._make_wrapper()
+        self._process(wrapper, self._iter_messages(100))
+        wrapper.store_state()
+        self.assertEqual(os.path.getsize(self.dbpath + '.journal.1'), 0)
+        self.assertFalse(os.path.exists(self.dbpath + '.journal.0'))
+        restored = self._make_wrapper()
+        self.assertEqual(self._dump(restored.aggr_data), self._dump(wrapper.aggr_data))
+
+    def test_incomplete_journal_record_ignored(self):
+        wrapper = self._make_wrapper()
+        messages = list(self._iter_messages(100))
+        self._process(wrapper, messages[:-1])
+        expected = self._dump(wrapper.aggr_data)
+        journal_path = self.dbpath + '.journal.0'
+        size = os.path.getsize(journal_path)
+        self._process(wrapper, messages[-1:])
+        # (simulating a crash while the last record was being written)
+        with open(journal_path, 'r+b') as f:
+            f.truncate(size + (os.path.getsize(journal_path) - size) // 2)
+        restored = self._make_wrapper()
+        self.assertEqual(self._dump(restored.aggr_data), expected)
+        self.assertEqual(os.path.getsize(journal_path), size)
+        # (new records are appended after the last complete one)
+        self._process(restored, messages[-1:])
+        self._process(wrapper, [])
+        self.assertEqual(self._dump(self._make_wrapper().aggr_data),
+                         self._dump(restored.aggr_data))
+
+    def test_legacy_snapshot_restored(self):
+        aggr_data = AggregatorData()
+        source_data = aggr_data.get_or_create_sourcedata({'source': 'testsource.testchannel'})
+        source_data.time = datetime.datetime(2017, 6, 1, 10)
+        source_data.last_event = datetime.datetime(2017, 6, 1, 11)
+        with open(self.dbpath, 'wb') as f:
+            cPickle.dump(aggr_data, f)
+        restored = self._make_wrapper()
+        self.assertEqual(restored.aggr_data.journal_generation, 0)
+        self.assertEqual(self._dump(restored.aggr_data), self._dump(aggr_data))
+
+
+
 class TestAggregatorData(unittest.TestCase):
 
     sample_source = 'testsource.testchannel'
@@ -1523,3 +1726,109 @@ class TestAggregatorData(unittest.TestCase):
         self.assertEqual(self.groups_hifreq_data, source_data.groups['group1'])
         self.assertEqual(self.buffer_hifreq_data, source_data.buffer['group1'])
         self.assertIs(source_data, self._aggregator_data.sources[self.sample_source])
+
+
+    def test_pop_inactive_sources(self):
+        for i in xrange(1000):
+            source_data = self._aggregator_data.get_or_create_sourcedata(
+                {'source': 'source{}.channel'.format(i)})
+            source_data.last_event = datetime.datetime(2017, 6, 2, 14) + datetime.timedelta(
+                minutes=i)
+        # the sample source's `last_event` is 2017-06-02 13:00
+        time_now = datetime.datetime(2017, 6, 3, 14, 1, 30)
+        inactive = self._aggregator_data.pop_inactive_sources(time_now)
+        self.assertEqual(inactive, [
+            self._sample_source_data,
+            self._aggregator_data.sources['source0.channel'],
+            self._aggregator_data.sources['source1.channel'],
+        ])
+        # the returned sources are re-indexed as active at `time_now`
+        self.assertEqual(self._aggregator_data.pop_inactive_sources(time_now), [])
+        self.assertEqual(len(self._aggregator_data._inactivity_heap), 1001)
+
+        # a source that was due according to the index, but has been
+        # active since then, is not returned (but it is re-indexed)
+        self._aggregator_data.sources['source2.channel'].last_event = (
+            datetime.datetime(2017, 6, 3, 14))
+        time_now = datetime.datetime(2017, 6, 3, 14, 4, 30)
+        inactive = self._aggregator_data.pop_inactive_sources(time_now)
+        self.assertEqual(inactive, [
+            self._aggregator_data.sources['source3.channel'],
+            self._aggregator_data.sources['source4.channel'],
+        ])
+        self.assertEqual(len(self._aggregator_data._inactivity_heap), 1001)
+        inactive = self._aggregator_data.pop_inactive_sources(
+            datetime.datetime(2017, 6, 4, 14, 0, 30))
+        self.assertEqual(inactive, (
+            [self._aggregator_data.sources['source{}.channel'.format(i)]
+             for i in xrange(5, 1000)] +
+            [self._aggregator_data.sources['source2.channel']]))
+
+
+    def test_inactivity_index_rebuilt_after_unpickling(self):
+        time_now = datetime.datetime(2017, 6, 3, 14)
+        self.assertEqual(self._aggregator_data.pop_inactive_sources(time_now),
+                         [self._sample_source_data])
+        self._sample_source_data.last_event = time_now
+        aggregator_data = cPickle.loads(cPickle.dumps(self._aggregator_data,
+                                                      cPickle.HIGHEST_PROTOCOL))
+        self.assertNotIn('_inactivity_heap', aggregator_data.__getstate__())
+        self.assertEqual(aggregator_data.pop_inactive_sources(time_now), [])
+        self.assertEqual(
+            aggregator_data.pop_inactive_sources(datetime.datetime(2017, 6, 4, 14, 1)),
+            [aggregator_data.sources[self.sample_source]])
+
+
+    def test_event_time_parsed_once(self):
+        source_data = self._aggregator_data.get_or_create_sourcedata(
+            self.new_event_new_source_payload)
+        with patch('n6.utils.aggregator.parse_iso_datetime_to_utc',
+                   wraps=parse_iso_datetime_to_utc) as parse_mock:
+            source_data.process_event(self.new_event_new_source_payload)
+            source_data.process_event(dict(self.new_event_new_source_payload,
+                                           time="2017-05-01 12:00:01"))
+            source_data.process_event(dict(self.new_event_new_source_payload,
+                                           time="2017-05-02 01:00:00"))
+        self.assertEqual(parse_mock.call_count, 3)
+        self.assertEqual(source_data.time, datetime.datetime(2017, 5, 2, 1))
+        self.assertEqual(source_data.time_ts, 1493686800)
+        self.assertEqual(source_data.buffer['group1'].until, datetime.datetime(2017, 5, 1, 12, 0, 1))
+        self.assertEqual(source_data.buffer['group1'].until_ts, 1493640001)
+
+
+    def test_fractional_seconds_preserved(self):
+        event = HiFreqEventData(dict(self.new_event_new_source_payload,
+                                     time="2017-05-01 12:00:00.123456"))
+        event.until = datetime.datetime(2017, 5, 1, 12, 30, 0, 654321)
+        self.assertEqual(event.first, datetime.datetime(2017, 5, 1, 12, 0, 0, 123456))
+        result = event.to_dict()
+        self.assertEqual(result['_first_time'], "2017-05-01 12:00:00.123456")
+        self.assertEqual(result['until'], "2017-05-01 12:30:00.654321")
+
+
+    def test_legacy_state_unpickled(self):
+        # (instances pickled by older versions kept datetimes/timedelta)
+        event = HiFreqEventData.__new__(HiFreqEventData)
+        event.__setstate__({
+            'group': 'group1',
+            'until': datetime.datetime(2017, 6, 2, 12),
+            'first': datetime.datetime(2017, 6, 2, 10),
+            'count': 2,
+            'payload': {'time': "2017-06-02 10:00:00"},
+        })
+        source_data = SourceData.__new__(SourceData)
+        source_data.__setstate__({
+            'time': datetime.datetime(2017, 6, 2, 12),
+            'last_event': datetime.datetime(2017, 6, 2, 13),
+            'groups': OrderedDict([('group1', event)]),
+            'time_tolerance': datetime.timedelta(seconds=self.sample_time_tolerance),
+            'buffer': OrderedDict(),
+        })
+        self.assertEqual(event.until_ts, 1496404800)
+        self.assertEqual(event.first_ts, 1496397600)
+        self.assertNotIn('until', vars(event))
+        self.assertEqual(source_data.time_ts, 1496404800)
+        self.assertEqual(source_data.time_tolerance_s, self.sample_time_tolerance)
+        self.assertEqual(source_data.time_tolerance,
+                         datetime.timedelta(seconds=self.sample_time_tolerance))
+        self.assertNotIn('time', vars(source_data))
@@ -2,6 +2,12 @@
 
 # Copyright (c) 2013-2018 NASK. All rights reserved.
 
+import cPickle
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
 import unittest
 import json
 
@@ -15,11 +21,36 @@ from n6.utils.comparator import (
     Comparator,
     ComparatorData,
     ComparatorDataWrapper,
+    BlackListData,
     ComparatorState,
+    SourceData,
 )
+from n6lib.datetime_helpers import parse_iso_datetime_to_utc
 from n6lib.unit_test_helpers import TestCaseMixin
 
 
+def _make_legacy_source_data(time, entries):
+    """
+    Make a SourceData instance as pickled by older versions, from
+    (<key>, <payload>, <flag (series id) or None>) tuples.
+    """
+    source_data = SourceData.__new__(SourceData)
+    source_data.__dict__.update(time=time, last_event=None, blacklist={})
+    for key, payload, flag in entries:
+        event = BlackListData.__new__(BlackListData)
+        event.__dict__.update(
+            id=payload['id'],
+            source=payload['source'],
+            url=payload.get('url'),
+            fqdn=payload.get('fqdn'),
+            ip=[str(addr['ip']) for addr in payload.get('address', [])],
+            flag=flag,
+            expires=parse_iso_datetime_to_utc(payload['expires']),
+            payload=dict(payload))
+        source_data.blacklist[key] = event
+    return source_data
+
+
 class TestComparator__message_flow(TestCaseMixin, unittest.TestCase):
 
     def setUp(self):
@@ -503,3 +534,212 @@ class TestComparator__message_flow(TestCaseMixin, unittest.TestCase):
             new_body = json.loads(call_kwargs['body'])
             deserialized_call_list.append(call(body=new_body, routing_key=call_kwargs['routing_key']))
         return deserialized_call_list
+
+
+class TestSourceData__deletion_detection(unittest.TestCase):
+
+    def setUp(self):
+        self.source_data = SourceData()
+
+    @staticmethod
+    def _msg(fqdn, series_id, bl_time='2017-01-19 12:00:00', expires='2017-01-25 12:00:00'):
+        return {
+            '_bl-time': bl_time,
+            '_bl-series-id': series_id,
+            'expires': expires,
+            'fqdn': fqdn,
+            'source': 'source_test1.channel_test1',
+            'id': fqdn + '-' + series_id,
+        }
+
+    def _process_series(self, series_id, fqdns, bl_time='2017-01-19 12:00:00', **kwargs):
+        for fqdn in fqdns:
+            self.source_data.process_event(self._msg(fqdn, series_id, bl_time, **kwargs))
+            self.source_data.update_time(parse_iso_datetime_to_utc(bl_time))
+
+    @staticmethod
+    def _summary(events):
+        return [(type_, payload['fqdn']) for type_, payload in events]
+
+    def test_not_seen_entries_delisted(self):
+        self._process_series('s1', ['a.pl', 'b.pl', 'c.pl', 'd.pl'])
+        self.assertEqual(self.source_data.process_deleted(), [])
+        self._process_series('s2', ['d.pl', 'b.pl'])
+        self.assertEqual(self._summary(self.source_data.process_deleted()),
+                         [('bl-delist', 'a.pl'), ('bl-delist', 'c.pl')])
+        self.assertItemsEqual(self.source_data.blacklist, ['b.pl', 'd.pl'])
+        self._process_series('s3', ['b.pl', 'd.pl'])
+        self.assertEqual(self.source_data.process_deleted(), [])
+
+    def test_expired_entries_expired(self):
+        self._process_series('s1', ['a.pl'], expires='2017-01-20 12:00:00')
+        self._process_series('s1', ['b.pl'])
+        self.assertEqual(self.source_data.process_deleted(), [])
+        self._process_series('s2', ['a.pl', 'b.pl'], bl_time='2017-01-21 12:00:00',
+                             expires='2017-01-20 12:00:00')
+        self.assertEqual(self._summary(self.source_data.process_deleted()),
+                         [('bl-expire', 'a.pl'), ('bl-expire', 'b.pl')])
+        self.assertEqual(self.source_data.blacklist, {})
+
+    def test_timed_out_series_entries_not_flagged(self):
+        self._process_series('s1', ['a.pl', 'b.pl'])
+        self.source_data.process_deleted()
+        self._process_series('s2', ['a.pl', 'b.pl'])
+        self.source_data.clear_flags('s2')
+        self._process_series('s3', ['b.pl'])
+        self.assertEqual(self._summary(self.source_data.process_deleted()),
+                         [('bl-delist', 'a.pl')])
+
+    def test_legacy_state_unpickled(self):
+        legacy = _make_legacy_source_data(parse_iso_datetime_to_utc('2017-01-19 12:00:00'), [
+            ('a.pl', self._msg('a.pl', 's1'), 's1'),
+            ('b.pl', self._msg('b.pl', 's1'), None),
+        ])
+        self.source_data = cPickle.loads(cPickle.dumps(legacy))
+        self.assertEqual(self._summary(self.source_data.process_deleted()),
+                         [('bl-delist', 'b.pl')])
+        self.assertItemsEqual(self.source_data.blacklist, ['a.pl'])
+
+
+class TestComparatorDataWrapper__persistence(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.dbpath = os.path.join(self.tmp_dir, 'comparator_db.pickle')
+
+    @staticmethod
+    def _msg(series_id, bl_time, **kwargs):
+        msg = {
+            '_bl-time': bl_time,
+            '_bl-series-id': series_id,
+            'expires': '2017-01-25 12:00:00',
+            'source': 'source_test1.channel_test1',
+        }
+        msg.update(kwargs)
+        msg['id'] = '{}-{}'.format(series_id, sorted(kwargs.items()))
+        return msg
+
+    def _process_series(self, wrapper, series_id, bl_time, entries):
+        for kwargs in entries:
+            wrapper.process_new_message(self._msg(series_id, bl_time, **kwargs))
+        return list(wrapper.process_deleted('source_test1.channel_test1'))
+
+    @staticmethod
+    def _dump(comp_data):
+        return {
+            source: (sd.time,
+                     sd.last_event,
+                     {key: (event.__getstate__(), sd.get_payload(key, event))
+                      for key, event in sd.blacklist.iteritems()})
+            for source, sd in comp_data.sources.iteritems()}
+
+    def _count_changes(self, wrapper, func):
+        changes_before = wrapper._db.total_changes
+        func()
+        return wrapper._db.total_changes - changes_before
+
+    def test_state_restored(self):
+        wrapper = ComparatorDataWrapper(self.dbpath)
+        self._process_series(wrapper, 's1', '2017-01-19 12:00:00', [
+            {'fqdn': 'a.pl'},
+            {'url': u'http://b.pl/\u0105'},
+            {'address': [{'ip': '1.1.1.1'}, {'ip': '2.2.2.2'}]},
+        ])
+        self._process_series(wrapper, 's2', '2017-01-20 12:00:00', [
+            {'fqdn': 'a.pl', 'expires': '2017-01-26 12:00:00'},
+            {'address': [{'ip': '2.2.2.2'}, {'ip': '1.1.1.1'}]},
+        ])
+        restored = ComparatorDataWrapper(self.dbpath)
+        self.assertEqual(self._dump(restored.comp_data), self._dump(wrapper.comp_data))
+        self.assertItemsEqual(restored.comp_data.sources['source_test1.channel_test1'].blacklist,
+                              ['a.pl', ('1.1.1.1', '2.2.2.2')])
+        delisted = self._process_series(restored, 's3', '2017-01-21 12:00:00', [
+            {'address': [{'ip': '1.1.1.1'}, {'ip': '2.2.2.2'}]},
+        ])
+        self.assertEqual([(type_, payload.get('fqdn')) for type_, payload in delisted],
+                         [('bl-delist', 'a.pl')])
+
+    def test_only_changes_written(self):
+        wrapper = ComparatorDataWrapper(self.dbpath)
+        entries = [{'fqdn': 'host{}.pl'.format(i)} for i in xrange(100)]
+        self.assertEqual(self._count_changes(wrapper, lambda: self._process_series(
+            wrapper, 's1', '2017-01-19 12:00:00', entries)), 1 + 100)
+        entries[0]['expires'] = '2017-01-26 12:00:00'
+        del entries[1]
+        # (the source row + the updated entry + the removed one)
+        self.assertEqual(self._count_changes(wrapper, lambda: self._process_series(
+            wrapper, 's2', '2017-01-20 12:00:00', entries)), 1 + 1 + 1)
+
+    def test_payloads_loaded_lazily(self):
+        wrapper = ComparatorDataWrapper(self.dbpath)
+        self._process_series(wrapper, 's1', '2017-01-19 12:00:00', [
+            {'fqdn': 'a.pl'},
+            {'fqdn': 'b.pl'},
+        ])
+        source_data = wrapper.comp_data.sources['source_test1.channel_test1']
+        self.assertEqual([event.payload for event in source_data.blacklist.itervalues()],
+                         [None, None])
+        type_, payload = wrapper.process_new_message(
+            self._msg('s2', '2017-01-20 12:00:00', fqdn='a.pl', expires='2017-01-26 12:00:00'))
+        self.assertEqual(type_, 'bl-update')
+        self.assertEqual((payload['fqdn'], payload['expires'], payload['_bl-time']),
+                         ('a.pl', '2017-01-26 12:00:00', '2017-01-19 12:00:00'))
+        delisted = list(wrapper.process_deleted('source_test1.channel_test1'))
+        self.assertEqual([(type_, payload['fqdn']) for type_, payload in delisted],
+                         [('bl-delist', 'b.pl')])
+
+    def test_pickle_migrated(self):
+        comp_data = ComparatorData()
+        comp_data.sources['source_test1.channel_test1'] = _make_legacy_source_data(
+            parse_iso_datetime_to_utc('2017-01-19 12:00:00'),
+            [('a.pl', self._msg('s1', '2017-01-19 12:00:00', fqdn='a.pl'), None)])
+        with open(self.dbpath, 'wb') as f:
+            cPickle.dump(comp_data, f)
+        wrapper = ComparatorDataWrapper(self.dbpath)
+        self.assertTrue(os.path.exists(self.dbpath + '.pickle-migrated'))
+        self.assertEqual(sqlite3.connect(self.dbpath).execute(
+            'SELECT COUNT(*) FROM blacklist_entry').fetchone(), (1,))
+        restored = ComparatorDataWrapper(self.dbpath)
+        self.assertEqual(self._dump(restored.comp_data), self._dump(wrapper.comp_data))
+
+
+class TestComparatorState(unittest.TestCase):
+
+    def setUp(self):
+        self.state = ComparatorState(sen.irrelevant)
+
+    @staticmethod
+    def _msg(series_no, total, series_id='s1'):
+        return {
+            '_bl-series-id': series_id,
+            '_bl-series-total': total,
+            '_bl-series-no': series_no,
+            'id': 'id{}'.format(series_no),
+        }
+
+    def test_duplicates_and_wrong_total_rejected(self):
+        self.state.update_series(self._msg(1, 3))
+        self.assertFalse(self.state.is_message_valid(self._msg(1, 3)))
+        self.assertFalse(self.state.is_message_valid(self._msg('1', '3')))
+        self.assertFalse(self.state.is_message_valid(self._msg(2, 4)))
+        self.assertTrue(self.state.is_message_valid(self._msg(2, 3)))
+        self.assertTrue(self.state.is_message_valid(self._msg(1, 4, series_id='s2')))
+
+    def test_replaying_100k_part_series(self):
+        # (a synthetic blacklist series, with parts shuffled and some
+        # of them redelivered; with list-based bookkeeping this took
+        # minutes, now it should take well under a second or two)
+        total = 100000
+        series_nos = range(1, total + 1)
+        rand = random.Random(42)
+        rand.shuffle(series_nos)
+        duplicates = set(rand.sample(series_nos, 1000))
+        for i, series_no in enumerate(series_nos, 1):
+            msg = self._msg(series_no, total)
+            self.assertTrue(self.state.is_message_valid(msg))
+            self.state.update_series(msg)
+            if series_no in duplicates:
+                self.assertFalse(self.state.is_message_valid(msg))
+            self.assertEqual(self.state.is_series_complete('s1'), i == total)
+        self.assertFalse(self.state.is_message_valid(self._msg(total + 1, total)))
@@ -2,16 +2,29 @@
 
 # Copyright (c) 2013-2018 NASK. All rights reserved.
 
+import collections
 import datetime
 import hashlib
+import os
+import random
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
 import unittest
 
+import dns.resolver
 import iptools
 import mock
 import pygeoip
 from dns.exception import DNSException
 
-from n6.utils.enrich import Enricher
+from n6.tests.utils import _geoip_test_db
+from n6.tests.utils._dns_stub_server import DnsStubServer
+from n6.utils.enrich import DnsCache, Enricher, GeoIpIndex, IpDataCache
+from n6lib.common_helpers import IPRangeMatcher
 from n6lib.record_dict import RecordDict
 from n6lib.unit_test_helpers import TestCaseMixin
 
@@ -39,6 +52,13 @@ class MockConfig(object):
         return self.config[key]
 
 
+class _FakeDnsAnswer(list):
+
+    def __init__(self, ips, ttl=300):
+        super(_FakeDnsAnswer, self).__init__(ips)
+        self.expiration = time.time() + ttl
+
+
 class TestEnricher(TestCaseMixin, unittest.TestCase):
 
     COMMON_DATA = {
@@ -54,13 +74,13 @@ class TestEnricher(TestCaseMixin, unittest.TestCase):
     @mock.patch('n6.base.queue.QueuedBase.get_connection_params_dict')
     @mock.patch('n6.utils.enrich.Config', MockConfig)
     def setUp(self, *args):
-        Enricher._setup_dnsresolver = mock.MagicMock()
-        Enricher._setup_geodb = mock.MagicMock()
-        self.enricher = Enricher()
+        with mock.patch.object(Enricher, '_setup_dnsresolver'), \
+             mock.patch.object(Enricher, '_setup_geodb'):
+            self.enricher = Enricher()
         self.enricher._resolver = mock.MagicMock()
         self.enricher.gi_asn = mock.MagicMock()
         self.enricher.gi_cc = mock.MagicMock()
-        self.enricher._resolver.query = mock.MagicMock(return_value=["127.0.0.1"])
+        self.enricher._resolver.query = mock.MagicMock(return_value=_FakeDnsAnswer(["127.0.0.1"]))
         self.enricher.gi_asn.org_by_addr = mock.MagicMock(return_value="AS1234")
         self.enricher.gi_cc.country_code_by_addr = mock.MagicMock(return_value="PL")
 
@@ -94,7 +114,7 @@ class TestEnricher(TestCaseMixin, unittest.TestCase):
             "_do_not_resolve_fqdn_to_ip": True}))
 
     def test__enrich__with_fqdn_given__resolved_to_various_ips_with_duplicates(self):
-        self.enricher._resolver.query.return_value = [
+        self.enricher._resolver.query.return_value = _FakeDnsAnswer([
             '2.2.2.2',
             '127.0.0.1',
             '13.1.2.3',
@@ -104,7 +124,7 @@ class TestEnricher(TestCaseMixin, unittest.TestCase):
             '12.11.10.9',
             '13.1.2.3',   # duplicate
             '1.0.1.1',
-        ]
+        ])
         data = self.enricher.enrich(RecordDict({"fqdn": "cert.pl"}))
         self.enricher._resolver.asert_called_once_with("cert.pl")
         self.assertEqualIncludingTypes(data, RecordDict({
@@ -200,6 +220,19 @@ class TestEnricher(TestCaseMixin, unittest.TestCase):
                          "cc": 'PL'}],
             "_do_not_resolve_fqdn_to_ip": True}))
 
+    def test__enrich__with_ipv6_url_given(self):
+        data = self.enricher.enrich(RecordDict({"url": "http://[2001:db8::1]:8080/asd"}))
+        self.assertEqualIncludingTypes(data, RecordDict({
+            "enriched": ([], {}),
+            "url": "http://[2001:db8::1]:8080/asd"}))
+        self.assertEqual(self.enricher._resolver.mock_calls, [])
+
+    def test__get_ip_data__ipv6_excluded(self):
+        self.enricher.excluded_ips = IPRangeMatcher('1.1.1.1', '2001:db8::/32')
+        self.assertEqual(self.enricher.get_ip_data('2001:db8::1'), (None, None, True))
+        self.assertEqual(self.enricher.get_ip_data('2001:db9::1'), (None, None, False))
+        self.assertEqual(self.enricher.get_ip_data('1.1.1.1'), (None, None, True))
+
     def test__enrich__with_fqdn_and_url_given(self):
         data = self.enricher.enrich(RecordDict({"fqdn": "cert.pl",
                                                 "url": "http://www.nask.pl/asd"}))
@@ -430,6 +463,99 @@ class TestEnricher(TestCaseMixin, unittest.TestCase):
         self.enricher.enrich(data)
         self.assertFalse(self.enricher.fqdn_to_ip.called)
 
+    def test__fqdn_to_ip__results_cached(self):
+        self.enricher._resolver.query.side_effect = [
+            _FakeDnsAnswer(['2.2.2.2', '1.1.1.1']),
+            _FakeDnsAnswer(['3.3.3.3'], ttl=-1),  # (already expired)
+            _FakeDnsAnswer(['4.4.4.4']),
+        ]
+        self.assertEqual(self.enricher.fqdn_to_ip('cert.pl'), ['1.1.1.1', '2.2.2.2'])
+        self.assertEqual(self.enricher.fqdn_to_ip('cert.pl'), ['1.1.1.1', '2.2.2.2'])
+        self.assertEqual(self.enricher.fqdn_to_ip('nask.pl'), ['3.3.3.3'])
+        self.assertEqual(self.enricher.fqdn_to_ip('nask.pl'), ['4.4.4.4'])
+        self.assertEqual(self.enricher._resolver.query.mock_calls, [
+            mock.call('cert.pl', 'A'),
+            mock.call('nask.pl', 'A'),
+            mock.call('nask.pl', 'A'),
+        ])
+        self.assertEqual(self.enricher.dns_cache.get_stats(),
+                         {'size': 2, 'hits': 1, 'misses': 3})
+
+    def test__fqdn_to_ip__negative_results_cached(self):
+        self.enricher._resolver.query.side_effect = DNSException
+        self.assertEqual(self.enricher.fqdn_to_ip('cert.pl'), [])
+        self.assertEqual(self.enricher.fqdn_to_ip('cert.pl'), [])
+        self.assertEqual(len(self.enricher._resolver.query.mock_calls), 1)
+        with mock.patch('n6.utils.enrich.time.time',
+                        return_value=time.time() + Enricher.default_dns_negative_cache_ttl):
+            self.assertEqual(self.enricher.fqdn_to_ip('cert.pl'), [])
+        self.assertEqual(len(self.enricher._resolver.query.mock_calls), 2)
+
+    def test__ip_data__cached(self):
+        self.enricher.excluded_ips = mock.MagicMock()
+        self.enricher.excluded_ips.__contains__.side_effect = lambda ip: ip == '2.2.2.2'
+        for _ in xrange(3):
+            data = RecordDict({
+                "address": [{"ip": "1.1.1.1"},
+                            {"ip": "2.2.2.2"},
+                            {"ip": "3.3.3.3"}]})
+            data.update(self.COMMON_DATA)
+            self.enricher.enrich(data)
+            self.assertEqual(data["address"], [
+                {"ip": "1.1.1.1", "asn": 1234, "cc": "PL"},
+                {"ip": "3.3.3.3", "asn": 1234, "cc": "PL"},
+            ])
+        self.assertEqual(self.enricher.excluded_ips.__contains__.mock_calls, [
+            mock.call('1.1.1.1'),
+            mock.call('2.2.2.2'),
+            mock.call('3.3.3.3'),
+        ])
+        self.assertEqual(self.enricher.gi_asn.org_by_addr.mock_calls, [
+            mock.call('1.1.1.1'),
+            mock.call('3.3.3.3'),
+        ])
+        self.assertEqual(self.enricher.gi_cc.country_code_by_addr.call_count, 2)
+        stats = self.enricher.ip_data_cache.get_stats()
+        self.assertEqual(stats['size'], 3)
+        self.assertEqual(stats['hits'], 12)  # (per event: 3 filtering + 2 setting data)
+        self.assertEqual(stats['misses'], 3)
+        self.assertAlmostEqual(stats['hit_rate'], 0.8)
+
+    def test__ip_data_cache__cleared_when_geodb_modified(self):
+        self.enricher.get_ip_data('1.1.1.1')
+        self.enricher._setup_geodb = mock.MagicMock()
+        with mock.patch.object(self.enricher, '_get_geodb_mtimes',
+                               return_value=self.enricher._geodb_mtimes):
+            # (it is too early to check)
+            self.enricher._get_geodb_mtimes.return_value = [1.0, 2.0]
+            self.enricher.enrich(RecordDict({}))
+            self.assertFalse(self.enricher._setup_geodb.called)
+            self.assertEqual(self.enricher.ip_data_cache.get_stats()['size'], 1)
+            with mock.patch('n6.utils.enrich.time.time',
+                            return_value=time.time() + Enricher.default_geodb_check_interval):
+                self.enricher.enrich(RecordDict({}))
+                self.assertEqual(self.enricher._setup_geodb.call_count, 1)
+                self.assertEqual(self.enricher.ip_data_cache.get_stats()['size'], 0)
+                self.enricher._geodb_next_check_time = 0
+                # (not modified since the last check)
+                self.enricher.enrich(RecordDict({}))
+                self.assertEqual(self.enricher._setup_geodb.call_count, 1)
+
+    def test__ip_data_cache__stale_value_not_stored_when_geodb_reloaded(self):
+        self.enricher._setup_geodb = mock.MagicMock()
+        self.enricher._geodb_next_check_time = 0
+        def org_by_addr(ip):
+            # (the databases are reloaded by another thread while
+            # the old ones are still being used by this one)
+            with mock.patch.object(self.enricher, '_get_geodb_mtimes',
+                                   return_value=[1.0, 2.0]):
+                self.enricher._maybe_check_geodb()
+            return 'AS1234 Foo'
+        self.enricher.gi_asn.org_by_addr.side_effect = org_by_addr
+        self.assertEqual(self.enricher.get_ip_data('1.1.1.1'), ('1234', 'PL', False))
+        self.assertEqual(self.enricher._setup_geodb.call_count, 1)
+        self.assertEqual(self.enricher.ip_data_cache.get_stats()['size'], 0)
+
     def test_routing_key_modified(self):
         """Test if routing key after enrichement is set to "enriched.*"
         when publishing to output queue"""
@@ -453,9 +579,41 @@ class TestEnricher(TestCaseMixin, unittest.TestCase):
                                         'dnsport': '53',
                                         'geoippath': '/usr/share/GeoIP',
                                         'excluded_ips': '1.1.1.1, 2.2.2.2,3.3.3.3'}
-        expected = iptools.IpRangeList('1.1.1.1', '2.2.2.2', '3.3.3.3')
         result = self.enricher._get_excluded_ips()
-        self.assertItemsEqual(expected, result)
+        self.assertIsInstance(result, IPRangeMatcher)
+        for ip in ['1.1.1.1', '2.2.2.2', '3.3.3.3']:
+            self.assertIn(ip, result)
+        for ip in ['0.0.0.0', '1.1.1.0', '1.1.1.2', '2.2.2.3', '3.3.3.2', '255.255.255.255']:
+            self.assertNotIn(ip, result)
+
+    def test__get_excluded_ips__consistent_with_iptools(self):
+        rand = random.Random(42)
+        random_ip = lambda: _geoip_test_db.int_to_ip(rand.randrange(2 ** 32))
+        # (abbreviated IPv4 addresses, such as '127' or '10.0', are also
+        # accepted by iptools -- both as standalone ones and in networks)
+        random_abbreviated_ip = lambda: '.'.join(random_ip().split('.')[:rand.randint(1, 3)])
+        for _ in xrange(20):
+            networks = ['{}/{}'.format(random_ip(), rand.randint(8, 32))
+                        for _ in xrange(rand.randint(1, 50))]
+            networks.extend('{}/{}'.format(random_abbreviated_ip(), rand.randint(8, 32))
+                            for _ in xrange(rand.randint(1, 5)))
+            networks.append(random_ip())
+            networks.append(random_abbreviated_ip())
+            networks.extend(['127/8', '10.0/16', '127.1', '192.168.1'])
+            self.enricher._enrich_config = {'dnshost': '8.8.8.8',
+                                            'dnsport': '53',
+                                            'geoippath': '/usr/share/GeoIP',
+                                            'excluded_ips': ', '.join(networks)}
+            result = self.enricher._get_excluded_ips()
+            reference = iptools.IpRangeList(*networks)
+            ips = [random_ip() for _ in xrange(500)]
+            for ip_range in reference.ips:
+                ips.extend(_geoip_test_db.int_to_ip(ip_int)
+                           for ip_int in (ip_range.startIp - 1, ip_range.startIp,
+                                          ip_range.endIp, ip_range.endIp + 1)
+                           if 0 <= ip_int < 2 ** 32)
+            for ip in ips:
+                self.assertEqual(ip in result, ip in reference, ip)
 
     def test__get_excluded_ips__without_excluded_ips_in_config(self):
         # config file without excluded_ips
@@ -526,7 +684,7 @@ class TestEnricher(TestCaseMixin, unittest.TestCase):
         self.assertEqual(ip_to_enr_mock.mock_calls, ip_to_enr_expected_calls)
 
     def test__filter_out_excluded_ips__with_no_ip_in_excluded_ips(self):
-        self.enricher.excluded_ips = iptools.IpRangeList('1.1.1.1', '2.2.2.2', '3.3.3.3')
+        self.enricher.excluded_ips = IPRangeMatcher('1.1.1.1', '2.2.2.2', '3.3.3.3')
         data = RecordDict({
             "url": "http://www.nask.pl/asd",
             "address": [{'ip': '1.1.1.5'}, {'ip': '2.1.1.1'}],
@@ -542,7 +700,7 @@ class TestEnricher(TestCaseMixin, unittest.TestCase):
         self.assertEqual(ip_to_enr_mock.mock_calls, ip_to_enr_expected_calls)
 
     def test__filter_out_excluded_ips__with_ip_in_excluded_ips__1(self):
-        self.enricher.excluded_ips = iptools.IpRangeList('1.1.1.1', '2.2.2.2', '3.3.3.3')
+        self.enricher.excluded_ips = IPRangeMatcher('1.1.1.1', '2.2.2.2', '3.3.3.3')
         data = RecordDict({
             "url": "http://www.nask.pl/asd",
             "address": [{'ip': '1.1.1.1'}, {'ip': '1.1.1.6'}],
@@ -560,7 +718,7 @@ class TestEnricher(TestCaseMixin, unittest.TestCase):
         self.assertEqual(ip_to_enr_mock.mock_calls, ip_to_enr_expected_calls)
 
     def test__filter_out_excluded_ips__with_ip_in_excluded_ips__2(self):
-        self.enricher.excluded_ips = iptools.IpRangeList('1.1.1.1', '2.2.2.2', '3.3.3.3')
+        self.enricher.excluded_ips = IPRangeMatcher('1.1.1.1', '2.2.2.2', '3.3.3.3')
         data = RecordDict({
             "url": "http://www.nask.pl/asd",
             "address": [{'ip': '1.1.1.1', 'asn': 1234}],
@@ -578,7 +736,7 @@ class TestEnricher(TestCaseMixin, unittest.TestCase):
         self.assertEqual(ip_to_enr_mock.mock_calls, ip_to_enr_expected_calls)
 
     def test__filter_out_excluded_ips__with_range_of_ips(self):
-        self.enricher.excluded_ips = iptools.IpRangeList('3.0.0.0/8')
+        self.enricher.excluded_ips = IPRangeMatcher('3.0.0.0/8')
         data = RecordDict({
             "url": "http://www.nask.pl/asd",
             "address": [
@@ -618,3 +776,382 @@ class TestEnricher(TestCaseMixin, unittest.TestCase):
         self.enricher._filter_out_excluded_ips(data, ip_to_enr_mock)
         self.assertEqualIncludingTypes(expected, data)
         self.assertItemsEqual(ip_to_enr_mock.mock_calls, ip_to_enr_expected_call_items)
+
+
+class TestDnsCache(unittest.TestCase):
+
+    def test_lru_eviction_and_expiration(self):
+        cache = DnsCache(max_size=2)
+        cache.set('a.example.com', ['1.2.3.4'], time.time() + 60)
+        cache.set('b.example.com', [], time.time() + 60)
+        self.assertEqual(cache.get('a.example.com'), ['1.2.3.4'])
+        cache.set('c.example.com', ['5.6.7.8'], time.time() + 60)
+        self.assertIsNone(cache.get('b.example.com'))  # (least recently used => evicted)
+        self.assertEqual(cache.get('a.example.com'), ['1.2.3.4'])
+        self.assertEqual(cache.get('c.example.com'), ['5.6.7.8'])
+        cache.set('c.example.com', ['5.6.7.8'], time.time() - 1)
+        self.assertIsNone(cache.get('c.example.com'))  # (expired)
+        self.assertEqual(cache.get_stats(), {'size': 1, 'hits': 3, 'misses': 2})
+
+    def test_disabled(self):
+        cache = DnsCache(max_size=0)
+        cache.set('a.example.com', ['1.2.3.4'], time.time() + 60)
+        self.assertIsNone(cache.get('a.example.com'))
+        self.assertEqual(cache.get_stats(), {'size': 0, 'hits': 0, 'misses': 1})
+
+
+class TestIpDataCache(unittest.TestCase):
+
+    def test_lru_eviction_and_clearing(self):
+        cache = IpDataCache(max_size=2)
+        cache.set('1.1.1.1', ('1234', 'PL', False))
+        cache.set('2.2.2.2', (None, None, True))
+        self.assertEqual(cache.get('1.1.1.1'), ('1234', 'PL', False))
+        cache.set('3.3.3.3', (None, 'US', False))
+        self.assertIsNone(cache.get('2.2.2.2'))  # (least recently used => evicted)
+        self.assertEqual(cache.get('1.1.1.1'), ('1234', 'PL', False))
+        self.assertEqual(cache.get('3.3.3.3'), (None, 'US', False))
+        self.assertEqual(cache.get_stats(), {'size': 2, 'max_size': 2, 'hits': 3,
+                                             'misses': 1, 'hit_rate': 0.75})
+        cache.clear()
+        self.assertIsNone(cache.get('1.1.1.1'))
+        self.assertEqual(cache.get_stats()['size'], 0)
+
+    def test_value_from_before_clearing_not_stored(self):
+        cache = IpDataCache(max_size=2)
+        generation = cache.generation
+        cache.clear()
+        cache.set('1.1.1.1', ('1234', 'PL', False), generation)
+        self.assertIsNone(cache.get('1.1.1.1'))
+        cache.set('1.1.1.1', ('5678', 'PL', False), cache.generation)
+        self.assertEqual(cache.get('1.1.1.1'), ('5678', 'PL', False))
+
+    def test_disabled(self):
+        cache = IpDataCache(max_size=0)
+        self.assertEqual(cache.get_stats(), {'size': 0, 'max_size': 0, 'hits': 0,
+                                             'misses': 0, 'hit_rate': None})
+        cache.set('1.1.1.1', ('1234', 'PL', False))
+        self.assertIsNone(cache.get('1.1.1.1'))
+
+
+class TestGeoIpIndex(unittest.TestCase):
+
+    ASN_NETWORKS = [
+        ('1.0.0.0/8', 'AS100 First Org'),
+        ('10.20.0.0/16', 'AS200 Second Org'),
+        ('10.21.128.0/17', 'AS200 Second Org'),
+        ('192.168.1.7/32', 'AS300 Third Org'),
+        ('200.0.0.0/6', 'AS400 Fourth Org'),
+    ]
+    CC_NETWORKS = [
+        ('1.0.0.0/9', 'PL'),
+        ('1.128.0.0/9', 'DE'),
+        ('10.0.0.0/8', 'PL'),
+        ('192.168.1.0/24', 'US'),
+        ('203.0.113.0/24', 'NL'),
+    ]
+    ASN_NETWORKS_V6 = [
+        ('2001:db8::/32', 'AS500 Fifth Org'),
+        ('2001:db9:1::/48', 'AS600 Sixth Org'),
+        ('2a00::/12', 'AS700 Seventh Org'),
+    ]
+    CC_NETWORKS_V6 = [
+        ('2001:db8::/33', 'PL'),
+        ('2001:db9::/32', 'CZ'),
+        ('2a00:1450::/32', 'IE'),
+    ]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.asn_db_path = os.path.join(self.tmp_dir, 'GeoIPASNum.dat')
+        self.cc_db_path = os.path.join(self.tmp_dir, 'GeoIP.dat')
+        self.index_path = os.path.join(self.tmp_dir, 'geoip-index.bin')
+        _geoip_test_db.write_asn_db(self.asn_db_path, self.ASN_NETWORKS)
+        _geoip_test_db.write_country_db(self.cc_db_path, self.CC_NETWORKS)
+        self.gi_asn = pygeoip.GeoIP(self.asn_db_path)
+        self.gi_cc = pygeoip.GeoIP(self.cc_db_path)
+        self.asn_db_v6_path = os.path.join(self.tmp_dir, 'GeoIPASNumv6.dat')
+        self.cc_db_v6_path = os.path.join(self.tmp_dir, 'GeoIPv6.dat')
+        _geoip_test_db.write_asn_db(self.asn_db_v6_path, self.ASN_NETWORKS_V6, ipv6=True)
+        _geoip_test_db.write_country_db(self.cc_db_v6_path, self.CC_NETWORKS_V6, ipv6=True)
+        self.gi_asn_v6 = pygeoip.GeoIP(self.asn_db_v6_path)
+        self.gi_cc_v6 = pygeoip.GeoIP(self.cc_db_v6_path)
+
+    def _expected(self, ip):
+        if ':' in ip:
+            org = self.gi_asn_v6.org_by_addr(ip)
+            cc = self.gi_cc_v6.country_code_by_addr(ip)
+        else:
+            org = self.gi_asn.org_by_addr(ip)
+            cc = self.gi_cc.country_code_by_addr(ip)
+        return (org.split()[0][2:] if org else None), (cc or None)
+
+    def _network_edge_ips(self, networks, ipv6=False):
+        address_bits = 128 if ipv6 else 32
+        for net, _ in networks:
+            ip, prefix_len = net.split('/')
+            start = _geoip_test_db.ip_to_int(ip)
+            end = start + 2 ** (address_bits - int(prefix_len))
+            for ip_int in (start - 1, start, start + 1, end - 1, end):
+                if 0 <= ip_int < 2 ** address_bits:
+                    yield _geoip_test_db.int_to_ip(ip_int, ipv6)
+
+    def test_lookup_consistent_with_geoip_databases(self):
+        index = GeoIpIndex.open(self.index_path, self.asn_db_path, self.cc_db_path)
+        rand = random.Random(42)
+        ips = list(self._network_edge_ips(self.ASN_NETWORKS + self.CC_NETWORKS))
+        ips.extend(_geoip_test_db.int_to_ip(rand.randrange(2 ** 32))
+                   for _ in xrange(2000))
+        ips.extend(['0.0.0.0', '255.255.255.255'])
+        for ip in ips:
+            self.assertEqual(index.lookup(ip), self._expected(ip), ip)
+        self.assertEqual(index.lookup('10.20.1.2'), ('200', 'PL'))
+        self.assertEqual(index.lookup('192.168.1.7'), ('300', 'US'))
+        self.assertEqual(index.lookup('192.168.1.8'), (None, 'US'))
+        self.assertEqual(index.lookup('203.0.113.1'), ('400', 'NL'))
+        self.assertEqual(index.lookup('100.1.1.1'), (None, None))
+
+    def test_lookup_consistent_with_geoip_databases__ipv6(self):
+        index = GeoIpIndex.open(self.index_path, self.asn_db_v6_path, self.cc_db_v6_path)
+        rand = random.Random(42)
+        ips = list(self._network_edge_ips(self.ASN_NETWORKS_V6 + self.CC_NETWORKS_V6,
+                                          ipv6=True))
+        # (note: pygeoip, being the reference here, misbehaves for
+        # IPv6 addresses whose int value has fewer than 11 digits)
+        ips.extend(_geoip_test_db.int_to_ip(rand.randrange(2 ** 34, 2 ** 128), ipv6=True)
+                   for _ in xrange(2000))
+        for ip in ips:
+            self.assertEqual(index.lookup(ip), self._expected(ip), ip)
+        self.assertEqual(index.lookup('2001:db8::1'), ('500', 'PL'))
+        self.assertEqual(index.lookup('2001:db8:8000::1'), ('500', None))
+        self.assertEqual(index.lookup('2001:db9:1:2::1'), ('600', 'CZ'))
+        self.assertEqual(index.lookup('2a00:1450:4001::1'), ('700', 'IE'))
+        self.assertEqual(index.lookup('::1'), (None, None))
+        self.assertEqual(index.lookup('ffff::1'), (None, None))
+
+    def test_lookup_of_invalid_ip(self):
+        index = GeoIpIndex.open(self.index_path, self.asn_db_path, self.cc_db_path)
+        self.assertEqual(index.lookup('1.2.3.256'), (None, None))
+        self.assertEqual(index.lookup(None), (None, None))
+
+    def test_lookup_of_ip_of_other_version(self):
+        index = GeoIpIndex.open(self.index_path, self.asn_db_path, self.cc_db_path)
+        index_v6 = GeoIpIndex.open(self.index_path + '.ipv6',
+                                   self.asn_db_v6_path, self.cc_db_v6_path)
+        self.assertEqual(index.lookup('2001:db8::1'), (None, None))
+        self.assertEqual(index_v6.lookup('1.2.3.4'), (None, None))
+
+    def test_databases_of_different_ip_versions(self):
+        with self.assertRaises(ValueError):
+            GeoIpIndex.build(self.index_path, self.asn_db_path, self.cc_db_v6_path)
+
+    def test_index_is_compact(self):
+        GeoIpIndex.open(self.index_path, self.asn_db_path, self.cc_db_path)
+        # (neighbouring intervals with equal data are merged)
+        num_of_intervals = ((os.path.getsize(self.index_path)
+                             - len(GeoIpIndex.FILE_MAGIC) - 5) // 10)
+        self.assertEqual(num_of_intervals, 18)
+
+    def test_index_file_rebuilt_only_if_outdated(self):
+        with mock.patch.object(GeoIpIndex, 'build', wraps=GeoIpIndex.build) as build_mock:
+            GeoIpIndex.open(self.index_path, self.asn_db_path, self.cc_db_path)
+            GeoIpIndex.open(self.index_path, self.asn_db_path, self.cc_db_path)
+            self.assertEqual(build_mock.call_count, 1)
+            _geoip_test_db.write_country_db(self.cc_db_path, [('100.0.0.0/8', 'CZ')])
+            index_mtime = os.path.getmtime(self.index_path)
+            os.utime(self.cc_db_path, (index_mtime + 10, index_mtime + 10))
+            index = GeoIpIndex.open(self.index_path, self.asn_db_path, self.cc_db_path)
+            self.assertEqual(build_mock.call_count, 2)
+        self.assertEqual(index.lookup('100.1.1.1'), (None, 'CZ'))
+        self.assertEqual(index.lookup('1.2.3.4'), ('100', None))
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['GeoIP.dat', 'GeoIPASNum.dat', 'GeoIPASNumv6.dat',
+                          'GeoIPv6.dat', 'geoip-index.bin'])
+
+    def test_not_an_index_file(self):
+        with self.assertRaises(ValueError):
+            GeoIpIndex(self.cc_db_path)
+
+    def test_enricher_uses_index(self):
+        enricher = Enricher.__new__(Enricher)
+        enricher.excluded_ips = None
+        enricher.ip_data_cache = IpDataCache(100)
+        enricher.geoip_index = GeoIpIndex.open(
+            self.index_path, self.asn_db_path, self.cc_db_path)
+        self.assertEqual(enricher.ip_to_asn_and_cc('10.20.1.2'), ('200', 'PL'))
+        self.assertEqual(enricher.ip_to_asn('1.200.0.1'), '100')
+        self.assertEqual(enricher.ip_to_cc('1.200.0.1'), 'DE')
+        data = RecordDict({'address': [{'ip': '192.168.1.7'}, {'ip': '100.1.1.1'}]})
+        data.update(TestEnricher.COMMON_DATA)
+        ip_to_enriched_address_keys = collections.defaultdict(list)
+        enricher._maybe_set_other_address_data(data, ip_to_enriched_address_keys)
+        self.assertEqual(data['address'], [{'ip': '192.168.1.7', 'asn': '300', 'cc': 'US'},
+                                           {'ip': '100.1.1.1'}])
+        self.assertEqual(ip_to_enriched_address_keys, {'192.168.1.7': ['asn', 'cc']})
+
+    def _make_enricher(self, geoip_index_path=None):
+        enrich_config = {
+            'dnshost': '8.8.8.8',
+            'dnsport': '53',
+            'geoippath': self.tmp_dir,
+        }
+        if geoip_index_path:
+            enrich_config['geoip_index_path'] = geoip_index_path
+        with mock.patch.dict(MockConfig.config, enrich=enrich_config), \
+             mock.patch('n6.utils.enrich.Config', MockConfig), \
+             mock.patch('n6.base.queue.QueuedBase.get_connection_params_dict'), \
+             mock.patch.object(Enricher, '_setup_dnsresolver'):
+            return Enricher()
+
+    def test_enricher_resolves_ipv6(self):
+        for geoip_index_path in [None, self.index_path]:
+            enricher = self._make_enricher(geoip_index_path)
+            if geoip_index_path:
+                self.assertIsNotNone(enricher.geoip_index_v6)
+                self.assertTrue(os.path.exists(geoip_index_path + '.ipv6'))
+            else:
+                self.assertIsNotNone(enricher.gi_asn_v6)
+            self.assertEqual(enricher.ip_to_asn_and_cc('2001:db8::1'), ('500', 'PL'))
+            self.assertEqual(enricher.ip_to_asn('2a00:1450::1'), '700')
+            self.assertEqual(enricher.ip_to_cc('2001:db9::1'), 'CZ')
+            self.assertEqual(enricher.get_ip_data('2001:db8::1'), ('500', 'PL', False))
+            self.assertEqual(enricher.ip_to_asn_and_cc('10.20.1.2'), ('200', 'PL'))
+
+    def test_enricher_without_ipv6_databases(self):
+        os.remove(self.asn_db_v6_path)
+        for geoip_index_path in [None, self.index_path]:
+            enricher = self._make_enricher(geoip_index_path)
+            self.assertEqual(enricher.ip_to_asn_and_cc('2001:db8::1'), (None, None))
+            self.assertEqual(enricher.ip_to_asn_and_cc('10.20.1.2'), ('200', 'PL'))
+
+    def _enrich_address(self, enricher, ip):
+        data = RecordDict({'address': [{'ip': ip}]})
+        data.update(TestEnricher.COMMON_DATA)
+        return enricher.enrich(data)['address']
+
+    def _touch_later(self, *paths):
+        later = time.time() + 10
+        for path in paths:
+            os.utime(path, (later, later))
+
+    def _check_geodb_now(self, enricher):
+        enricher._geodb_next_check_time = 0
+        return self._enrich_address(enricher, '10.20.1.2')
+
+    def test_enricher_keeps_previous_data_if_reloading_geodb_fails(self):
+        for geoip_index_path in [None, self.index_path]:
+            _geoip_test_db.write_country_db(self.cc_db_path, self.CC_NETWORKS)
+            enricher = self._make_enricher(geoip_index_path)
+            self.assertEqual(self._enrich_address(enricher, '10.20.1.2'),
+                             [{'ip': '10.20.1.2', 'asn': 200, 'cc': 'PL'}])
+            geodb_mtimes = enricher._geodb_mtimes
+            # (the new database file is corrupt, e.g., a failed download)
+            with open(self.cc_db_path, 'wb') as f:
+                f.write('<html><body>502 Bad Gateway</body></html>')
+            self._touch_later(self.cc_db_path)
+            with mock.patch('n6.utils.enrich.LOGGER') as LOGGER_mock:
+                self.assertEqual(self._check_geodb_now(enricher),
+                                 [{'ip': '10.20.1.2', 'asn': 200, 'cc': 'PL'}])
+            self.assertTrue(LOGGER_mock.error.called or LOGGER_mock.warning.called)
+            self.assertEqual(enricher._geodb_mtimes, geodb_mtimes)
+            self.assertGreater(enricher._geodb_next_check_time, time.time())
+            self.assertEqual(enricher.ip_data_cache.get_stats()['size'], 1)
+            self.assertEqual(enricher.ip_to_asn_and_cc('1.200.0.1'), ('100', 'DE'))
+
+    def test_enricher_reloads_geodb(self):
+        for geoip_index_path in [None, self.index_path]:
+            _geoip_test_db.write_country_db(self.cc_db_path, self.CC_NETWORKS)
+            enricher = self._make_enricher(geoip_index_path)
+            self.assertEqual(self._enrich_address(enricher, '10.20.1.2'),
+                             [{'ip': '10.20.1.2', 'asn': 200, 'cc': 'PL'}])
+            _geoip_test_db.write_country_db(self.cc_db_path, [('10.0.0.0/8', 'CZ')])
+            self._touch_later(self.cc_db_path)
+            with mock.patch.object(GeoIpIndex, 'build',
+                                   wraps=GeoIpIndex.build) as build_mock:
+                if geoip_index_path:
+                    # (an outdated index file is not rebuilt by the enricher)
+                    self.assertEqual(self._check_geodb_now(enricher),
+                                     [{'ip': '10.20.1.2', 'asn': 200, 'cc': 'PL'}])
+                    self.assertFalse(build_mock.called)
+                    Enricher.build_geoip_index_files(enricher._enrich_config)
+                    self.assertEqual(build_mock.call_count, 2)
+                    self._touch_later(geoip_index_path, geoip_index_path + '.ipv6')
+                self.assertEqual(self._check_geodb_now(enricher),
+                                 [{'ip': '10.20.1.2', 'asn': 200, 'cc': 'CZ'}])
+            self.assertEqual(enricher._geodb_mtimes, enricher._get_geodb_mtimes())
+
+
+class TestEnricher__with_dns_stub_server(unittest.TestCase):
+
+    @mock.patch('n6.base.queue.QueuedBase.get_connection_params_dict')
+    @mock.patch('n6.utils.enrich.Config', MockConfig)
+    def setUp(self, *args):
+        with mock.patch.object(Enricher, '_setup_dnsresolver'), \
+             mock.patch.object(Enricher, '_setup_geodb'):
+            self.enricher = Enricher()
+
+    def _set_resolver(self, dns_server, lifetime=2.0):
+        resolver = dns.resolver.Resolver(configure=False)
+        resolver.nameservers = [dns_server.host]
+        resolver.port = dns_server.port
+        resolver.timeout = resolver.lifetime = lifetime
+        self.enricher._resolver = resolver
+
+    def _fqdn_to_ip_concurrently(self, fqdns):
+        results = {}
+        def target(fqdn):
+            results[fqdn] = self.enricher.fqdn_to_ip(fqdn)
+        threads = [threading.Thread(target=target, args=(fqdn,)) for fqdn in fqdns]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_lookups_overlap(self):
+        records = {'host{0}.example.com'.format(i): ['10.0.0.{0}'.format(i)]
+                   for i in xrange(10)}
+        with DnsStubServer(records, latency=0.3) as dns_server:
+            self._set_resolver(dns_server)
+            start = time.time()
+            results = self._fqdn_to_ip_concurrently(sorted(records))
+            duration = time.time() - start
+        self.assertEqual(results, records)
+        self.assertLess(duration, 0.3 * 5)  # (sequentially it would take >= 3s)
+
+    def test_concurrent_lookups_of_same_fqdn_merged(self):
+        with DnsStubServer({'cert.pl': ['1.2.3.4']}, latency=0.2) as dns_server:
+            self._set_resolver(dns_server)
+            results = self._fqdn_to_ip_concurrently(['cert.pl'] * 10)
+            self.assertEqual(self.enricher.fqdn_to_ip('cert.pl'), ['1.2.3.4'])
+        self.assertEqual(results, {'cert.pl': ['1.2.3.4']})
+        self.assertEqual(dns_server.queried_fqdns, ['cert.pl'])
+
+    def test_ipv6_resolution(self):
+        records = {'cert.pl': ['1.2.3.4', '2001:db8::2', '2001:db8::1'],
+                   'v4only.example.com': ['5.6.7.8']}
+        with DnsStubServer(records) as dns_server:
+            self._set_resolver(dns_server)
+            self.assertEqual(self.enricher.fqdn_to_ipv6('cert.pl'), ['2001:db8::1', '2001:db8::2'])
+            self.assertEqual(self.enricher.fqdn_to_ip('cert.pl'), ['1.2.3.4'])
+            self.assertEqual(self.enricher.fqdn_to_ipv6('v4only.example.com'), [])
+            # (cached separately for each record type)
+            self.assertEqual(self.enricher.fqdn_to_ipv6('cert.pl'), ['2001:db8::1', '2001:db8::2'])
+            self.assertEqual(self.enricher.fqdn_to_ip('cert.pl'), ['1.2.3.4'])
+            self.assertEqual(self.enricher.fqdn_to_ipv6('v4only.example.com'), [])
+        self.assertEqual(dns_server.queried_fqdns, ['cert.pl', 'cert.pl', 'v4only.example.com'])
+
+    def test_nxdomain_and_timeout_negatively_cached(self):
+        with DnsStubServer({}, unresponsive_fqdns=['slow.example.com']) as dns_server:
+            self._set_resolver(dns_server, lifetime=0.3)
+            self.assertEqual(self.enricher.fqdn_to_ip('nonexistent.example.com'), [])
+            start = time.time()
+            self.assertEqual(self.enricher.fqdn_to_ip('slow.example.com'), [])
+            self.assertGreaterEqual(time.time() - start, 0.3)
+            num_of_queries = len(dns_server.queried_fqdns)
+            start = time.time()
+            self.assertEqual(self.enricher.fqdn_to_ip('slow.example.com'), [])
+            self.assertEqual(self.enricher.fqdn_to_ip('nonexistent.example.com'), [])
+            self.assertLess(time.time() - start, 0.1)
+            self.assertEqual(len(dns_server.queried_fqdns), num_of_queries)
@@ -7,7 +7,7 @@ import unittest
 
 from mock import MagicMock, call
 
-from n6.base.queue import QueuedBase
+from n6.base.queue import BatchedMessage, QueuedBase
 from n6.utils.filter import Filter
 from n6lib.auth_api import AuthAPI
 from n6lib.record_dict import RecordDict, AdjusterError
@@ -974,6 +974,39 @@ class TestFilter(unittest.TestCase):
             self.filter.get_client_and_urls_matched(record_dict, self.fqdn_only_categories),
             (['org4'], {'org4': [u'wąska.pl']}))
 
+    def test__get_client_and_urls_matched__url_seq_shared_by_many_orgs(self):
+        test_criteria_local = [
+            {'org_id': 'org5',
+             'url_seq': ['http://aaa.pl/auth.php', 'http://aaa.pl/', 'example.com'], },
+            {'org_id': 'org6',
+             'url_seq': ['http://aaa.pl/auth.php', 'http://aaa.pl/x'], },
+            {'org_id': 'org7',
+             'url_seq': ['http://aab.pl/auth.php'], }]
+        body = self.prepare_mock(test_criteria_local)
+        # test glob mach (not a valid regexp, literal prefix 'http://aaa.pl/')
+        body[u'url_pattern'] = u'http://aaa.pl/*?*'
+        json_msg = json.dumps(body)
+        record_dict = RecordDict.from_json(json_msg)
+        self.assertEqual(
+            self.filter.get_client_and_urls_matched(record_dict, self.fqdn_only_categories),
+            (['org5', 'org6'], {'org5': ['http://aaa.pl/auth.php'],
+                                'org6': ['http://aaa.pl/auth.php', 'http://aaa.pl/x']}))
+        # test regexp mach (the same pattern again, for another event)
+        body[u'url_pattern'] = u'aa[ab]\\.pl/auth'
+        json_msg = json.dumps(body)
+        record_dict = RecordDict.from_json(json_msg)
+        self.assertEqual(
+            self.filter.get_client_and_urls_matched(record_dict, self.fqdn_only_categories),
+            (['org5', 'org6', 'org7'], {'org5': ['http://aaa.pl/auth.php'],
+                                        'org6': ['http://aaa.pl/auth.php'],
+                                        'org7': ['http://aab.pl/auth.php']}))
+        record_dict = RecordDict.from_json(json_msg)
+        self.assertEqual(
+            self.filter.get_client_and_urls_matched(record_dict, self.fqdn_only_categories),
+            (['org5', 'org6', 'org7'], {'org5': ['http://aaa.pl/auth.php'],
+                                        'org6': ['http://aaa.pl/auth.php'],
+                                        'org7': ['http://aab.pl/auth.php']}))
+
     def test__get_client_and_urls_matched__only_fqdn(self):
         # domain is ok, category 'leak'
         test_criteria_local = [
@@ -1068,3 +1101,41 @@ class TestFilter(unittest.TestCase):
         self.assertEqual(
             self.filter.get_client_and_urls_matched(record_dict, self.fqdn_only_categories),
             (['org11'], {'org11': [u'władcażlebów.pl']}))
+
+    def test__batch_input_callback(self):
+        self.auth_api_mock._get_inside_criteria.return_value = [
+            {'org_id': 'org1',
+             'asn_seq': [42]},
+            {'org_id': 'org2',
+             'cc_seq': ['PL']},
+        ]
+        resolver_calls = []
+        get_inside_criteria_resolver = self.auth_api_mock.get_inside_criteria_resolver
+        self.auth_api_mock.get_inside_criteria_resolver = lambda: (
+            resolver_calls.append(None) or get_inside_criteria_resolver())
+        self.filter.fqdn_only_categories = self.fqdn_only_categories
+        self.filter.publish_output = MagicMock()
+        bodies = [
+            {"category": "bots", "restriction": "public", "confidence": "medium",
+             "source": "hpfeeds.dionaea", "time": "2013-07-01 20:37:20",
+             "id": "023a00e7c2ef04ee5b0f767ba73ee397", "rid": "023a00e7c2ef04ee5b0f767ba73ee397",
+             "address": [{"cc": "PL", "ip": "1.1.1.1", "asn": 42}]},
+            {"category": "bots", "restriction": "public", "confidence": "medium",
+             "source": "hpfeeds.dionaea", "time": "2013-07-01 20:37:20",
+             "id": "023a00e7c2ef04ee5b0f767ba73ee397", "rid": "023a00e7c2ef04ee5b0f767ba73ee397",
+             "address": [{"cc": "PL", "ip": "1.1.1.1", "asn": "not an asn"}]},
+            {"category": "bots", "restriction": "public", "confidence": "medium",
+             "source": "hpfeeds.dionaea", "time": "2013-07-01 20:37:20",
+             "id": "023a00e7c2ef04ee5b0f767ba73ee397", "rid": "023a00e7c2ef04ee5b0f767ba73ee397",
+             "address": [{"cc": "XX", "ip": "1.1.1.1", "asn": 42}]},
+        ]
+        messages = [BatchedMessage(i, 'event.enriched.foo.bar', json.dumps(body), None)
+                    for i, body in enumerate(bodies)]
+        self.filter.batch_input_callback(messages)
+        self.assertEqual(len(resolver_calls), 1)
+        self.assertEqual([m.exc_info is not None for m in messages], [False, True, False])
+        self.assertEqual(
+            [(kwargs['routing_key'], json.loads(kwargs['body'])['client'])
+             for _, _, kwargs in self.filter.publish_output.mock_calls],
+            [('event.filtered.foo.bar', ['org1', 'org2']),
+             ('event.filtered.foo.bar', ['org1'])])
@@ -1,11 +1,16 @@
 # Copyright (c) 2013-2018 NASK. All rights reserved.
 
+import calendar
 import collections
 import cPickle
 import datetime
+import functools
+import heapq
 import json
 import os
 import os.path
+import struct
+import zlib
 
 from n6.base.queue import (
     QueuedBase,
@@ -32,16 +37,66 @@ TICK_TIMEOUT = 3600
 # in seconds
 DEFAULT_TIME_TOLERANCE = 600
 
+# number of journal records after which a new snapshot of the state is made
+DEFAULT_JOURNAL_COMPACTION_THRESHOLD = 10000
+
+# (in the sharded mode -- see: Aggregator.configure_sharding())
+SHARDS_EXCHANGE_TYPE = 'x-consistent-hash'
+SHARD_BINDING_WEIGHT = '1'
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_SECONDS_PER_DAY = 86400
+
+
+# Event times are kept as UTC timestamps (int, or float if there is a
+# fractional part) -- they are cheaper to compare and to pickle than
+# datetimes; they are converted back to datetimes only when needed.
+
+def _datetime_to_timestamp(dt):
+    timestamp = calendar.timegm(dt.utctimetuple())
+    if dt.microsecond:
+        return timestamp + dt.microsecond / 1000000.0
+    return timestamp
+
+
+def _timestamp_to_datetime(timestamp):
+    return _EPOCH + datetime.timedelta(seconds=timestamp)
+
 
 class HiFreqEventData(object):
 
-    def __init__(self, payload):
+    def __init__(self, payload, event_time=None):
         self.group = payload.get("_group")
-        self.until = parse_iso_datetime_to_utc(payload.get('time'))
-        self.first = parse_iso_datetime_to_utc(payload.get('time'))
+        if event_time is None:
+            event_time = _datetime_to_timestamp(parse_iso_datetime_to_utc(payload.get('time')))
+        self.until_ts = event_time
+        self.first_ts = event_time
         self.count = 1
         self.payload = payload
 
+    def __setstate__(self, state):
+        if 'until' in state:
+            # (state pickled by an older version)
+            state['until_ts'] = _datetime_to_timestamp(state.pop('until'))
+            state['first_ts'] = _datetime_to_timestamp(state.pop('first'))
+        self.__dict__.update(state)
+
+    @property
+    def until(self):
+        return _timestamp_to_datetime(self.until_ts)
+
+    @until.setter
+    def until(self, dt):
+        self.until_ts = _datetime_to_timestamp(dt)
+
+    @property
+    def first(self):
+        return _timestamp_to_datetime(self.first_ts)
+
+    @first.setter
+    def first(self, dt):
+        self.first_ts = _datetime_to_timestamp(dt)
+
     def to_dict(self):
         result = self.payload
         result['count'] = self.count
@@ -57,38 +112,108 @@ class HiFreqEventData(object):
 
 class SourceData(object):
 
+    # a list of changes made since the last AggregatorDataWrapper.save_changes()
+    # call -- or None if changes are not recorded (see: the apply_change() method)
+    changes = None
+
     def __init__(self, time_tolerance):
-        self.time = None # current time tracked for source (based on event time)
+        self.time_ts = None # current time tracked for source (based on event time)
         # utc time of the last event (used to trigger cleanup if source is inactive)
         self.last_event = None
         self.groups = collections.OrderedDict() # groups aggregated for a given source
-        self.time_tolerance = datetime.timedelta(seconds=time_tolerance)
+        self.time_tolerance_s = time_tolerance
         # buffer to store aggregated events until time_tolerance has passed
         self.buffer = collections.OrderedDict()
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('changes', None)
+        return state
+
+    def __setstate__(self, state):
+        if 'time' in state:
+            # (state pickled by an older version)
+            time = state.pop('time')
+            state['time_ts'] = None if time is None else _datetime_to_timestamp(time)
+            state['time_tolerance_s'] = int(state.pop('time_tolerance').total_seconds())
+        self.__dict__.update(state)
+
+    @property
+    def time(self):
+        return None if self.time_ts is None else _timestamp_to_datetime(self.time_ts)
+
+    @time.setter
+    def time(self, dt):
+        self.time_ts = None if dt is None else _datetime_to_timestamp(dt)
+
+    @property
+    def time_tolerance(self):
+        return datetime.timedelta(seconds=self.time_tolerance_s)
+
+    def record_change(self, *change):
+        if self.changes is not None:
+            self.changes.append(change)
+
+    def apply_change(self, change):
+        """
+        Apply a change recorded earlier (to replay the journal).
+
+        Changes are tuples (the first item is a tag):
+        * ('time', <time (timestamp)>, <last_event>),
+        * ('group', <key>, <HiFreqEventData>) -- set a group (keeping
+          its position in `groups`, if it is already there),
+        * ('group-to-end', <key>, <HiFreqEventData>) -- set a group,
+          placing it at the end of `groups`,
+        * ('group-del', <key>),
+        * ('buffer', <key>, <HiFreqEventData>) -- analogous to 'group',
+        * ('buffer-del', <key>),
+        * ('clear',) -- clear `groups` and `buffer`.
+        """
+        tag = change[0]
+        if tag == 'time':
+            self.time_ts, self.last_event = change[1:]
+        elif tag == 'group':
+            self.groups[change[1]] = change[2]
+        elif tag == 'group-to-end':
+            self.groups.pop(change[1], None)
+            self.groups[change[1]] = change[2]
+        elif tag == 'group-del':
+            self.groups.pop(change[1], None)
+        elif tag == 'buffer':
+            self.buffer[change[1]] = change[2]
+        elif tag == 'buffer-del':
+            self.buffer.pop(change[1], None)
+        elif tag == 'clear':
+            self.groups.clear()
+            self.buffer.clear()
+        else:
+            raise ValueError('unknown change: {!r}'.format(change))
+
     def update_time(self, event_time):
-        if event_time > self.time:
-            self.time = event_time
+        if event_time > self.time_ts:
+            self.time_ts = event_time
         self.last_event = datetime.datetime.utcnow()
+        self.record_change('time', self.time_ts, self.last_event)
 
     def process_event(self, data):
-        event_time = parse_iso_datetime_to_utc(data['time'])
+        event_time = _datetime_to_timestamp(parse_iso_datetime_to_utc(data['time']))
         event = self.groups.get(data['_group'])
-        if self.time is None:
-            self.time = event_time
-        if event_time + self.time_tolerance < self.time:
-            if event is None or event.first > event_time:
+        if self.time_ts is None:
+            self.time_ts = event_time
+        if event_time + self.time_tolerance_s < self.time_ts:
+            if event is None or event.first_ts > event_time:
                 LOGGER.error('Event out of order. Ignoring. Data: %s', data)
                 raise n6QueueProcessingException('Event out of order.')
             else:
                 LOGGER.info('Event out of order, but not older than group\'s first event, '
                             'so it will be added to existing aggregate group. Data: %s', data)
-                event.until = max(event.until, event_time)
+                event.until_ts = max(event.until_ts, event_time)
                 event.count += 1
+                self.record_change('group', data['_group'], event)
                 return False
 
         if event is None:
-            if event_time < self.time:
+            if event_time < self.time_ts:
                 # unordered event, self.buffer may contain suppressed event
                 LOGGER.debug("Unordered event of the '%s' group, '%s' source within time "
                              "tolerance. Check and update buffer.", data['_group'], data['source'])
@@ -96,62 +221,71 @@ class SourceData(object):
                 if buffered_event is not None:
                     buffered_event.count += 1
                     self.buffer[data['_group']] = buffered_event
+                    self.record_change('buffer', data['_group'], buffered_event)
                     return False
             # Event not seen before - add new event to group
             LOGGER.debug("A new group '%s' for '%s' source began to be aggregated, "
                          "first event is being generated.", data['_group'], data['source'])
-            self.groups[data['_group']] = HiFreqEventData(data)
-            self.update_time(parse_iso_datetime_to_utc(data['time']))
+            self.groups[data['_group']] = HiFreqEventData(data, event_time)
+            self.record_change('group', data['_group'], self.groups[data['_group']])
+            self.update_time(event_time)
             return True
 
-        if (event_time > event.until + datetime.timedelta(hours=AGGREGATE_WAIT) or
-            event_time.date() > self.time.date()):
+        if (event_time > event.until_ts + AGGREGATE_WAIT * 3600 or
+            event_time // _SECONDS_PER_DAY > self.time_ts // _SECONDS_PER_DAY):
             LOGGER.debug("A suppressed event is generated for the '%s' group of "
                          "'%s' source due to passing of %s hours between events.",
                          data['_group'], data['source'], AGGREGATE_WAIT)
             # 24 hour aggregation or AGGREGATE_WAIT time passed between events in group
             del self.groups[data['_group']]
-            self.groups[data['_group']] = HiFreqEventData(data)
+            self.groups[data['_group']] = HiFreqEventData(data, event_time)
             self.buffer[data['_group']] = event
-            self.update_time(parse_iso_datetime_to_utc(data['time']))
+            self.record_change('group-to-end', data['_group'], self.groups[data['_group']])
+            self.record_change('buffer', data['_group'], event)
+            self.update_time(event_time)
             return True
 
         # Event for existing group and still aggregating
         LOGGER.debug("Event is being aggregated in the '%s' group of the '%s' source.",
                      data['_group'], data['source'])
         event.count += 1
-        if event_time > event.until:
-            event.until = event_time
+        if event_time > event.until_ts:
+            event.until_ts = event_time
         del self.groups[data['_group']]
         self.groups[data['_group']] = event
-        self.update_time(parse_iso_datetime_to_utc(data['time']))
+        self.record_change('group-to-end', data['_group'], event)
+        self.update_time(event_time)
         return False
 
     def generate_suppressed_events(self):
-        cutoff_time = self.time - datetime.timedelta(hours=AGGREGATE_WAIT)
+        cutoff_time = self.time_ts - AGGREGATE_WAIT * 3600
+        current_day = self.time_ts // _SECONDS_PER_DAY
         cutoff_check_complete = False
         for_cleanup = []
         for k, v in self.groups.iteritems():
-            if v.until >= cutoff_time:
+            if v.until_ts >= cutoff_time:
                 cutoff_check_complete = True
-            if cutoff_check_complete and v.until.date() == self.time.date():
+            if cutoff_check_complete and v.until_ts // _SECONDS_PER_DAY == current_day:
                 break
             for_cleanup.append(k)
             self.buffer[k] = v
+            self.record_change('buffer', k, v)
             # yield 'suppressed', v.to_dict() if v.count > 1 else None
         for k in for_cleanup:
             del self.groups[k]
+            self.record_change('group-del', k)
 
         # generate suppressed events from buffer
-        cutoff_time = self.time - self.time_tolerance
+        cutoff_time = self.time_ts - self.time_tolerance_s
         for_cleanup = []
         for k, v in self.buffer.iteritems():
-            if v.until >= cutoff_time:
+            if v.until_ts >= cutoff_time:
                 break
             for_cleanup.append(k)
             yield 'suppressed', v.to_dict() if v.count > 1 else None
         for k in for_cleanup:
             del self.buffer[k]
+            self.record_change('buffer-del', k)
 
     def generate_suppressed_events_after_inactive(self):
         for k, v in self.buffer.iteritems():
@@ -161,6 +295,8 @@ class SourceData(object):
         self.groups.clear()
         self.buffer.clear()
         self.last_event = datetime.datetime.utcnow()
+        self.record_change('clear')
+        self.record_change('time', self.time_ts, self.last_event)
 
     def __repr__(self):
         return repr(self.groups)
@@ -168,8 +304,73 @@ class SourceData(object):
 
 class AggregatorData(object):
 
+    # the number of the journal file that contains changes made after
+    # this state was stored (see: AggregatorDataWrapper)
+    journal_generation = 0
+
     def __init__(self):
         self.sources = {}
+        self._init_inactivity_index()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_inactivity_heap']
+        del state['_indexed_sources']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_inactivity_index()
+
+    def _init_inactivity_index(self):
+        # a heap of (<last_event>, <source>) pairs -- one per source; as
+        # `last_event` of a source is never decreased, the value in the
+        # heap is a lower bound of it, updated only when it gets due
+        # (so processing of events does not need to touch the heap)
+        self._inactivity_heap = []
+        self._indexed_sources = set()
+
+    def _index_new_sources(self):
+        # (sources are never removed, so comparing lengths is enough
+        # to detect whether any have been added)
+        if len(self._indexed_sources) < len(self.sources):
+            for source, source_data in self.sources.iteritems():
+                if source not in self._indexed_sources:
+                    heapq.heappush(self._inactivity_heap, (source_data.last_event, source))
+                    self._indexed_sources.add(source)
+
+    def pop_inactive_sources(self, time_now):
+        """
+        Get sources inactive for more than SOURCE_INACTIVITY_TIMEOUT hours.
+
+        Args:
+            `time_now`: the current UTC time (a datetime.datetime).
+
+        Returns:
+            A list of SourceData instances (the least recently active
+            first).  Their suppressed events are supposed to be generated
+            (see: SourceData.generate_suppressed_events_after_inactive()),
+            so they are re-indexed as active at `time_now`.
+
+        Only the heap entries which are due are touched, so the cost
+        does not depend on the number of active sources.
+        """
+        self._index_new_sources()
+        heap = self._inactivity_heap
+        deadline = time_now - datetime.timedelta(hours=SOURCE_INACTIVITY_TIMEOUT)
+        inactive = []
+        stale = []
+        while heap and heap[0][0] < deadline:
+            _, source = heapq.heappop(heap)
+            source_data = self.sources[source]
+            if source_data.last_event is None or source_data.last_event < deadline:
+                inactive.append(source_data)
+                stale.append((time_now, source))
+            else:
+                stale.append((source_data.last_event, source))
+        for item in stale:
+            heapq.heappush(heap, item)
+        return inactive
 
     def get_or_create_sourcedata(self, event, time_tolerance=DEFAULT_TIME_TOLERANCE):
         source = event['source']
@@ -185,26 +386,167 @@ class AggregatorData(object):
 
 class AggregatorDataWrapper(object):
 
-    def __init__(self, dbpath, time_tolerance):
+    """
+    The aggregator's state (an AggregatorData instance) with persistence.
+
+    The state is stored as a snapshot (pickled to the `dbpath` file)
+    plus a journal -- an append-only file (named `<dbpath>.journal.<N>`,
+    where N is the `journal_generation` of the snapshot) to which changes
+    of the state are written as soon as each message is processed (see:
+    save_changes()), so that the state survives even if the aggregator
+    is killed.  When the journal grows to `journal_compaction_threshold`
+    records (and also in store_state()), a new snapshot is made and a
+    new journal is started.  On restore, the snapshot is loaded and the
+    journal records are replayed.
+
+    Each journal record consists of a header: the length and the CRC32
+    of the data (two 32-bit unsigned little-endian integers), and the
+    data: a pickled (<source>, <time tolerance>, <list of changes>)
+    tuple (see: SourceData.apply_change()).  A record that is truncated
+    or corrupted (e.g., because of a crash while it was being written)
+    -- and anything after it -- is ignored.
+    """
+
+    _JOURNAL_RECORD_HEADER = struct.Struct('<II')
+
+    # (class-level defaults, for instances created without __init__())
+    journal_compaction_threshold = DEFAULT_JOURNAL_COMPACTION_THRESHOLD
+    _journal_file = None
+    _journal_record_count = 0
+
+    def __init__(self, dbpath, time_tolerance,
+                 journal_compaction_threshold=DEFAULT_JOURNAL_COMPACTION_THRESHOLD):
         self.aggr_data = None
         self.dbpath = dbpath
         self.time_tolerance = time_tolerance
+        self.journal_compaction_threshold = journal_compaction_threshold
         try:
             self.restore_state()
         except:
             LOGGER.error("Error restoring state from: %r", self.dbpath)
             self.aggr_data = AggregatorData()
+        try:
+            self._open_journal()
+        except (IOError, OSError):
+            LOGGER.error("Error opening journal file for: %r "
+                         "(changes will not be journaled)", self.dbpath)
 
-    def store_state(self):
+    def _get_journal_path(self, generation):
+        return '{}.journal.{}'.format(self.dbpath, generation)
+
+    def _open_journal(self):
+        self._journal_file = open(self._get_journal_path(self.aggr_data.journal_generation), 'ab')
+        for source_data in self.aggr_data.sources.itervalues():
+            source_data.changes = []
+
+    def save_changes(self):
+        """
+        Write changes made (since the previous call) to the journal.
+
+        To be called after each processed message (and each tick).
+        """
+        if self._journal_file is None:
+            return
+        records = []
+        for source, source_data in self.aggr_data.sources.iteritems():
+            if source_data.changes is None:
+                # a new source
+                source_data.changes = [('time', source_data.time_ts, source_data.last_event)]
+                source_data.changes.extend(('group', k, v) for k, v in source_data.groups.iteritems())
+                source_data.changes.extend(('buffer', k, v) for k, v in source_data.buffer.iteritems())
+            if source_data.changes:
+                record = cPickle.dumps(
+                    (source, source_data.time_tolerance_s, source_data.changes),
+                    cPickle.HIGHEST_PROTOCOL)
+                records.append(self._JOURNAL_RECORD_HEADER.pack(
+                    len(record), zlib.crc32(record) & 0xffffffff))
+                records.append(record)
+                source_data.changes = []
+        if not records:
+            return
         try:
-            with open(self.dbpath, "w") as f:
-                cPickle.dump(self.aggr_data, f)
+            self._journal_file.write(''.join(records))
+            self._journal_file.flush()
         except IOError:
+            LOGGER.error("Error writing to journal file for: %r", self.dbpath)
+        self._journal_record_count += len(records) // 2
+        if self._journal_record_count >= self.journal_compaction_threshold:
+            self.store_state()
+
+    def store_state(self):
+        """
+        Store a snapshot of the state and start a new journal.
+        """
+        if self._journal_file is not None:
+            self.aggr_data.journal_generation += 1
+        tmp_path = self.dbpath + '.tmp'
+        try:
+            with open(tmp_path, "wb") as f:
+                cPickle.dump(self.aggr_data, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self.dbpath)
+        except (IOError, OSError):
             LOGGER.error("Error saving state to: %r", self.dbpath)
+            if self._journal_file is not None:
+                # (continuing with the old journal)
+                self.aggr_data.journal_generation -= 1
+            return
+        if self._journal_file is not None:
+            self._journal_file.close()
+            old_journal_path = self._get_journal_path(self.aggr_data.journal_generation - 1)
+            try:
+                os.remove(old_journal_path)
+            except OSError:
+                LOGGER.warning("Could not remove old journal file %r", old_journal_path)
+            self._journal_record_count = 0
+            self._open_journal()
 
     def restore_state(self):
-        with open(self.dbpath, "r") as f:
-            self.aggr_data = cPickle.load(f)
+        if os.path.exists(self.dbpath):
+            with open(self.dbpath, "rb") as f:
+                self.aggr_data = cPickle.load(f)
+        else:
+            # (there may be a journal, even if no snapshot has been stored yet)
+            self.aggr_data = AggregatorData()
+        self._replay_journal()
+        # (the previous journal may remain if a crash occurred just after
+        # a snapshot was stored)
+        old_journal_path = self._get_journal_path(self.aggr_data.journal_generation - 1)
+        if os.path.exists(old_journal_path):
+            os.remove(old_journal_path)
+
+    def _replay_journal(self):
+        journal_path = self._get_journal_path(self.aggr_data.journal_generation)
+        try:
+            f = open(journal_path, 'r+b')
+        except IOError:
+            return
+        with f:
+            header_size = self._JOURNAL_RECORD_HEADER.size
+            record_count = 0
+            valid_size = 0
+            while True:
+                header = f.read(header_size)
+                if not header:
+                    break
+                if len(header) == header_size:
+                    length, crc = self._JOURNAL_RECORD_HEADER.unpack(header)
+                    record = f.read(length)
+                    if len(record) == length and zlib.crc32(record) & 0xffffffff == crc:
+                        source, time_tolerance, changes = cPickle.loads(record)
+                        source_data = self.aggr_data.get_or_create_sourcedata(
+                            {'source': source}, time_tolerance)
+                        for change in changes:
+                            source_data.apply_change(change)
+                        record_count += 1
+                        valid_size = f.tell()
+                        continue
+                LOGGER.warning("Incomplete or corrupted record in journal file %r "
+                               "(at offset %d) -- truncating the journal",
+                               journal_path, valid_size)
+                f.truncate(valid_size)
+                break
+        LOGGER.info("%d journal records replayed from %r", record_count, journal_path)
+        self._journal_record_count = record_count
 
     def process_new_message(self, data):
         """Processes a message and validates agains db to detect suppressed event.
@@ -227,19 +569,17 @@ class AggregatorDataWrapper(object):
             yield event
 
     def generate_suppresed_events_after_timeout(self):
-        """Scans all stored sources and based on real time
-         (i.e. source has been inactive for defined time)
-        generates suppressed events for inactive sources
+        """Based on real time (i.e. source has been inactive for defined time)
+        generates suppressed events for inactive sources (only sources that
+        are due are checked -- see: AggregatorData.pop_inactive_sources())
         """
         LOGGER.debug('Detecting inactive sources after tick timout')
         time_now = datetime.datetime.utcnow()
-        for source in self.aggr_data.sources.itervalues():
-            LOGGER.debug('Checking source: %r', source)
-            if source.last_event + datetime.timedelta(hours=SOURCE_INACTIVITY_TIMEOUT) < time_now:
-                LOGGER.debug('Source inactive. Generating suppressed events')
-                for type_, event in source.generate_suppressed_events_after_inactive():
-                    LOGGER.debug('%r: %r', type_, event)
-                    yield type_, event
+        for source in self.aggr_data.pop_inactive_sources(time_now):
+            LOGGER.debug('Source inactive. Generating suppressed events')
+            for type_, event in source.generate_suppressed_events_after_inactive():
+                LOGGER.debug('%r: %r', type_, event)
+                yield type_, event
 
 
 class Aggregator(QueuedBase):
@@ -253,12 +593,16 @@ class Aggregator(QueuedBase):
                     "exchange_type": "topic"
                     }
 
+    # (the non-sharded mode is the default -- see: configure_sharding())
+    shard_count = 1
+    shard_index = None
+
     def __init__(self, **kwargs):
         config = Config(required={"aggregator": ("dbpath", "time_tolerance")})
         self.aggregator_config = config["aggregator"]
         self.aggregator_config["dbpath"] = os.path.expanduser(self.aggregator_config["dbpath"])
         try:
-            os.makedirs(self.aggregator_config["dbpath"], 0700)
+            os.makedirs(os.path.dirname(self.aggregator_config["dbpath"]), 0700)
         except OSError:
             pass
         super(Aggregator, self).__init__(**kwargs)
@@ -271,9 +615,143 @@ class Aggregator(QueuedBase):
             raise Exception('stop aggregator, remember to set the rights'
                             ' for user, which runs aggregator,  path:',
                             self.aggregator_config["dbpath"])
-        self.db = AggregatorDataWrapper(self.aggregator_config["dbpath"], int(self.aggregator_config["time_tolerance"]))
+        self.configure_sharding(int(self.aggregator_config.get("shard_count", 1)),
+                                self.cmdline_args.n6shard)
+        self.db = AggregatorDataWrapper(
+            self.get_shard_dbpath(self.aggregator_config["dbpath"]),
+            int(self.aggregator_config["time_tolerance"]),
+            int(self.aggregator_config.get("journal_compaction_threshold",
+                                           DEFAULT_JOURNAL_COMPACTION_THRESHOLD)))
         self.timeout_id = None # id of the 'tick' timeout that executes source cleanup
 
+    def get_arg_parser(self):
+        arg_parser = super(Aggregator, self).get_arg_parser()
+        arg_parser.add_argument('--n6shard',
+                                type=int,
+                                metavar='INDEX',
+                                help=('the index (0, 1, ...) of the aggregator shard '
+                                      'to run (required if `shard_count` > 1)'))
+        return arg_parser
+
+    def configure_sharding(self, shard_count, shard_index):
+        """
+        Set up the sharded mode (if `shard_count` is greater than 1).
+
+        In the sharded mode `shard_count` aggregator instances are run,
+        each with a distinct `shard_index` (0 <= `shard_index` <
+        `shard_count`) and its own state (see: get_shard_dbpath()).
+        Events are routed from the original input exchange to a
+        consistent-hash exchange (it requires the RabbitMQ plugin
+        `rabbitmq_consistent_hash_exchange`) to which the queues of all
+        shards are bound with equal weights -- so all events of a source
+        (i.e., with the same routing key) go to the same shard.  Each
+        shard declares (and binds) the queues of all shards, so the
+        routing does not depend on the order in which the shards are
+        started; it depends, however, on `shard_count` -- after changing
+        it, the states of the shards are not valid any more.
+
+        Note that the non-sharded input queue is not used in the
+        sharded mode (it should be deleted when switching to that mode).
+        """
+        if shard_count < 1:
+            raise ValueError('shard_count must be a positive integer (got: {!r})'
+                             .format(shard_count))
+        if shard_count == 1:
+            if shard_index not in (None, 0):
+                raise ValueError('shard index {!r} given but sharding is not '
+                                 'enabled (shard_count is 1)'.format(shard_index))
+            return
+        if shard_index is None or not 0 <= shard_index < shard_count:
+            raise ValueError('for shard_count={!r}, the shard index must be '
+                             'given as an integer in the range 0..{!r} (got: {!r})'
+                             .format(shard_count, shard_count - 1, shard_index))
+        self.shard_count = shard_count
+        self.shard_index = shard_index
+        self._upstream_input_queue = self.input_queue
+        # (the names are derived from the original queue name, so
+        # that the '_recovery' suffix, if any, is kept)
+        base_queue_name = self.input_queue["queue_name"]
+        self.input_queue = {
+            "exchange": '{}_shards'.format(base_queue_name),
+            "exchange_type": SHARDS_EXCHANGE_TYPE,
+            "queue_name": self._get_shard_queue_name(shard_index),
+            "binding_keys": [SHARD_BINDING_WEIGHT],
+        }
+        LOGGER.info('Running as aggregator shard #%d (of %d), input queue: %r',
+                    shard_index, shard_count, self.input_queue["queue_name"])
+
+    def get_shard_dbpath(self, dbpath):
+        if self.shard_index is None:
+            return dbpath
+        return '{}.shard{}'.format(dbpath, self.shard_index)
+
+    def _get_shard_queue_name(self, shard_index):
+        return '{}_shard{}'.format(self._upstream_input_queue["queue_name"], shard_index)
+
+    def setup_input_exchange(self):
+        if self.shard_index is None:
+            super(Aggregator, self).setup_input_exchange()
+            return
+        params = self._upstream_input_queue
+        LOGGER.debug('Declaring exchange %s', params["exchange"])
+        self._channel_in.exchange_declare(
+            self.on_upstream_exchange_declared,
+            params["exchange"],
+            params["exchange_type"],
+            durable=True)
+
+    def on_upstream_exchange_declared(self, frame):
+        """
+        Declare the shards exchange (the sharded mode only).
+        """
+        if self._channel_in is None:
+            LOGGER.error('Shards exchange cannot be set up because input channel is None')
+            return
+        super(Aggregator, self).setup_input_exchange()
+
+    def on_input_exchange_declared(self, frame):
+        """
+        In the sharded mode: bind the shards exchange to the upstream
+        exchange and declare/bind the queues of the other shards, then
+        set up the own input queue (as in the non-sharded mode).
+
+        Note: pika performs synchronous RPC commands issued on a channel
+        one by one, so those bindings are complete before this shard
+        starts consuming.
+        """
+        if self.shard_index is not None and self._channel_in is not None:
+            upstream = self._upstream_input_queue
+            for binding_key in upstream["binding_keys"]:
+                LOGGER.debug('Binding %r to %r with %r',
+                             upstream["exchange"], self.input_queue["exchange"], binding_key)
+                self._channel_in.exchange_bind(
+                    self.on_shard_binding_ok,
+                    destination=self.input_queue["exchange"],
+                    source=upstream["exchange"],
+                    routing_key=binding_key)
+            for shard_index in xrange(self.shard_count):
+                if shard_index != self.shard_index:
+                    queue_name = self._get_shard_queue_name(shard_index)
+                    LOGGER.debug('Declaring queue %s', queue_name)
+                    self._channel_in.queue_declare(
+                        functools.partial(self.on_other_shard_queue_declared, queue_name),
+                        queue_name,
+                        durable=True,
+                        auto_delete=False,
+                        arguments={"x-dead-letter-exchange": "dead"})
+        super(Aggregator, self).on_input_exchange_declared(frame)
+
+    def on_other_shard_queue_declared(self, queue_name, method_frame):
+        if self._channel_in is None:
+            return
+        self._channel_in.queue_bind(self.on_shard_binding_ok,
+                                    queue_name,
+                                    self.input_queue["exchange"],
+                                    SHARD_BINDING_WEIGHT)
+
+    def on_shard_binding_ok(self, unused_frame):
+        LOGGER.debug('Shard binding made')
+
     def run(self):
         super(Aggregator, self).run()
 
@@ -290,6 +768,7 @@ class Aggregator(QueuedBase):
         for type_, event in self.db.generate_suppresed_events_after_timeout():
             if event is not None:
                 self.publish_event((type_, event))
+        self.db.save_changes()
         self.set_timeout()
 
     def process_event(self, data):
@@ -302,6 +781,7 @@ class Aggregator(QueuedBase):
         for type_, event in self.db.generate_suppresed_events_for_source(data):
             if event is not None:
                 self.publish_event((type_, event))
+        self.db.save_changes()
 
     def _cleanup_data(self, data):
         """Removes artifacts from earlier processing ('_group')
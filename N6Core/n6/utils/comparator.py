@@ -1,10 +1,16 @@
 # Copyright (c) 2013-2018 NASK. All rights reserved.
 
+import calendar
 import datetime
+import functools
+import hashlib
+import heapq
 import json
 import cPickle
+import struct
 import os
 import os.path
+import sqlite3
 
 from n6lib.config import Config
 from n6lib.datetime_helpers import parse_iso_datetime_to_utc
@@ -18,64 +24,198 @@ from n6.base.queue import (
 LOGGER = get_logger(__name__)
 
 
+def _datetime_to_timestamp(dt):
+    timestamp = calendar.timegm(dt.utctimetuple())
+    if dt.microsecond:
+        return timestamp + dt.microsecond / 1000000.0
+    return timestamp
+
+
+def _get_ips_hash(ips):
+    # (a 64-bit digest of the sorted IPs -- compared to detect changes)
+    digest = hashlib.md5('\n'.join(sorted(str(ip) for ip in ips))).digest()
+    return struct.unpack('<q', digest[:8])[0]
+
+
+class BlackListEntry(object):
+
+    """
+    A compact representation of a blacklist entry.
+
+    Only what is needed to detect changes is kept: the event id, the
+    hash of its IPs and the `expires` UTC timestamp.  The full event
+    (`payload`) may be None -- then it is loaded from the store when it
+    is needed (see: SourceData.get_payload()).
+    """
+
+    __slots__ = (
+        'id',
+        'ips_hash',
+        'expires',
+        # the generation of the source's blacklist in which the entry
+        # has been seen most recently (see: SourceData)
+        'generation',
+        'payload',
+    )
+
+    def __init__(self, id, ips_hash, expires, payload=None):
+        self.id = id
+        self.ips_hash = ips_hash
+        self.expires = expires
+        self.generation = None
+        self.payload = payload
+
+    @classmethod
+    def from_payload(cls, payload):
+        address = payload.get("address")
+        return cls(payload.get("id"),
+                   _get_ips_hash([addr["ip"] for addr in address] if address is not None else []),
+                   _datetime_to_timestamp(parse_iso_datetime_to_utc(payload.get("expires"))),
+                   payload.copy())
+
+    def __getstate__(self):
+        # (the generation and payload are not included -- see: ComparatorDataWrapper)
+        return self.id, self.ips_hash, self.expires
+
+    def __setstate__(self, state):
+        self.id, self.ips_hash, self.expires = state
+        self.generation = None
+        self.payload = None
+
+
 class BlackListData(object):
-    
-    def __init__(self, payload):
-        self.id = payload.get("id")
-        self.source = payload.get("source")
-        self.url = payload.get("url")
-        self.fqdn = payload.get("fqdn")
-        self.ip = [str(addr["ip"]) for addr in payload.get("address")] if payload.get("address") is not None else []
-        self.flag = payload.get("flag")
-        self.expires = parse_iso_datetime_to_utc(payload.get("expires"))
-        self.payload = payload.copy()
-        
-    def to_dict(self):
-        return self.payload
-    
-    def update_payload(self, update_dict):
-        tmp = self.payload.copy()
-        tmp.update(update_dict)
-        self.payload = tmp
+
+    # (the representation of blacklist entries used by older versions;
+    # kept to make it possible to unpickle and migrate their states --
+    # see: SourceData.__setstate__())
+
+    def to_entry(self):
+        return BlackListEntry(self.id,
+                              _get_ips_hash(self.ip),
+                              _datetime_to_timestamp(self.expires),
+                              self.payload)
 
 
 class SourceData(object):
 
+    """
+    The state of a source's blacklist.
+
+    To find the entries that have not been seen in a series without
+    scanning the whole blacklist, each entry is stamped (when it is
+    seen) with the *generation* assigned to the series (a number
+    unique within the source) and an index from generations to keys
+    of entries is kept.  Entries stamped with the generation of a
+    series that is still open are "flagged"; the others -- i.e., those
+    not seen since the last complete series, or seen only in a series
+    which has timed out -- are the leftovers that are delisted when
+    a series is complete (see: process_deleted()).  Flagged entries
+    are checked for expiry using a heap ordered by `expires`.
+
+    Entries are BlackListEntry instances.  If `payload_loader` is set
+    (to a callable taking an entry key), payloads of entries may be
+    dropped from memory once they are stored (see: mark_stored()).
+    """
+
+    payload_loader = None
+
     def __init__(self):
         self.time = None  # current time tracked for source (based on event _bl-time)
         # real time of the last event (used to trigger cleanup if source is inactive)
         self.last_event = None
         self.blacklist = {}  # current state of black list
+        self.generation = 0  # the most recently assigned generation
+        self._init_generation_index()
+        # keys of entries added, changed or removed since the last
+        # pop_dirty_keys() call
+        self._dirty_keys = set()
+
+    def _init_generation_index(self):
+        # {<series id>: <generation>} for series open in this source
+        self._series_generations = {}
+        # {<generation>: <set of keys of entries stamped with it>}
+        self._keys_by_generation = {}
+        # a heap of (<expires>, <key>) pairs; a pair is stale if the
+        # entry has been removed or its `expires` has been changed
+        self._expiry_heap = []
+
+    def __setstate__(self, state):
+        # (only states pickled by older versions are unpickled -- with
+        # BlackListData entries, flagged with the series id instead of
+        # generations; now the state is stored by ComparatorDataWrapper)
+        self.__dict__.update(state)
+        self._dirty_keys = set()
+        self.generation = 0
+        self._init_generation_index()
+        for key, old_event in self.blacklist.items():
+            event = old_event.to_entry()
+            series_id = old_event.__dict__.get('flag')
+            if series_id is not None:
+                self.blacklist[key] = event
+                self._mark_seen(key, event, series_id)
+                self._push_expiry(key, event)
+            else:
+                self.add_restored_entry(key, event)
+
+    def add_restored_entry(self, event_key, event):
+        """Add an entry restored from the store (as not seen in any open series)."""
+        self.blacklist[event_key] = event
+        event.generation = 0
+        self._keys_by_generation.setdefault(0, set()).add(event_key)
+        self._push_expiry(event_key, event)
+
+    def get_dirty_keys(self):
+        return self._dirty_keys
+
+    def mark_stored(self, stored_keys):
+        """
+        Forget the dirty keys and, if `payload_loader` is set, drop
+        the payloads of the stored entries from memory.
+        """
+        self._dirty_keys = set()
+        if self.payload_loader is not None:
+            blacklist = self.blacklist
+            for key in stored_keys:
+                event = blacklist.get(key)
+                if event is not None:
+                    event.payload = None
+
+    def get_payload(self, event_key, event):
+        if event.payload is not None:
+            return event.payload
+        return self.payload_loader(event_key)
 
     def update_time(self, event_time):
         if event_time > self.time:
             self.time = event_time
         self.last_event = datetime.datetime.now()  ## FIXME unused variable ?
 
-    def _are_ips_different(self, ips_old, ips_new):
-        """
-        Compare lists of ips.
-        
-        Returns:
-            True if lists different
-            False if lists the same
-        """
-        if ips_old is None and ips_new is None:
-            return False
-        if (ips_old is None and ips_new is not None) or (ips_old is not None and ips_new is None):
-            return True
-        if sorted(ips_old) == sorted(ips_new):
-            return False
-        else:
-            return True
-        
+    def _mark_seen(self, event_key, event, series_id):
+        generation = self._series_generations.get(series_id)
+        if generation is None:
+            self.generation += 1
+            generation = self._series_generations[series_id] = self.generation
+        if event.generation != generation:
+            if event.generation is not None:
+                self._keys_by_generation[event.generation].discard(event_key)
+            self._keys_by_generation.setdefault(generation, set()).add(event_key)
+            event.generation = generation
+
+    def _push_expiry(self, event_key, event):
+        heapq.heappush(self._expiry_heap, (event.expires, event_key))
+        if len(self._expiry_heap) > 2 * len(self.blacklist) + 1000:
+            # (getting rid of stale pairs)
+            self._expiry_heap = [(ev.expires, key) for key, ev in self.blacklist.iteritems()]
+            heapq.heapify(self._expiry_heap)
+
     def get_event_key(self, data):
         if data.get("url") is not None:
             return data.get("url")
         elif data.get("fqdn") is not None:
             return data.get("fqdn")
         elif data.get("address") is not None:
-            ips = tuple(sorted([str(addr["ip"]) for addr in data.get("address")]))
+            # (IP strings are interned -- they are shared by many entries)
+            ips = tuple(sorted([intern(str(addr["ip"])) for addr in data.get("address")]))
             return ips
         else:
             raise n6QueueProcessingException('Unable to determine event key for source: {}. Event '
@@ -95,59 +235,82 @@ class SourceData(object):
         event_key = self.get_event_key(data)
         event = self.blacklist.get(event_key)
 
+        series_id = data.get("_bl-series-id")
         if event is None:
             # new bl event
-            new_event = BlackListData(data)
-            new_event.flag = data.get("_bl-series-id")
+            new_event = BlackListEntry.from_payload(data)
+            self._mark_seen(event_key, new_event, series_id)
             self.blacklist[event_key] = new_event
+            self._push_expiry(event_key, new_event)
+            self._dirty_keys.add(event_key)
             return 'bl-new', new_event.payload
         else:
             # existing
-            ips_old = event.ip
             ips_new = [x["ip"] for x in data.get("address")] if data.get("address") is not None else []
-            if self._are_ips_different(ips_old, ips_new):
+            if _get_ips_hash(ips_new) != event.ips_hash:
                 data["replaces"] = event.id
-                new_event = BlackListData(data)
-                new_event.flag = data.get("_bl-series-id")
+                new_event = BlackListEntry.from_payload(data)
+                new_event.generation = event.generation
+                self._mark_seen(event_key, new_event, series_id)
                 self.blacklist[event_key] = new_event
+                self._push_expiry(event_key, new_event)
+                self._dirty_keys.add(event_key)
                 return "bl-change", new_event.payload
-            elif parse_iso_datetime_to_utc(data.get("expires")) != event.expires:
-                event.expires = parse_iso_datetime_to_utc(data.get("expires"))
-                event.flag = data.get("_bl-series-id")
-                event.update_payload({"expires": data.get("expires")})
-                self.blacklist[event_key] = event
+            elif _datetime_to_timestamp(parse_iso_datetime_to_utc(data.get("expires"))) != event.expires:
+                event.expires = _datetime_to_timestamp(parse_iso_datetime_to_utc(data.get("expires")))
+                self._mark_seen(event_key, event, series_id)
+                payload = self.get_payload(event_key, event).copy()
+                payload["expires"] = data.get("expires")
+                event.payload = payload
+                self._push_expiry(event_key, event)
+                self._dirty_keys.add(event_key)
                 return "bl-update", event.payload
             else:
-                event.flag = data.get("_bl-series-id")
-                self.blacklist[event_key] = event
-                return None, event.payload
+                self._mark_seen(event_key, event, series_id)
+                # (the payload is not needed -- nothing is published)
+                return None, None
 
     def process_deleted(self):
+        """
+        Remove entries not seen in open series and expired ones.
 
+        Returns:
+            A list of ["bl-delist", <payload>] and ["bl-expire",
+            <payload>] lists.
+
+        All entries are "unflagged" afterwards, i.e., the generations
+        of all open series become old ones.
+        """
         ret_value = []
-        for key, event in list(self.blacklist.iteritems()):
-            if event.flag is None:
-                value = event.payload.copy()
-                if key in self.blacklist:
-                    del self.blacklist[key]
-                # yield "bl-delist", value
-                ret_value.append(["bl-delist", value])
-                continue
-            if event.expires < self.time:
-                value = event.payload.copy()
-                if key in self.blacklist:
-                    del self.blacklist[key]
-                # yield "bl-expire", value
-                ret_value.append(["bl-expire", value])
+        current_generations = set(self._series_generations.itervalues())
+        deleted = []
+        for generation in self._keys_by_generation.keys():
+            if generation not in current_generations:
+                for key in self._keys_by_generation.pop(generation):
+                    deleted.append((key, self.blacklist.pop(key)))
+                    self._dirty_keys.add(key)
+        # (sorted -- to make the order of output messages deterministic)
+        deleted.sort(key=lambda (key, event): event.id)
+        for key, event in deleted:
+            ret_value.append(["bl-delist", self.get_payload(key, event).copy()])
+        heap = self._expiry_heap
+        time = _datetime_to_timestamp(self.time)
+        while heap and heap[0][0] < time:
+            expires, key = heapq.heappop(heap)
+            event = self.blacklist.get(key)
+            if event is None or event.expires != expires:
+                # (stale)
                 continue
-            event.flag = None
+            del self.blacklist[key]
+            self._keys_by_generation[event.generation].discard(key)
+            self._dirty_keys.add(key)
+            ret_value.append(["bl-expire", self.get_payload(key, event).copy()])
+        self._series_generations.clear()
         return ret_value
 
     def clear_flags(self, flag_id):
-        for key, event in list(self.blacklist.iteritems()):
-            if event.flag == flag_id:
-                event.flag = None
-                self.blacklist[key] = event
+        # (the entries stamped with the series' generation become old ones)
+        self._series_generations.pop(flag_id, None)
 
     def __repr__(self):
         return repr(self.groups)
@@ -171,6 +334,48 @@ class ComparatorData(object):
 
 class ComparatorDataWrapper(object):
 
+    """
+    The comparator's state (a ComparatorData instance) with persistence.
+
+    The state is stored in an SQLite database (the `dbpath` file): a
+    row per source (its `time` and `last_event`) and a row per blacklist
+    entry (a pickled BlackListEntry and, separately, the JSON of its
+    payload; keyed by the source and the JSON representation of the
+    entry key).  store_state() writes -- in one transaction -- only the
+    entries that have been added, changed or removed since the previous
+    call (see: SourceData.get_dirty_keys()), so its cost does not depend
+    on the size of the blacklists.
+
+    Payloads of stored entries are not kept in memory: they are loaded
+    from the database only when an update, delist or expire message is
+    to be emitted (see: SourceData.get_payload()).
+
+    Which entries have been seen in open series is not stored: the
+    state of series (see: ComparatorState) is not persistent either.
+
+    If the `dbpath` file is a pickled ComparatorData (as stored by older
+    versions), it is migrated to the database once: the file is renamed
+    to `<dbpath>.pickle-migrated` and its content is stored in a new
+    database at `dbpath`.
+    """
+
+    _SQLITE_FILE_HEADER = 'SQLite format 3\x00'
+
+    _SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS source (
+            name TEXT PRIMARY KEY,
+            state BLOB NOT NULL)""",
+        """CREATE TABLE IF NOT EXISTS blacklist_entry (
+            source TEXT NOT NULL,
+            key TEXT NOT NULL,
+            entry BLOB NOT NULL,
+            payload TEXT NOT NULL,
+            PRIMARY KEY (source, key))""",
+    )
+
+    # (class-level default, for instances created without __init__())
+    _db = None
+
     def __init__(self, dbpath):
         self.comp_data = None
         self.dbpath = dbpath
@@ -180,16 +385,117 @@ class ComparatorDataWrapper(object):
             LOGGER.error("Error restoring state from: %r", self.dbpath)
             self.comp_data = ComparatorData()
 
-    def store_state(self):
+    @staticmethod
+    def _dump(obj):
+        return buffer(cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL))
+
+    @staticmethod
+    def _load(blob):
+        return cPickle.loads(str(blob))
+
+    @staticmethod
+    def _dump_key(event_key):
+        # (keys are URLs, FQDNs or tuples of IPs -- see: SourceData.get_event_key())
+        return json.dumps(event_key)
+
+    @staticmethod
+    def _load_key(key_json):
+        event_key = json.loads(key_json)
+        if isinstance(event_key, list):
+            return tuple(intern(str(ip)) for ip in event_key)
+        return event_key
+
+    def _is_sqlite_file(self):
+        with open(self.dbpath, 'rb') as f:
+            header = f.read(len(self._SQLITE_FILE_HEADER))
+        # (an empty file is a valid, empty SQLite database)
+        return header in (self._SQLITE_FILE_HEADER, '')
+
+    def _connect(self):
+        self._db = sqlite3.connect(self.dbpath)
+        with self._db:
+            for statement in self._SCHEMA:
+                self._db.execute(statement)
+
+    def store_state(self, all_entries=False):
+        """
+        Store the changes of the state (or, if `all_entries` is true,
+        the whole state) in the database.
+        """
+        stored = []
         try:
-            with open(self.dbpath, "w") as f:
-                cPickle.dump(self.comp_data, f)
-        except IOError:
+            if self._db is None:
+                self._connect()
+            with self._db:
+                for source, source_data in self.comp_data.sources.iteritems():
+                    stored_keys = self._store_source_data(source, source_data, all_entries)
+                    stored.append((source, source_data, stored_keys))
+        except (sqlite3.Error, IOError, OSError):
             LOGGER.error("Error saving state to: %r", self.dbpath)
+            return
+        # (only when the transaction has been committed)
+        for source, source_data, stored_keys in stored:
+            if source_data.payload_loader is None:
+                source_data.payload_loader = functools.partial(self._load_payload, source)
+            source_data.mark_stored(stored_keys)
+
+    def _store_source_data(self, source, source_data, all_entries):
+        blacklist = source_data.blacklist
+        dirty_keys = source_data.get_dirty_keys()
+        if all_entries:
+            dirty_keys = dirty_keys.union(blacklist)
+        self._db.execute(
+            "INSERT OR REPLACE INTO source (name, state) VALUES (?, ?)",
+            (source, self._dump((source_data.time, source_data.last_event))))
+        self._db.executemany(
+            "INSERT OR REPLACE INTO blacklist_entry (source, key, entry, payload) "
+            "VALUES (?, ?, ?, ?)",
+            ((source,
+              self._dump_key(key),
+              self._dump(blacklist[key]),
+              json.dumps(source_data.get_payload(key, blacklist[key])))
+             for key in dirty_keys if key in blacklist))
+        self._db.executemany(
+            "DELETE FROM blacklist_entry WHERE source = ? AND key = ?",
+            ((source, self._dump_key(key))
+             for key in dirty_keys if key not in blacklist))
+        return dirty_keys
+
+    def _load_payload(self, source, event_key):
+        row = self._db.execute(
+            "SELECT payload FROM blacklist_entry WHERE source = ? AND key = ?",
+            (source, self._dump_key(event_key))).fetchone()
+        if row is None:
+            raise KeyError('no payload of the blacklist entry {!r} (source: {!r}) '
+                           'in the database'.format(event_key, source))
+        return json.loads(row[0])
 
     def restore_state(self):
-        with open(self.dbpath, "r") as f:
-            self.comp_data = cPickle.load(f)
+        if os.path.exists(self.dbpath) and not self._is_sqlite_file():
+            self._migrate_pickle()
+            return
+        self._connect()
+        comp_data = ComparatorData()
+        for source, state in self._db.execute("SELECT name, state FROM source"):
+            source_data = comp_data.get_or_create_sourcedata(source)
+            source_data.time, source_data.last_event = self._load(state)
+            source_data.payload_loader = functools.partial(self._load_payload, source)
+        for source, key_json, entry in self._db.execute(
+                "SELECT source, key, entry FROM blacklist_entry"):
+            source_data = comp_data.get_or_create_sourcedata(source)
+            source_data.add_restored_entry(self._load_key(key_json), self._load(entry))
+        self.comp_data = comp_data
+
+    def _migrate_pickle(self):
+        with open(self.dbpath, "rb") as f:
+            comp_data = cPickle.load(f)
+        migrated_path = self.dbpath + '.pickle-migrated'
+        os.rename(self.dbpath, migrated_path)
+        LOGGER.info("Migrating the comparator state from the pickle file %r "
+                    "(renamed to %r) to the database", self.dbpath, migrated_path)
+        self.comp_data = comp_data
+        self._connect()
+        self.store_state(all_entries=True)
 
     def process_new_message(self, data):
         """Processes a message and validates agains db to detect new/change/update.
@@ -227,8 +533,8 @@ class ComparatorState(object):
                          ...}
         open_series = {series-id: {"total": int, #total number of messages in a series
                                    "msg-count": int #number of messages seen so far
-                                   "msg-nums": [int, ...], #message numbers of seen messages
-                                   "msg-ids": [str, ...], #ids of the seen messages
+                                   "msg-nums": {int, ...}, #message numbers of seen messages
+                                   "msg-ids": {str, ...}, #ids of the seen messages
                                    "timeout-id": str, #id of the created timeout for a serie
                                     }
                        ...}
@@ -239,23 +545,22 @@ class ComparatorState(object):
     def is_series_complete(self, series_id):
         """Verify if the series is complete"""
         assert series_id in self.open_series
-        if self.open_series[series_id]["total"] == self.open_series[series_id]["msg-count"]:
-            return True
-        else:
-            return False
+        series = self.open_series[series_id]
+        return series["total"] == series["msg-count"]
 
     def is_message_valid(self, message):
         """Check if message belongs to open series and it was not seen earlier
         (i.e. is not a duplicate)
         """
-        if message["_bl-series-id"] in self.open_series:
-            #if message["id"] in self.open_series[message["_bl-series-id"]]["msg-ids"]:
+        series = self.open_series.get(message["_bl-series-id"])
+        if series is not None:
+            #if message["id"] in series["msg-ids"]:
             #    return False
-            if message["_bl-series-total"] != self.open_series[message["_bl-series-id"]]["total"]:
+            if int(message["_bl-series-total"]) != series["total"]:
                 return False
-            if message["_bl-series-no"] in self.open_series[message["_bl-series-id"]]["msg-nums"]:
+            if int(message["_bl-series-no"]) in series["msg-nums"]:
                 return False
-            if self.open_series[message["_bl-series-id"]]["msg-count"] + 1 > self.open_series[message["_bl-series-id"]]["total"]:
+            if series["msg-count"] + 1 > series["total"]:
                 return False
         return True
 
@@ -265,19 +570,20 @@ class ComparatorState(object):
         - update message count for a series
         - store message id and msg num
         """
-        if message["_bl-series-id"] not in self.open_series:
-            self.open_series[message["_bl-series-id"]] = {"total": int(message["_bl-series-total"]),
-                                                         "timeout-id": None,
-                                                         "msg-count": 0,
-                                                         "msg-nums": [],
-                                                         "msg-ids": []
-                                                         }
-        self.open_series[message["_bl-series-id"]]["msg-count"] += 1
-        self.open_series[message["_bl-series-id"]]["msg-nums"].append(int(message["_bl-series-no"]))
-        self.open_series[message["_bl-series-id"]]["msg-ids"].append(message["id"])
+        series = self.open_series.get(message["_bl-series-id"])
+        if series is None:
+            series = self.open_series[message["_bl-series-id"]] = {"total": int(message["_bl-series-total"]),
+                                                                   "timeout-id": None,
+                                                                   "msg-count": 0,
+                                                                   "msg-nums": set(),
+                                                                   "msg-ids": set()
+                                                                   }
+        series["msg-count"] += 1
+        series["msg-nums"].add(int(message["_bl-series-no"]))
+        series["msg-ids"].add(message["id"])
         # print "received message series %s: %d of %d" % (message["_bl-series-id"],
-        #                                                 self.open_series[message["_bl-series-id"]]["msg-count"],
-        #                                                 self.open_series[message["_bl-series-id"]]["total"])
+        #                                                 series["msg-count"],
+        #                                                 series["total"])
 
     def close_series(self, series_id):
         """Close given series
@@ -314,7 +620,7 @@ class Comparator(QueuedBase):
         self.comparator_config = config["comparator"]
         self.comparator_config["dbpath"] = os.path.expanduser(self.comparator_config["dbpath"])
         try:
-            os.makedirs(self.comparator_config["dbpath"], 0700)
+            os.makedirs(os.path.dirname(self.comparator_config["dbpath"]), 0700)
         except OSError:
             pass
         super(Comparator, self).__init__(**kwargs)
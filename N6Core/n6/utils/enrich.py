@@ -1,16 +1,23 @@
 # Copyright (c) 2013-2018 NASK. All rights reserved.
 
+import bisect
 import collections
+import mmap
 import os
+import socket
+import struct
+import tempfile
+import threading
+import time
 import urlparse
 
-import iptools
 import pygeoip
+import pygeoip.const
 import dns.resolver
 from dns.exception import DNSException
 
 from n6.base.queue import QueuedBase
-from n6lib.common_helpers import replace_segment, is_ipv4
+from n6lib.common_helpers import IPRangeMatcher, replace_segment, is_ipv4
 from n6lib.config import Config
 from n6lib.log_helpers import get_logger, logging_configured
 from n6lib.record_dict import RecordDict
@@ -19,6 +26,405 @@ from n6lib.record_dict import RecordDict
 LOGGER = get_logger(__name__)
 
 
+class DnsCache(object):
+
+    """
+    A thread-safe cache of DNS resolution results.
+
+    Each entry expires at the time specified when it is set (typically,
+    determined by TTLs of the DNS records or, for negative results, by
+    the configured negative TTL).  When the cache is full, the least
+    recently used entry is evicted.
+    """
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        # fqdn -> (expiration time, list of IPs)
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, fqdn):
+        """
+        Get the cached list of IPs (possibly empty -- for a negative
+        result) or None if there is no valid entry for the given FQDN.
+        """
+        with self._lock:
+            entry = self._entries.pop(fqdn, None)
+            if entry is None or entry[0] <= time.time():
+                self.misses += 1
+                return None
+            self._entries[fqdn] = entry  # (now it is the most recently used one)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, fqdn, ips, expiration_time):
+        if self._max_size <= 0:
+            return
+        with self._lock:
+            self._entries.pop(fqdn, None)
+            while len(self._entries) >= self._max_size:
+                self._entries.popitem(last=False)
+            self._entries[fqdn] = expiration_time, ips
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+class IpDataCache(object):
+
+    """
+    A thread-safe LRU cache of per-IP enrichment data.
+
+    Values are (<ASN>, <CC>, <is the IP excluded?>) tuples.  When the
+    cache is full, the least recently used entry is evicted.
+
+    Each clear() call increments the `generation` number.  A value
+    computed before clearing (e.g., using the previous GeoIP databases)
+    can be prevented from being stored after clearing: just pass to
+    set() the `generation` number read before computing the value.
+    """
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        # ip -> (asn, cc, excluded)
+        self._entries = collections.OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, ip):
+        """
+        Get the cached tuple or None if there is no entry for the given IP.
+        """
+        with self._lock:
+            entry = self._entries.pop(ip, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[ip] = entry  # (now it is the most recently used one)
+            self.hits += 1
+            return entry
+
+    def set(self, ip, ip_data, generation=None):
+        """
+        Store the tuple -- unless the cache has been cleared since the
+        given `generation` (if not None) was read.
+        """
+        if self._max_size <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries.pop(ip, None)
+            while len(self._entries) >= self._max_size:
+                self._entries.popitem(last=False)
+            self._entries[ip] = ip_data
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self._max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': (float(self.hits) / lookups if lookups else None),
+            }
+
+
+class _MmapArray(object):
+
+    # (a read-only sequence of fixed-size items stored in a memory-mapped
+    # file -- to be used with bisect; if `unpack_from` is given, each item
+    # is converted with it, otherwise it is just a raw string)
+
+    def __init__(self, mm, offset, item_size, length, unpack_from=None):
+        self._mm = mm
+        self._offset = offset
+        self._item_size = item_size
+        self._length = length
+        self._unpack_from = unpack_from
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, i):
+        if not 0 <= i < self._length:
+            raise IndexError('index out of range')
+        item_offset = self._offset + self._item_size * i
+        if self._unpack_from is not None:
+            return self._unpack_from(self._mm, item_offset)[0]
+        return self._mm[item_offset : item_offset + self._item_size]
+
+
+def _pack_ip(ip):
+    """
+    Get the given IPv4 or IPv6 address as a packed (big-endian) string
+    (4 or 16 bytes long); raise ValueError if it is not a valid address.
+    """
+    try:
+        if ':' in ip:
+            return socket.inet_pton(socket.AF_INET6, ip)
+        return socket.inet_pton(socket.AF_INET, ip)
+    except (socket.error, TypeError):
+        raise ValueError('{!r} is not a valid IP address'.format(ip))
+
+
+def _is_ipv6(value):
+    if ':' not in value:
+        return False
+    try:
+        _pack_ip(value)
+    except ValueError:
+        return False
+    return True
+
+
+class GeoIpIndexOutdated(ValueError):
+    """Raised by GeoIpIndex.open() if the index file needs to be rebuilt."""
+
+
+class GeoIpIndex(object):
+
+    """
+    A combined sorted-interval index: IP address -> (ASN, CC).
+
+    The index is built from the GeoIP (legacy format) ASN and country
+    databases -- either the IPv4 ones or the IPv6 ones -- and saved to
+    a file which is memory-mapped -- so that its pages are shared by all
+    enricher processes on the host.  Each lookup is one binary search
+    (instead of two GeoIP database tree walks).
+
+    The index file consists of a header (`FILE_MAGIC` + the address
+    size S [4 for IPv4, 16 for IPv6] as an 8-bit unsigned integer + the
+    number N of intervals as a 32-bit unsigned integer) followed by
+    three arrays: N interval start IPs (packed, i.e., S-byte big-endian
+    strings -- so that they sort in the same order as the addresses),
+    N ASNs (32-bit unsigned integers; 0 means: no ASN) and N country
+    codes (2-character strings; empty ones -- i.e., consisting of NUL
+    characters -- mean: no CC); all integers are little-endian.
+
+    Use the open() class method to get an instance (it builds the index
+    file first, if it does not exist or is older than the databases --
+    unless `build_if_outdated` is false; then GeoIpIndexOutdated is
+    raised).
+    """
+
+    FILE_MAGIC = 'n6GeoIPIndex2\n'
+
+    def __init__(self, index_path):
+        with open(index_path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(self.FILE_MAGIC)] != self.FILE_MAGIC:
+            raise ValueError('{!r} is not a GeoIP index file'.format(index_path))
+        header_size = len(self.FILE_MAGIC) + 5
+        self.address_size, length = struct.unpack_from('<BI', self._mm, len(self.FILE_MAGIC))
+        self._starts = _MmapArray(self._mm, header_size, self.address_size, length)
+        asns_offset = header_size + self.address_size * length
+        self._asns = _MmapArray(self._mm, asns_offset, 4, length,
+                                unpack_from=struct.Struct('<I').unpack_from)
+        self._ccs_offset = asns_offset + 4 * length
+
+    @classmethod
+    def open(cls, index_path, asn_db_path, cc_db_path, build_if_outdated=True):
+        """
+        Get an instance -- (re)building the index file if necessary.
+        """
+        try:
+            index_mtime = os.path.getmtime(index_path)
+        except OSError:
+            index_mtime = None
+        if (index_mtime is None or
+              index_mtime < os.path.getmtime(asn_db_path) or
+              index_mtime < os.path.getmtime(cc_db_path)):
+            if not build_if_outdated:
+                raise GeoIpIndexOutdated('the GeoIP index file {!r} does not exist '
+                                         'or is older than the GeoIP databases'
+                                         .format(index_path))
+            LOGGER.info('Building the GeoIP index file %r...', index_path)
+            cls.build(index_path, asn_db_path, cc_db_path)
+        return cls(index_path)
+
+    @classmethod
+    def build(cls, index_path, asn_db_path, cc_db_path):
+        """
+        Build the index file from the given GeoIP ASN and country databases.
+
+        The file is written atomically (so it is safe even if several
+        processes build it at the same time).
+        """
+        asn_bits, asn_intervals = _get_geoip_db_intervals(asn_db_path)
+        cc_bits, cc_intervals = _get_geoip_db_intervals(cc_db_path)
+        if asn_bits != cc_bits:
+            raise ValueError('GeoIP databases {!r} and {!r} concern different '
+                             'IP versions'.format(asn_db_path, cc_db_path))
+        address_size = asn_bits // 8
+        asn_intervals = [(start, cls._get_asn_from_org(org))
+                         for start, org in asn_intervals]
+        starts, asns, ccs = [], [], []
+        for start, asn, cc in _merge_intervals(asn_intervals, cc_intervals):
+            if starts and asns[-1] == (asn or 0) and ccs[-1] == (cc or '\0\0'):
+                continue
+            starts.append(_int_to_packed_ip(start, address_size))
+            asns.append(asn or 0)
+            ccs.append(cc or '\0\0')
+        length = len(starts)
+        index_dir = os.path.dirname(os.path.abspath(index_path))
+        fd, tmp_path = tempfile.mkstemp(dir=index_dir, prefix='.tmp-geoip-index-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(cls.FILE_MAGIC)
+                f.write(struct.pack('<BI', address_size, length))
+                f.write(''.join(starts))
+                f.write(struct.pack('<{}I'.format(length), *asns))
+                f.write(''.join(ccs))
+            os.rename(tmp_path, index_path)
+        except:
+            os.remove(tmp_path)
+            raise
+
+    @staticmethod
+    def _get_asn_from_org(org):
+        # (the same way of extracting ASN as in Enricher.ip_to_asn())
+        if org is None:
+            return None
+        asn = org.split()[0][2:]
+        if not asn.isdigit():
+            LOGGER.warning('Cannot extract ASN from GeoIP organization %r', org)
+            return None
+        return int(asn)
+
+    def lookup(self, ip):
+        """
+        Get a pair: (<ASN as str or None>, <CC as str or None>).
+        """
+        try:
+            packed_ip = _pack_ip(ip)
+        except ValueError:
+            packed_ip = None
+        if packed_ip is None or len(packed_ip) != self.address_size:
+            LOGGER.info('%r cannot be resolved by the GeoIP index', ip)
+            return None, None
+        i = bisect.bisect_right(self._starts, packed_ip) - 1
+        asn = self._asns[i]
+        cc_offset = self._ccs_offset + 2 * i
+        cc = self._mm[cc_offset : cc_offset + 2]
+        return (str(asn) if asn else None,
+                cc if cc != '\0\0' else None)
+
+
+def _int_to_packed_ip(ip_int, address_size):
+    return ''.join(chr((ip_int >> (8 * j)) & 0xff)
+                   for j in reversed(xrange(address_size)))
+
+
+def _get_geoip_db_intervals(db_path):
+    """
+    Get a pair: (<address size in bits: 32 or 128>, <list of intervals>)
+    for the given GeoIP (legacy format) ASN or country database (IPv4
+    or IPv6) -- by walking its whole tree.
+
+    The list contains (<interval start IP as int>, <value>) pairs, in
+    ascending order; each interval ends where the next one starts;
+    values are organization (ASN) strings or country codes (or None if
+    there is no data for the interval).
+    """
+    # (`cache=False` -- to get a new instance, not the one pygeoip
+    # keeps for the file name -- as the file may have been replaced)
+    gi = pygeoip.GeoIP(db_path, pygeoip.STANDARD, cache=False)
+    db_type = gi._databaseType
+    record_length = gi._recordLength
+    segments = gi._databaseSegments
+    with open(db_path, 'rb') as f:
+        db = f.read()
+    if db_type in (pygeoip.const.COUNTRY_EDITION,
+                   pygeoip.const.COUNTRY_EDITION_V6):
+        def get_value(leaf):
+            return pygeoip.const.COUNTRY_CODES[leaf - pygeoip.const.COUNTRY_BEGIN] or None
+    elif db_type in (pygeoip.const.ASNUM_EDITION,
+                     pygeoip.const.ASNUM_EDITION_V6):
+        org_offset = (2 * record_length - 1) * segments
+        def get_value(leaf):
+            if leaf == segments:
+                return None
+            start = leaf + org_offset
+            return db[start : db.index('\0', start)]
+    else:
+        raise ValueError('{!r} is neither an ASN nor a country '
+                         'GeoIP database'.format(db_path))
+    if db_type in (pygeoip.const.COUNTRY_EDITION_V6,
+                   pygeoip.const.ASNUM_EDITION_V6):
+        address_bits = 128
+    else:
+        address_bits = 32
+    node_size = 2 * record_length
+    leaves = []
+    nodes_to_visit = [(0, 0, 0)]  # (node number, depth, prefix as int)
+    while nodes_to_visit:
+        node, depth, prefix = nodes_to_visit.pop()
+        if depth >= address_bits:
+            raise ValueError('corrupt GeoIP database: {!r}'.format(db_path))
+        node_offset = node * node_size
+        for branch in (0, 1):
+            record_offset = node_offset + branch * record_length
+            pointer = 0
+            for j in xrange(record_length):
+                pointer += ord(db[record_offset + j]) << (j * 8)
+            start = prefix | (branch << (address_bits - 1 - depth))
+            if pointer >= segments:
+                leaves.append((start, pointer))
+            else:
+                nodes_to_visit.append((pointer, depth + 1, start))
+    leaves.sort()
+    value_cache = {}
+    intervals = []
+    for start, leaf in leaves:
+        value = value_cache.get(leaf)
+        if value is None and leaf not in value_cache:
+            value = value_cache[leaf] = get_value(leaf)
+        intervals.append((start, value))
+    return address_bits, intervals
+
+
+def _merge_intervals(asn_intervals, cc_intervals):
+    """
+    Merge two lists of (<start>, <value>) pairs (each covering the whole
+    address space) into (<start>, <ASN>, <CC>) triples.
+    """
+    boundaries = sorted(set(start for start, _ in asn_intervals) |
+                        set(start for start, _ in cc_intervals))
+    asn_i = cc_i = 0
+    for start in boundaries:
+        while asn_i + 1 < len(asn_intervals) and asn_intervals[asn_i + 1][0] <= start:
+            asn_i += 1
+        while cc_i + 1 < len(cc_intervals) and cc_intervals[cc_i + 1][0] <= start:
+            cc_i += 1
+        yield start, asn_intervals[asn_i][1], cc_intervals[cc_i][1]
+
+
+class _DnsLookup(object):
+
+    # (a DNS lookup being performed by one thread,
+    # whose result other threads may wait for)
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.ips = None
+
+
 class Enricher(QueuedBase):
 
     input_queue = {
@@ -40,6 +446,37 @@ class Enricher(QueuedBase):
 
     single_instance = False
 
+    # (the worker-pool mode can be used -- see: QueuedBase.max_workers;
+    # then many DNS queries can be in flight at once; concurrent lookups
+    # of the same FQDN are merged into one query)
+    input_callback_thread_safe = True
+
+    # defaults of the DNS-cache-related options of the `enrich` config
+    # section (the TTL is the time, in seconds, for which a negative
+    # result of resolution -- e.g., NXDOMAIN or timeout -- is cached)
+    default_dns_cache_max_size = 10000
+    default_dns_negative_cache_ttl = 60
+
+    # defaults of the IP-data-cache-related options of the `enrich`
+    # config section (the interval is the time, in seconds, between
+    # checks whether the GeoIP database files have been modified -- if
+    # they have, the databases are reloaded and the cache is cleared;
+    # at each check the cache stats are logged)
+    default_ip_data_cache_max_size = 100000
+    default_geodb_check_interval = 60
+
+    # GeoIpIndex instances (if the `geoip_index_path` option is set;
+    # the IPv6 one -- only if the IPv6 GeoIP databases are available)
+    geoip_index = None
+    geoip_index_v6 = None
+
+    # GeoIP database objects (the IPv6 ones -- if the databases are
+    # available; all of them -- if no GeoIpIndex is used)
+    gi_asn = None
+    gi_cc = None
+    gi_asn_v6 = None
+    gi_cc_v6 = None
+
     #
     # Initialization
 
@@ -50,25 +487,118 @@ class Enricher(QueuedBase):
         config = Config(required={"enrich": ("dnshost", "dnsport", "geoippath",)})
         self._enrich_config = config["enrich"]
         self.excluded_ips = self._get_excluded_ips()
+        self.dns_cache = DnsCache(int(self._enrich_config.get(
+            'dns_cache_max_size', self.default_dns_cache_max_size)))
+        self._dns_negative_cache_ttl = float(self._enrich_config.get(
+            'dns_negative_cache_ttl', self.default_dns_negative_cache_ttl))
+        self._dns_lookups = {}
+        self._dns_lookups_lock = threading.Lock()
+        self.ip_data_cache = IpDataCache(int(self._enrich_config.get(
+            'ip_data_cache_max_size', self.default_ip_data_cache_max_size)))
+        self._geodb_check_interval = float(self._enrich_config.get(
+            'geodb_check_interval', self.default_geodb_check_interval))
+        self._geodb_check_lock = threading.Lock()
+        self._geodb_next_check_time = time.time() + self._geodb_check_interval
+        self._geodb_mtimes = self._get_geodb_mtimes()
         self._setup_geodb()
-        self._setup_dnsresolver(self._enrich_config["dnshost"], int(self._enrich_config["dnsport"]))
+        self._setup_dnsresolver(self._enrich_config["dnshost"], int(self._enrich_config["dnsport"]),
+                                self._enrich_config.get("dns_timeout"))
         super(Enricher, self).__init__(**kwargs)
 
     def _get_excluded_ips(self):
         if self._enrich_config.get('excluded_ips'):
             excluded_ips = [_ip.strip() for _ip in self._enrich_config['excluded_ips'].split(',')]
-            return iptools.IpRangeList(*excluded_ips)
+            return IPRangeMatcher(*excluded_ips)
         return None
 
-    def _setup_dnsresolver(self, dnshost, dnsport):
+    def _setup_dnsresolver(self, dnshost, dnsport, dns_timeout=None):
         self._resolver = dns.resolver.Resolver(configure=False)
         self._resolver.nameservers = [dnshost]
         self._resolver.port = dnsport
-
-    def _setup_geodb(self):
-        geoipdb_path = self._enrich_config["geoippath"]
-        self.gi_asn = pygeoip.GeoIP(os.path.join(geoipdb_path, "GeoIPASNum.dat"), pygeoip.MEMORY_CACHE)
-        self.gi_cc = pygeoip.GeoIP(os.path.join(geoipdb_path, "GeoIP.dat"), pygeoip.MEMORY_CACHE)
+        if dns_timeout is not None:
+            # (the max time of the whole resolution, including retries)
+            self._resolver.lifetime = float(dns_timeout)
+
+    @staticmethod
+    def _get_geodb_paths(enrich_config):
+        geoipdb_path = enrich_config["geoippath"]
+        asn_db_path = os.path.join(geoipdb_path, "GeoIPASNum.dat")
+        cc_db_path = os.path.join(geoipdb_path, "GeoIP.dat")
+        return asn_db_path, cc_db_path
+
+    @staticmethod
+    def _get_ipv6_geodb_paths(enrich_config):
+        geoipdb_path = enrich_config["geoippath"]
+        asn_db_path = os.path.join(geoipdb_path, "GeoIPASNumv6.dat")
+        cc_db_path = os.path.join(geoipdb_path, "GeoIPv6.dat")
+        return asn_db_path, cc_db_path
+
+    def _get_geodb_mtimes(self):
+        mtimes = []
+        for path in (self._get_geodb_paths(self._enrich_config) +
+                     self._get_ipv6_geodb_paths(self._enrich_config)):
+            try:
+                mtimes.append(os.path.getmtime(path))
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def _setup_geodb(self, build_geoip_index=True):
+        # (all databases/indexes are loaded first and only then installed
+        # -- so that if loading fails the previous ones are still in use;
+        # if `build_geoip_index` is false, outdated GeoIP index files are
+        # not rebuilt -- GeoIpIndexOutdated is raised instead)
+        geoip_index = gi_asn = gi_cc = None
+        geoip_index_v6 = gi_asn_v6 = gi_cc_v6 = None
+        asn_db_path, cc_db_path = self._get_geodb_paths(self._enrich_config)
+        geoip_index_path = self._enrich_config.get("geoip_index_path")
+        if geoip_index_path:
+            # the combined, memory-mapped index is used instead of the databases
+            geoip_index = GeoIpIndex.open(geoip_index_path, asn_db_path, cc_db_path,
+                                          build_if_outdated=build_geoip_index)
+        else:
+            gi_asn, gi_cc = self._load_geodb_pair(asn_db_path, cc_db_path, '1.1.1.1')
+        # the IPv6 databases are optional
+        asn_db_path, cc_db_path = self._get_ipv6_geodb_paths(self._enrich_config)
+        if not (os.path.exists(asn_db_path) and os.path.exists(cc_db_path)):
+            LOGGER.info('IPv6 GeoIP databases not found -- IPv6 addresses '
+                        'will not be resolved to ASN/CC')
+        elif geoip_index_path:
+            geoip_index_v6 = GeoIpIndex.open(geoip_index_path + ".ipv6",
+                                             asn_db_path, cc_db_path,
+                                             build_if_outdated=build_geoip_index)
+        else:
+            gi_asn_v6, gi_cc_v6 = self._load_geodb_pair(asn_db_path, cc_db_path,
+                                                        '2001:db8::1')
+        (self.geoip_index, self.gi_asn, self.gi_cc,
+         self.geoip_index_v6, self.gi_asn_v6, self.gi_cc_v6) = (
+            geoip_index, gi_asn, gi_cc,
+            geoip_index_v6, gi_asn_v6, gi_cc_v6)
+
+    @staticmethod
+    def _load_geodb_pair(asn_db_path, cc_db_path, probe_ip):
+        # (`cache=False` -- to get new instances, not the ones pygeoip
+        # keeps for the file names -- as the files may have been replaced)
+        gi_asn = pygeoip.GeoIP(asn_db_path, pygeoip.MEMORY_CACHE, cache=False)
+        gi_cc = pygeoip.GeoIP(cc_db_path, pygeoip.MEMORY_CACHE, cache=False)
+        # pygeoip detects a corrupt database file (e.g., one that is
+        # not a GeoIP database at all) only when it is used -- so let's
+        # make a lookup now
+        gi_asn.org_by_addr(probe_ip)
+        gi_cc.country_code_by_addr(probe_ip)
+        return gi_asn, gi_cc
+
+    @classmethod
+    def build_geoip_index_files(cls, enrich_config):
+        """
+        Build the GeoIP index files (see: the `geoip_index_path` option
+        of the `enrich` config section) from the current GeoIP databases.
+        """
+        geoip_index_path = enrich_config["geoip_index_path"]
+        GeoIpIndex.build(geoip_index_path, *cls._get_geodb_paths(enrich_config))
+        asn_db_path, cc_db_path = cls._get_ipv6_geodb_paths(enrich_config)
+        if os.path.exists(asn_db_path) and os.path.exists(cc_db_path):
+            GeoIpIndex.build(geoip_index_path + ".ipv6", asn_db_path, cc_db_path)
 
     #
     # Main activity
@@ -82,6 +612,7 @@ class Enricher(QueuedBase):
             self.publish_output(routing_key=rk, body=body)
 
     def enrich(self, data):
+        self._maybe_check_geodb()
         enriched_keys = []
         ip_to_enriched_address_keys = collections.defaultdict(list)
         ip_from_url, fqdn_from_url = self._extract_ip_or_fqdn(data)
@@ -118,6 +649,12 @@ class Enricher(QueuedBase):
                     url)
             if is_ipv4(_fqdn_or_ip):
                 ip_from_url = _fqdn_or_ip
+            elif _is_ipv6(_fqdn_or_ip):
+                # (an IPv6 address is neither an FQDN nor something that
+                # could be placed in `address` -- whose items, in n6, can
+                # contain only IPv4 addresses)
+                LOGGER.debug('IPv6 address %r from url %r not enriched '
+                             '[source: %r]', _fqdn_or_ip, url, data.get('source'))
             elif _fqdn_or_ip:
                 fqdn_from_url = _fqdn_or_ip
         return ip_from_url, fqdn_from_url
@@ -143,11 +680,11 @@ class Enricher(QueuedBase):
 
     def _filter_out_excluded_ips(self, data, ip_to_enriched_address_keys):
         assert 'address' in data
-        if self.excluded_ips:
+        if self.excluded_ips is not None:
             _address = []
             for addr in data['address']:
                 ip = addr['ip']
-                if ip in self.excluded_ips:
+                if self.get_ip_data(ip)[2]:
                     ip_to_enriched_address_keys.pop(ip, None)
                 else:
                     _address.append(addr)
@@ -156,8 +693,9 @@ class Enricher(QueuedBase):
     def _maybe_set_other_address_data(self, data, ip_to_enriched_address_keys):
         assert 'address' in data
         for addr in data['address']:
-            # ASN
             ip = addr['ip']
+            asn, cc, _ = self.get_ip_data(ip)
+            # ASN
             existing_asn = addr.pop('asn', None)
             if existing_asn is not None:
                 LOGGER.warning(
@@ -170,7 +708,6 @@ class Enricher(QueuedBase):
                     data['source'],
                     data['id'],
                     data['rid'])
-            asn = self.ip_to_asn(ip)
             if asn:
                 addr['asn'] = asn
                 ip_to_enriched_address_keys[ip].append('asn')
@@ -187,7 +724,6 @@ class Enricher(QueuedBase):
                     data['source'],
                     data['id'],
                     data['rid'])
-            cc = self.ip_to_cc(ip)
             if cc:
                 addr['cc'] = cc
                 ip_to_enriched_address_keys[ip].append('cc')
@@ -225,18 +761,137 @@ class Enricher(QueuedBase):
         return parsed_url.hostname
 
     def fqdn_to_ip(self, fqdn):
+        return self._resolve_fqdn(fqdn, 'A')
+
+    def fqdn_to_ipv6(self, fqdn):
+        # (note: not used by enrich() as `address` items, in n6, can
+        # contain only IPv4 addresses)
+        return self._resolve_fqdn(fqdn, 'AAAA')
+
+    def _resolve_fqdn(self, fqdn, rdtype):
+        # (cache keys: FQDNs for `A` records, (FQDN, rdtype) pairs for others)
+        key = fqdn if rdtype == 'A' else (fqdn, rdtype)
+        ips = self.dns_cache.get(key)
+        if ips is None:
+            ips = self._lookup_fqdn(fqdn, rdtype, key)
+        return list(ips)
+
+    def _lookup_fqdn(self, fqdn, rdtype, key):
+        with self._dns_lookups_lock:
+            lookup = self._dns_lookups.get(key)
+            if lookup is None:
+                lookup = self._dns_lookups[key] = _DnsLookup()
+                in_progress = False
+            else:
+                in_progress = True
+        if in_progress:
+            # another thread is already querying for this FQDN
+            lookup.done.wait()
+            if lookup.ips is not None:
+                return lookup.ips
+            # (that thread failed unexpectedly)
+            return self._query_fqdn(fqdn, rdtype, key)
+        try:
+            lookup.ips = self._query_fqdn(fqdn, rdtype, key)
+        finally:
+            with self._dns_lookups_lock:
+                del self._dns_lookups[key]
+            lookup.done.set()
+        return lookup.ips
+
+    def _query_fqdn(self, fqdn, rdtype, key):
         try:
-            dns_result = self._resolver.query(fqdn, 'A')
+            dns_result = self._resolver.query(fqdn, rdtype)
         except DNSException:
-            return []
-        ip_set = set()
-        for i in dns_result:
-            ip_set.add(str(i))
-        return sorted(ip_set)
+            ips = []
+            expiration_time = time.time() + self._dns_negative_cache_ttl
+        else:
+            ip_set = set()
+            for i in dns_result:
+                ip_set.add(str(i))
+            ips = sorted(ip_set)
+            expiration_time = dns_result.expiration
+        self.dns_cache.set(key, ips, expiration_time)
+        return ips
+
+    def _maybe_check_geodb(self):
+        if time.time() < self._geodb_next_check_time:
+            return
+        if not self._geodb_check_lock.acquire(False):
+            # another thread is checking right now
+            return
+        try:
+            if time.time() < self._geodb_next_check_time:
+                return
+            LOGGER.info('IP data cache stats: %r', self.ip_data_cache.get_stats())
+            mtimes = self._get_geodb_mtimes()
+            if mtimes != self._geodb_mtimes:
+                LOGGER.info('GeoIP database files have been modified -- reloading them')
+                try:
+                    # (GeoIP index files are not rebuilt here, i.e., in
+                    # the midst of message processing, by each enricher
+                    # process -- they need to be built beforehand; see:
+                    # geoip_index_main())
+                    self._setup_geodb(build_geoip_index=False)
+                except GeoIpIndexOutdated as exc:
+                    LOGGER.warning('%s -- still using the previously loaded '
+                                   'GeoIP data (will retry)', exc)
+                except Exception:
+                    # Note: catching Exception is OK here.  The new files
+                    # may be incomplete (e.g., still being downloaded) or
+                    # corrupt -- then we just keep using the previous ones.
+                    LOGGER.error('Could not reload the GeoIP databases -- still '
+                                 'using the previously loaded ones (will retry)',
+                                 exc_info=True)
+                else:
+                    # (it must be done *after* installing the new databases:
+                    # values computed by other threads using the previous
+                    # ones will not be stored -- see: get_ip_data())
+                    self.ip_data_cache.clear()
+                    LOGGER.info('GeoIP databases reloaded, IP data cache cleared')
+                    self._geodb_mtimes = mtimes
+            self._geodb_next_check_time = time.time() + self._geodb_check_interval
+        finally:
+            self._geodb_check_lock.release()
+
+    def get_ip_data(self, ip):
+        """
+        Get a tuple: (<ASN>, <CC>, <is the IP excluded?>) -- cached.
+
+        For excluded IPs, ASN and CC are not looked up (they are None).
+        """
+        cache_generation = self.ip_data_cache.generation
+        ip_data = self.ip_data_cache.get(ip)
+        if ip_data is None:
+            if self.excluded_ips is not None and ip in self.excluded_ips:
+                ip_data = None, None, True
+            else:
+                asn, cc = self.ip_to_asn_and_cc(ip)
+                ip_data = asn, cc, False
+            self.ip_data_cache.set(ip, ip_data, cache_generation)
+        return ip_data
+
+    def _get_geoip_objects(self, ip):
+        # (get a tuple: (<GeoIpIndex or None>, <ASN db>, <CC db>) -- for
+        # the IP version of the given address)
+        if ':' in ip:
+            return self.geoip_index_v6, self.gi_asn_v6, self.gi_cc_v6
+        return self.geoip_index, self.gi_asn, self.gi_cc
+
+    def ip_to_asn_and_cc(self, ip):
+        geoip_index = self._get_geoip_objects(ip)[0]
+        if geoip_index is not None:
+            return geoip_index.lookup(ip)
+        return self.ip_to_asn(ip), self.ip_to_cc(ip)
 
     def ip_to_asn(self, ip):
+        geoip_index, gi_asn, _ = self._get_geoip_objects(ip)
+        if geoip_index is not None:
+            return geoip_index.lookup(ip)[0]
+        if gi_asn is None:
+            return None
         try:
-            isp = self.gi_asn.org_by_addr(ip)
+            isp = gi_asn.org_by_addr(ip)
         except pygeoip.GeoIPError:
             LOGGER.info("%r cannot be resolved by GeoIP (to ASN)", ip)
             return None
@@ -247,8 +902,13 @@ class Enricher(QueuedBase):
         return asn
 
     def ip_to_cc(self, ip):
+        geoip_index, _, gi_cc = self._get_geoip_objects(ip)
+        if geoip_index is not None:
+            return geoip_index.lookup(ip)[1]
+        if gi_cc is None:
+            return None
         try:
-            cc = self.gi_cc.country_code_by_addr(ip)
+            cc = gi_cc.country_code_by_addr(ip)
         except pygeoip.GeoIPError:
             LOGGER.info("%r cannot be resolved by GeoIP (to CC)", ip)
             return None
@@ -264,5 +924,17 @@ def main():
             enricher.stop()
 
 
+def geoip_index_main():
+    """
+    Build the GeoIP index files -- to be run whenever the GeoIP databases
+    are updated (running enrichers do not rebuild outdated index files;
+    they keep using the previously loaded data until the index files are
+    up to date).
+    """
+    with logging_configured():
+        config = Config(required={"enrich": ("geoippath", "geoip_index_path")})
+        Enricher.build_geoip_index_files(config["enrich"])
+
+
 if __name__ == "__main__":
     main()
@@ -57,18 +57,33 @@ class Filter(ConfigMixin, QueuedBase):
         super(Filter, self).__init__(**kwargs)
 
     def input_callback(self, routing_key, body, properties):
+        self.process_event(routing_key, body)
+
+    def batch_input_callback(self, messages):
+        # (used in the micro-batch mode -- see: QueuedBase.batch_max_size)
+        # the criteria resolver is obtained once per batch
+        resolver = self.auth_api.get_inside_criteria_resolver()
+        for message in messages:
+            try:
+                self.process_event(message.routing_key, message.body, resolver)
+            except Exception:
+                message.mark_failed()
+
+    def process_event(self, routing_key, body, resolver=None):
         record_dict = RecordDict.from_json(body)
         with self.setting_error_event_info(record_dict):
             client, urls_matched = self.get_client_and_urls_matched(
                 record_dict,
-                self.fqdn_only_categories)
+                self.fqdn_only_categories,
+                resolver)
             record_dict['client'] = client
             if urls_matched:
                 record_dict['urls_matched'] = urls_matched
             self.publish_event(record_dict, routing_key)
 
-    def get_client_and_urls_matched(self, record_dict, fqdn_only_categories):
-        resolver = self.auth_api.get_inside_criteria_resolver()
+    def get_client_and_urls_matched(self, record_dict, fqdn_only_categories, resolver=None):
+        if resolver is None:
+            resolver = self.auth_api.get_inside_criteria_resolver()
         client_org_ids, urls_matched = resolver.get_client_org_ids_and_urls_matched(
             record_dict,
             fqdn_only_categories)
@@ -1021,6 +1021,39 @@ class AuthAPI(object):
 
 
 
+_GLOB_SPECIAL_CHARS_REGEX = re.compile(r'[*?[]')
+
+@memoized(max_size=1000)
+def _get_url_pattern_matchers(url_pattern):
+    """
+    Compile the given `url_pattern` (only once per distinct pattern).
+
+    Returns a triple (3-tuple):
+
+    * the `search` method of the pattern compiled as a regular
+      expression (or None if it is not a valid regular expression),
+    * the `match` method of the pattern compiled as a glob-like
+      (fnmatch) pattern (or None if that compilation failed),
+    * the literal prefix of the glob-like pattern (a string).
+
+    Raises an exception if neither of the compilations succeeded.
+    """
+    try:
+        ### XXX: do we really want to use the re.UNICODE flag here???
+        regex_search = re.compile(url_pattern, re.UNICODE).search
+    except re.error:
+        regex_search = None
+        glob_match = re.compile(fnmatch.translate(url_pattern)).match
+    else:
+        try:
+            glob_match = re.compile(fnmatch.translate(url_pattern)).match
+        except re.error:
+            glob_match = None
+    glob_prefix = _GLOB_SPECIAL_CHARS_REGEX.split(url_pattern, 1)[0]
+    return regex_search, glob_match, glob_prefix
+
+
+
 class InsideCriteriaResolver(object):
 
     """
@@ -1087,8 +1120,8 @@ class InsideCriteriaResolver(object):
         self._asn_to_ids = collections.defaultdict(list)
         self._cc_to_ids = collections.defaultdict(list)
 
-        # a list of pairs: (<org id>, <tuple of `n6url` values>)
-        self._ids_and_urls = []
+        # a mapping that maps `n6url` values to lists of org ids
+        url_to_ids = collections.defaultdict(list)
 
         _seen_ids = set()  # <- for sanity assertions only
         for cri in inside_criteria:
@@ -1112,9 +1145,8 @@ class InsideCriteriaResolver(object):
                     mapping[key].append(org_id)
 
             # URLs
-            url_seq = cri.get('url_seq')
-            if url_seq:
-                self._ids_and_urls.append((org_id, tuple(url_seq)))
+            for url in set(cri.get('url_seq', ())):
+                url_to_ids[url].append(org_id)
 
         # [related to IPs]
         # a pair (2-tuple) consisting of:
@@ -1134,6 +1166,21 @@ class InsideCriteriaResolver(object):
         self._border_ips_and_corresponding_id_sets = (
             self._get_border_ips_and_corresponding_id_sets(ip_to_id_endpoints))
 
+        # [related to URLs]
+        # * `url to ids` -- a dict that maps each distinct `n6url` value
+        #   to a tuple of org ids (so that each URL is examined only
+        #   once per event, regardless of how many orgs specify it)
+        #
+        # * `sorted urls` -- a sorted list of all those distinct URLs;
+        #   thanks to it, when the event's `url_pattern` is treated as
+        #   a glob-like pattern with a literal prefix, only the URLs
+        #   beginning with that prefix need to be examined (they are
+        #   found with bisection)
+        self._url_to_ids = dict(
+            (url, tuple(id_seq))
+            for url, id_seq in url_to_ids.iteritems())
+        self._sorted_urls = sorted(self._url_to_ids)
+
 
     def _get_border_ips_and_corresponding_id_sets(self, ip_to_id_endpoints):
         border_ips = []
@@ -1160,6 +1207,26 @@ class InsideCriteriaResolver(object):
         return border_ips, corresponding_id_sets
 
 
+    def _get_matching_urls(self, regex_search, glob_match, glob_prefix):
+        sorted_urls = self._sorted_urls
+        if regex_search is not None:
+            matching_urls = set(url for url in sorted_urls
+                                if regex_search(url) is not None)
+        else:
+            matching_urls = set()
+        if glob_match is not None:
+            # only the URLs that start with the literal prefix
+            # of the glob-like pattern can be matched by it
+            for i in xrange(bisect.bisect_left(sorted_urls, glob_prefix),
+                            len(sorted_urls)):
+                url = sorted_urls[i]
+                if not url.startswith(glob_prefix):
+                    break
+                if url not in matching_urls and glob_match(url) is not None:
+                    matching_urls.add(url)
+        return matching_urls
+
+
     def get_client_org_ids_and_urls_matched(self,
                                             record_dict,
                                             fqdn_only_categories=frozenset()):
@@ -1240,31 +1307,17 @@ class InsideCriteriaResolver(object):
             if url_pattern is not None:
                 assert url_pattern  # (already assured by RecordDict machinery)
                 try:
-                    try:
-                        ### XXX: do we really want to use the re.UNICODE flag here???
-                        match1 = re.compile(url_pattern, re.UNICODE).search
-                    except re.error:
-                        match1 = re.compile(fnmatch.translate(url_pattern)).match
-                        match2 = None
-                    else:
-                        try:
-                            match2 = re.compile(fnmatch.translate(url_pattern)).match
-                        except re.error:
-                            match2 = None
+                    regex_search, glob_match, glob_prefix = _get_url_pattern_matchers(url_pattern)
                 except Exception as exc:
                     LOGGER.warning(
                         'Exception occurred when trying to process `url_pattern` (%r) '
                         '-- %s: %s', url_pattern, get_class_name(exc), ascii_str(exc))
                 else:
-                    for org_id, urls in self._ids_and_urls:
-                        org_matching_urls = set()
-                        for url in urls:
-                            if match1(url) is not None or (
-                                  match2 is not None and
-                                  match2(url) is not None):
-                                client_org_ids.add(org_id)
-                                org_matching_urls.add(url)
-                        if org_matching_urls:
-                            urls_matched[org_id] = sorted(org_matching_urls)
+                    matching_urls = self._get_matching_urls(regex_search, glob_match, glob_prefix)
+                    url_to_ids = self._url_to_ids
+                    for url in sorted(matching_urls):
+                        for org_id in url_to_ids[url]:
+                            client_org_ids.add(org_id)
+                            urls_matched.setdefault(org_id, []).append(url)
 
         return client_org_ids, urls_matched
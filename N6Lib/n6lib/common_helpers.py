@@ -8,6 +8,7 @@
 
 import abc
 import ast
+import bisect
 import collections
 import copy
 import cPickle
@@ -20,6 +21,8 @@ import os.path as osp
 import random
 import re
 import shutil
+import socket
+import struct
 import subprocess
 import sys
 import tempfile
@@ -1455,6 +1458,146 @@ class LimitedDict(collections.OrderedDict):
         return self
 
 
+class IPRangeMatcher(object):
+
+    """
+    A set of IP (v4 and/or v6) address ranges, with fast membership tests.
+
+    The constructor takes any number of IP addresses and/or CIDR network
+    specifications (strings).  Overlapping and adjacent ranges are merged
+    into disjoint intervals whose lower endpoints are kept in a sorted
+    list -- so that each membership test is just one binary search (in
+    contrast to `iptools.IpRangeList`, which tests each range in turn).
+
+    Abbreviated IPv4 addresses are accepted and interpreted in the same
+    way as by `iptools`: in a network specification the missing parts
+    are the trailing ones (e.g., '10.0/16' means '10.0.0.0/16'); in a
+    standalone address the last given part is the last octet (e.g.,
+    '127.1' means '127.0.0.1'), except that a one-part address denotes
+    a network number (e.g., '127' means '127.0.0.0').
+
+    >>> m = IPRangeMatcher('10.0.0.0/8', '192.168.1.1', ' 192.168.1.2 ',
+    ...                    '2001:db8::/32', '10.20.0.0/16')
+    >>> '10.0.0.0' in m
+    True
+    >>> u'10.255.255.255' in m
+    True
+    >>> '11.0.0.0' in m
+    False
+    >>> '192.168.1.1' in m, '192.168.1.2' in m, '192.168.1.3' in m
+    (True, True, False)
+    >>> '2001:db8::1' in m
+    True
+    >>> '2001:db9::' in m
+    False
+    >>> '::ffff:10.0.0.1' in m   # (IPv4-mapped IPv6 addresses are not IPv4)
+    False
+    >>> len(m)   # (the number of disjoint intervals)
+    3
+    >>> '0.0.0.0' in IPRangeMatcher('0.0.0.0/0')
+    True
+    >>> '255.255.255.255' in IPRangeMatcher('0.0.0.0/0')
+    True
+    >>> '::' in IPRangeMatcher('0.0.0.0/0')
+    False
+    >>> '1.2.3.4' in IPRangeMatcher()
+    False
+
+    >>> a = IPRangeMatcher('127/8', '10.0/16', '192.168.1', '172.16')
+    >>> '127.255.0.1' in a, '10.0.255.255' in a, '10.1.0.0' in a
+    (True, True, False)
+    >>> '192.168.0.1' in a, '192.168.1.0' in a, '172.0.0.16' in a, '172.16.0.0' in a
+    (True, False, True, False)
+    >>> '127.1' in a
+    True
+
+    >>> '1.2.3.256' in m                   # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+      ...
+    ValueError: ...
+
+    >>> IPRangeMatcher('10.0.0.0/33')     # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+      ...
+    ValueError: ...
+
+    >>> IPRangeMatcher('10.256/16')       # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+      ...
+    ValueError: ...
+    """
+
+    # (IPv6 addresses are mapped to ints following all IPv4 ones,
+    # so that both kinds of addresses can be kept in one list)
+    _IPv6_OFFSET = 2 ** 32
+
+    # (an IPv4 address consisting of 1 to 3 parts)
+    _ABBREVIATED_IPv4_REGEX = re.compile(r'\A\d{1,3}(?:\.\d{1,3}){0,2}\Z')
+
+    def __init__(self, *ips_or_networks):
+        intervals = sorted(map(self._get_interval, ips_or_networks))
+        self._starts = []
+        self._ends = []
+        for start, end in intervals:
+            if self._ends and start <= self._ends[-1]:
+                # overlapping or adjacent => merging
+                self._ends[-1] = max(self._ends[-1], end)
+            else:
+                self._starts.append(start)
+                self._ends.append(end)
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __contains__(self, ip):
+        ip_int = self._ip_to_int(ip)
+        i = bisect.bisect_right(self._starts, ip_int) - 1
+        return i >= 0 and ip_int < self._ends[i]
+
+    @classmethod
+    def _get_interval(cls, ip_or_network):
+        # (get a pair: (<lower endpoint>, <upper endpoint, exclusive>))
+        ip, _, prefix_len = ip_or_network.strip().partition('/')
+        ip_int = cls._ip_to_int(ip, is_network=bool(prefix_len))
+        bits = 128 if ip_int >= cls._IPv6_OFFSET else 32
+        try:
+            prefix_len = int(prefix_len) if prefix_len else bits
+            if not 0 <= prefix_len <= bits:
+                raise ValueError
+        except ValueError:
+            raise ValueError('{!r} is not a valid IP network '
+                             'specification'.format(ip_or_network))
+        size = 2 ** (bits - prefix_len)
+        offset = (cls._IPv6_OFFSET if bits == 128 else 0)
+        start = offset + (ip_int - offset) // size * size
+        return start, start + size
+
+    @classmethod
+    def _ip_to_int(cls, ip, is_network=False,
+                   _unpack_ipv4=struct.Struct('!I').unpack,
+                   _unpack_ipv6=struct.Struct('!QQ').unpack):
+        try:
+            if cls._ABBREVIATED_IPv4_REGEX.match(ip):
+                ip = cls._expand_abbreviated_ipv4(ip, is_network)
+            if ':' in ip:
+                high, low = _unpack_ipv6(socket.inet_pton(socket.AF_INET6, ip))
+                return cls._IPv6_OFFSET + ((high << 64) | low)
+            return _unpack_ipv4(socket.inet_pton(socket.AF_INET, ip))[0]
+        except (socket.error, TypeError):
+            raise ValueError('{!r} is not a valid IP address'.format(ip))
+
+    @staticmethod
+    def _expand_abbreviated_ipv4(ip, is_network):
+        # (see the class docs)
+        parts = ip.split('.')
+        missing = ['0'] * (4 - len(parts))
+        if is_network or len(parts) == 1:
+            parts += missing
+        else:
+            parts[-1:-1] = missing
+        return '.'.join(parts)
+
+
 class _CacheKey(object):
 
     def __init__(self, *args):
@@ -598,6 +598,25 @@ class Config(DictWithSomeHooks):
         return section
 
 
+    @classmethod
+    def is_section_present(cls, sect_name):
+        """
+        A class method that checks whether the n6 config files contain
+        the specified section.
+
+        It is cheaper than creating a Config instance (the config files
+        are read by the same -- memoized -- helper but no Config or
+        ConfigSection objects are made).
+
+        Args:
+            `sect_name` (str): The config section name.
+
+        Returns:
+            True or False.
+        """
+        return sect_name in cls._load_n6_config_files()
+
+
     @classmethod
     def make(*args, **kwargs):
         """